@@ -25,7 +25,7 @@ import threading
 import time
 import types
 import urllib.parse
-from concurrent import futures
+import weakref
 from pathlib import Path
 
 from markupsafe import Markup, escape
@@ -99,7 +99,14 @@ from .views.table import (
 from .views.row import RowView, RowDeleteView, RowUpdateView
 from .renderer import json_renderer
 from .url_builder import Urls
-from .database import Database, QueryInterrupted
+from .sql_processes import create_sql_process_pool
+from .database import (
+    Database,
+    QueryInterrupted,
+    QueryResultCache,
+    SQLThreadPool,
+    _query_result_cache_disabled,
+)
 
 from .utils import (
     PaginatedResources,
@@ -128,8 +135,12 @@ from .utils import (
     tilde_encode,
     to_css_class,
     urlsafe_components,
+    value_as_boolean,
+    ValueAsBooleanError,
     redact_keys,
     row_sql_params_pks,
+    _start_background_task,
+    _task_is_running,
 )
 from .tokens import TokenInvalid
 from .utils.asgi import (
@@ -151,10 +162,12 @@ from .utils.asgi import (
 from .csrf import CrossOriginProtectionMiddleware
 from .utils.internal_db import init_internal_db, populate_schema_tables
 from .utils.sqlite import (
+    decode_text_replacing_errors,
     sqlite3,
     using_pysqlite3,
 )
-from .tracer import AsgiTracer
+from .tracer import AsgiTracer, trace_child_tasks
+from .response_cache import AsgiResponseCache, ResponseCache
 from .plugins import pm, DEFAULT_PLUGINS, get_plugins
 from .version import __version__
 
@@ -219,6 +232,31 @@ SETTINGS = (
         3,
         "Number of threads in the thread pool for executing SQLite queries",
     ),
+    Setting(
+        "max_read_connections",
+        0,
+        "Maximum number of read connections to open for each database - 0 means one per SQL thread",
+    ),
+    Setting(
+        "idle_connection_timeout",
+        300,
+        "Close read connections that have been idle for this many seconds - set 0 to keep them open",
+    ),
+    Setting(
+        "num_sql_processes",
+        0,
+        "Number of worker processes for executing read-only SQL queries - 0 runs them in threads",
+    ),
+    Setting(
+        "write_batch_size",
+        1,
+        "Maximum number of queued writes to commit together in a single transaction",
+    ),
+    Setting(
+        "write_batch_wait_ms",
+        0,
+        "Time to wait for more queued writes before committing a batch of writes",
+    ),
     Setting("sql_time_limit_ms", 1000, "Time limit for a SQL query in milliseconds"),
     Setting(
         "default_facet_size", 30, "Number of values to return for requested facets"
@@ -261,6 +299,31 @@ SETTINGS = (
         "Default HTTP cache TTL (used in Cache-Control: max-age= header)",
     ),
     Setting("cache_size_kb", 0, "SQLite cache size in KB (0 == use SQLite default)"),
+    Setting(
+        "query_cache_size_kb",
+        0,
+        "Size of the in-memory cache of query results, in KB (0 == disabled)",
+    ),
+    Setting(
+        "response_cache_size_kb",
+        0,
+        "Size of the in-memory cache of responses to anonymous GET requests, in KB (0 == disabled)",
+    ),
+    Setting(
+        "response_cache_ttl",
+        5,
+        "Seconds that cached responses are served before being refreshed",
+    ),
+    Setting(
+        "fast_text_decoding",
+        False,
+        "Decode TEXT values using the faster built-in str decoder, replacing invalid UTF-8 only for databases found to contain it",
+    ),
+    Setting(
+        "hash_sidecar_files",
+        False,
+        "Record the hashes of large immutable databases in .datasette-hash.json files next to them, so they are not hashed again on restart",
+    ),
     Setting(
         "allow_csv_stream",
         True,
@@ -452,17 +515,13 @@ class Datasette:
         self.databases = collections.OrderedDict()
         self.actions = {}  # .invoke_startup() will populate this
         self._column_types = {}  # .invoke_startup() will populate this
-        try:
-            self._refresh_schemas_lock = asyncio.Lock()
-        except RuntimeError as rex:
-            # Workaround for intermittent test failure, see:
-            # https://github.com/simonw/datasette/issues/1802
-            if "There is no current event loop in thread" in str(rex):
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                self._refresh_schemas_lock = asyncio.Lock()
-            else:
-                raise
+        # See refresh_schemas()
+        self._last_schema_refresh = 0
+        self._schema_probe_task = None
+        self._schema_refresh_task = None
+        self._schema_refresh_pending = set()
+        self._schema_refreshed_databases = None
+        self._refresh_schemas_locks = weakref.WeakKeyDictionary()
         self.crossdb = crossdb
         self.nolock = nolock
         if memory or crossdb or not self.files:
@@ -572,11 +631,34 @@ class Datasette:
         self._settings = dict(DEFAULT_SETTINGS, **(config_settings), **(settings or {}))
         self.renderers = {}  # File extension -> (renderer, can_render) functions
         self.version_note = version_note
+        # SQL thread pools: "default" plus any configured for specific databases
+        self._sql_thread_pools = {}
+        self._database_sql_thread_pools = {}
         if self.setting("num_sql_threads") == 0:
             self.executor = None
         else:
-            self.executor = futures.ThreadPoolExecutor(
-                max_workers=self.setting("num_sql_threads")
+            default_pool = SQLThreadPool("default", self.setting("num_sql_threads"))
+            self._sql_thread_pools["default"] = default_pool
+            self.executor = default_pool.executor
+            self._configure_sql_thread_pools()
+        self._sql_process_pool = None
+        # Tells worker processes to close connections to removed databases
+        self._databases_removed = 0
+        if self.setting("num_sql_processes") and self.executor is not None:
+            self._sql_process_pool = create_sql_process_pool(
+                self, self.setting("num_sql_processes")
+            )
+        self._last_read_connection_eviction = time.monotonic()
+        self.query_result_cache = None
+        if self.setting("query_cache_size_kb"):
+            self.query_result_cache = QueryResultCache(
+                self.setting("query_cache_size_kb") * 1024
+            )
+        self.response_cache = None
+        if self.setting("response_cache_size_kb"):
+            self.response_cache = ResponseCache(
+                self.setting("response_cache_size_kb") * 1024,
+                self.setting("response_cache_ttl"),
             )
         self.max_returned_rows = self.setting("max_returned_rows")
         self.sql_time_limit_ms = self.setting("sql_time_limit_ms")
@@ -694,19 +776,79 @@ class Datasette:
         return None
 
     async def refresh_schemas(self, *, force=False):
-        # Throttle schema refreshes to at most once per second
-        if (
-            not force
-            and time.monotonic() - getattr(self, "_last_schema_refresh", 0) < 1.0
+        # Databases that have been attached or detached since the last full
+        # refresh are refreshed straight away
+        if force or set(self.databases) != self._schema_refreshed_databases:
+            async with self._refresh_schemas_lock():
+                await self._refresh_schemas()
+            return
+        # Schema changes made by writes through Datasette are refreshed in
+        # the background as soon as they happen - wait for any in progress
+        if self._schema_refresh_pending and not _task_is_running(
+            self._schema_refresh_task
         ):
+            self._schema_refresh_task = _start_background_task(
+                self._refresh_pending_schemas()
+            )
+        if _task_is_running(self._schema_refresh_task):
+            await asyncio.shield(self._schema_refresh_task)
+        # Changes made by other connections are checked for at most once
+        # per second, in the background for databases that are not shared
+        # in-memory databases
+        if time.monotonic() - self._last_schema_refresh < 1.0:
             return
         self._last_schema_refresh = time.monotonic()
-        if self._refresh_schemas_lock.locked():
+        shared_memory = [name for name, db in self.databases.items() if db.memory_name]
+        if shared_memory:
+            async with self._refresh_schemas_lock():
+                await self._refresh_schemas(shared_memory)
+        if not _task_is_running(self._schema_probe_task):
+            self._schema_probe_task = _start_background_task(
+                self._refresh_schemas_in_background(
+                    [name for name in self.databases if name not in shared_memory]
+                )
+            )
+
+    def _refresh_schemas_lock(self):
+        # One lock per event loop, so a refresh left unfinished by a loop
+        # that has stopped cannot hold up refreshes in another
+        loop = asyncio.get_running_loop()
+        lock = self._refresh_schemas_locks.get(loop)
+        if lock is None:
+            lock = self._refresh_schemas_locks[loop] = asyncio.Lock()
+        return lock
+
+    def _schedule_schema_refresh(self, database_name):
+        # Called by Database.execute_write_fn() after a write changed the
+        # schema of a database. Shared in-memory databases are left for the
+        # next refresh_schemas() - their table locks mean reading the schema
+        # while another write is running could make that write fail.
+        db = self.databases.get(database_name)
+        if db is None:
             return
-        async with self._refresh_schemas_lock:
-            await self._refresh_schemas()
+        self._schema_refresh_pending.add(database_name)
+        if db.memory_name:
+            return
+        if not _task_is_running(self._schema_refresh_task):
+            self._schema_refresh_task = _start_background_task(
+                self._refresh_pending_schemas()
+            )
 
-    async def _refresh_schemas(self):
+    async def _refresh_pending_schemas(self):
+        while self._schema_refresh_pending:
+            database_names = self._schema_refresh_pending
+            self._schema_refresh_pending = set()
+            await self._refresh_schemas_in_background(database_names)
+
+    async def _refresh_schemas_in_background(self, database_names=None):
+        try:
+            async with self._refresh_schemas_lock():
+                await self._refresh_schemas(database_names)
+        except Exception:
+            # The next refresh will try again
+            pass
+
+    async def _refresh_schemas(self, database_names=None):
         internal_db = self.get_internal_database()
         if not self.internal_db_created:
             await init_internal_db(internal_db)
@@ -718,6 +860,14 @@ class Datasette:
                 "select database_name, schema_version from catalog_databases"
             )
         }
+        if database_names is not None:
+            await self._refresh_database_schemas(
+                internal_db,
+                current_schema_versions,
+                [name for name in database_names if name in self.databases],
+            )
+            return
+        attached_databases = set(self.databases)
         catalog_table_names = (
             "catalog_columns",
             "catalog_foreign_keys",
@@ -748,12 +898,47 @@ class Datasette:
                         )
 
             await internal_db.execute_write_fn(delete_stale_database_catalog)
-        for database_name, db in self.databases.items():
-            schema_version = (await db.execute("PRAGMA schema_version")).first()[0]
-            # Compare schema versions to see if we should skip it
-            if schema_version == current_schema_versions.get(database_name):
-                continue
-            await populate_schema_tables(internal_db, db, schema_version)
+        await self._refresh_database_schemas(
+            internal_db, current_schema_versions, list(self.databases.keys())
+        )
+        self._schema_refreshed_databases = attached_databases
+
+    async def _refresh_database_schemas(
+        self, internal_db, current_schema_versions, database_names
+    ):
+        async def schema_version(database_name):
+            db = self.databases[database_name]
+            if not db.is_mutable and database_name in current_schema_versions:
+                # The schema of an immutable database cannot change
+                return current_schema_versions[database_name]
+            return (await db.execute("PRAGMA schema_version")).first()[0]
+
+        async def refresh(database_name, schema_version):
+            await populate_schema_tables(
+                internal_db,
+                self.databases[database_name],
+                schema_version,
+                # The catalog rows may have been deleted since they were
+                # last populated, e.g. by remove_database()
+                incremental=database_name in current_schema_versions,
+            )
+            db = self.databases[database_name]
+            if db._exact_counts_synced:
+                # Tables may have been created or dropped since the exact
+                # count triggers were last installed
+                await db.sync_exact_counts()
+
+        # Check every database at once, then refresh those that changed
+        schema_versions = await asyncio.gather(
+            *(schema_version(database_name) for database_name in database_names)
+        )
+        await asyncio.gather(
+            *(
+                refresh(database_name, version)
+                for database_name, version in zip(database_names, schema_versions)
+                if version != current_schema_versions.get(database_name)
+            )
+        )
 
     @property
     def urls(self):
@@ -826,6 +1011,15 @@ class Datasette:
         await self._save_queries_from_config()
         # Load column_types from config into internal DB
         await self._apply_column_types_config()
+        # Install triggers for tables configured with exact_counts, and
+        # remove them for tables that no longer are
+        for database in self.databases.values():
+            if database.is_mutable:
+                await database.sync_exact_counts()
+        # Create the tables for columns configured with array_indexes
+        for database in self.databases.values():
+            if database.is_mutable and database._configured_array_indexes():
+                await database.sync_array_indexes()
         for hook in pm.hook.startup(datasette=self):
             await await_me_maybe(hook)
         self._startup_invoked = True
@@ -896,6 +1090,27 @@ class Datasette:
             restrictions=restrictions,
         )
 
+    async def _actor_from_request(self, request):
+        # Returns (actor, token_error) from the actor_from_request hooks
+        actor = None
+        token_error = None
+        results = pm.hook.actor_from_request(datasette=self, request=request)
+        for result in results:
+            try:
+                result = await await_me_maybe(result)
+            except TokenInvalid as ex:
+                # A presented token was recognized but rejected - fail the
+                # request with a 401 even if another credential is valid,
+                # but keep awaiting the remaining coroutines first
+                if token_error is None:
+                    token_error = ex
+                continue
+            if result and actor is None:
+                actor = result
+                # Don't break — we must await all coroutines to avoid
+                # "coroutine was never awaited" warnings
+        return actor, token_error
+
     async def verify_token(self, token: str) -> dict | None:
         """
         Verify an API token by trying all registered token handlers.
@@ -947,15 +1162,18 @@ class Datasette:
 
     def remove_database(self, name):
         self.get_database(name).close()
+        if self.query_result_cache is not None:
+            self.query_result_cache.remove_database(name)
         new_databases = self.databases.copy()
         new_databases.pop(name)
         self.databases = new_databases
+        self._databases_removed += 1
 
     def close(self):
         """Release all resources held by this Datasette instance.
 
         Closes every attached Database (including the internal database),
-        shuts down the executor, and unlinks the temporary file used for
+        shuts down the SQL thread pools, and unlinks the temporary file used for
         the internal database if one was created. Idempotent and one-way.
         """
         if self._closed:
@@ -969,9 +1187,15 @@ class Datasette:
             except Exception as e:
                 if first_exception is None:
                     first_exception = e
-        if self.executor is not None:
+        if self._sql_process_pool is not None:
             try:
-                self.executor.shutdown(wait=True, cancel_futures=True)
+                self._sql_process_pool.shutdown(wait=True, cancel_futures=True)
+            except Exception as e:
+                if first_exception is None:
+                    first_exception = e
+        for sql_thread_pool in self._sql_thread_pools.values():
+            try:
+                sql_thread_pool.shutdown()
             except Exception as e:
                 if first_exception is None:
                     first_exception = e
@@ -981,6 +1205,65 @@ class Datasette:
     def setting(self, key):
         return self._settings.get(key, None)
 
+    def _configure_sql_thread_pools(self):
+        # Named pools can be shared by several databases:
+        #   sql_thread_pools: {"archives": {"num_sql_threads": 2}}
+        #   databases: {"archive_2020": {"sql_thread_pool": "archives"}}
+        # A database can also ask for a dedicated pool of its own:
+        #   databases: {"big": {"num_sql_threads": 4}}
+        for pool_name, pool_config in (
+            self.config.get("sql_thread_pools") or {}
+        ).items():
+            num_threads = (pool_config or {}).get("num_sql_threads")
+            if not isinstance(num_threads, int) or num_threads < 1:
+                raise StartupError(
+                    "sql_thread_pools.{}.num_sql_threads must be a positive integer".format(
+                        pool_name
+                    )
+                )
+            if pool_name == "default":
+                raise StartupError(
+                    'The "default" SQL thread pool is configured by num_sql_threads'
+                )
+            self._sql_thread_pools[pool_name] = SQLThreadPool(pool_name, num_threads)
+        for database_name, db_config in (self.config.get("databases") or {}).items():
+            db_config = db_config or {}
+            pool_name = db_config.get("sql_thread_pool")
+            num_threads = db_config.get("num_sql_threads")
+            if pool_name is not None and num_threads is not None:
+                raise StartupError(
+                    "Database {} cannot set both sql_thread_pool and num_sql_threads".format(
+                        database_name
+                    )
+                )
+            if num_threads is not None:
+                if not isinstance(num_threads, int) or num_threads < 1:
+                    raise StartupError(
+                        "databases.{}.num_sql_threads must be a positive integer".format(
+                            database_name
+                        )
+                    )
+                pool_name = "database:{}".format(database_name)
+                self._sql_thread_pools[pool_name] = SQLThreadPool(
+                    pool_name, num_threads
+                )
+            if pool_name is None:
+                continue
+            if pool_name not in self._sql_thread_pools:
+                raise StartupError(
+                    "Database {} uses unknown sql_thread_pool: {}".format(
+                        database_name, pool_name
+                    )
+                )
+            self._database_sql_thread_pools[database_name] = pool_name
+
+    def _sql_thread_pool_for_database(self, database_name):
+        if not self._sql_thread_pools:
+            # num_sql_threads is 0
+            return None
+        pool_name = self._database_sql_thread_pools.get(database_name, "default")
+        return self._sql_thread_pools[pool_name]
+
     def settings_dict(self):
         # Returns a fully resolved settings dictionary, useful for templates
         return {option.name: self.setting(option.name) for option in SETTINGS}
@@ -1540,7 +1823,7 @@ class Datasette:
 
     def _prepare_connection(self, conn, database):
         conn.row_factory = sqlite3.Row
-        conn.text_factory = lambda x: str(x, "utf-8", "replace")
+        conn.text_factory = decode_text_replacing_errors
         if self.sqlite_extensions and database != INTERNAL_DB_NAME:
             conn.enable_load_extension(True)
             for extension in self.sqlite_extensions:
@@ -2162,6 +2445,7 @@ class Datasette:
                 "is_mutable": d.is_mutable,
                 "is_memory": d.is_memory,
                 "hash": d.hash,
+                "hash_status": d.hash_status,
             }
             for name, d in self.databases.items()
         ]
@@ -2275,6 +2559,19 @@ class Datasette:
             for p in ps
         ]
 
+    def _evict_idle_read_connections(self):
+        # Called from executor threads - closes read connections that have
+        # been idle for too long, checking all databases at most once a second
+        if not self.setting("idle_connection_timeout"):
+            return
+        now = time.monotonic()
+        if now - self._last_read_connection_eviction < 1.0:
+            return
+        self._last_read_connection_eviction = now
+        for db in list(self.databases.values()) + [self._internal_database]:
+            if db._read_pool is not None:
+                db._read_pool.evict_idle()
+
     def _threads(self):
         if self.setting("num_sql_threads") == 0:
             return {"num_threads": 0, "threads": []}
@@ -2284,6 +2581,29 @@ class Datasette:
             "threads": [
                 {"name": t.name, "ident": t.ident, "daemon": t.daemon} for t in threads
             ],
+            "sql_thread_pools": {
+                name: pool.stats() for name, pool in self._sql_thread_pools.items()
+            },
+            "query_result_cache": (
+                self.query_result_cache.stats()
+                if self.query_result_cache is not None
+                else None
+            ),
+            "response_cache": (
+                self.response_cache.stats() if self.response_cache is not None else None
+            ),
+            "databases": {
+                name: {
+                    "sql_thread_pool": db.sql_thread_pool.name,
+                    "cancelled_queries": db.cancelled_queries,
+                    "deduplicated_queries": db.deduplicated_queries,
+                    "introspection_cache": db.introspection_cache_stats(),
+                    "read_connections": (
+                        db._read_pool.stats() if db._read_pool is not None else None
+                    ),
+                }
+                for name, db in self.databases.items()
+            },
         }
         tasks = asyncio.all_tasks()
         d.update(
@@ -2827,6 +3147,8 @@ class Datasette:
             # First time server starts up, calculate table counts for immutable databases
             for database in self.databases.values():
                 if not database.is_mutable:
+                    # Large files are hashed in a background thread
+                    database.start_hashing()
                     await database.table_counts(limit=60 * 60 * 1000)
 
         async def _close_on_shutdown():
@@ -2835,6 +3157,7 @@ class Datasette:
         asgi = CrossOriginProtectionMiddleware(DatasetteRouter(self, routes), self)
         if self.setting("trace_debug"):
             asgi = AsgiTracer(asgi)
+        asgi = AsgiResponseCache(asgi, self)
         asgi = AsgiLifespan(asgi, on_shutdown=[_close_on_shutdown])
         asgi = AsgiRunOnFirstRequest(asgi, on_startup=[setup_db, self.invoke_startup])
         for wrapper in pm.hook.asgi_wrapper(datasette=self):
@@ -2842,6 +3165,18 @@ class Datasette:
         return asgi
 
 
+def _nocache_requested(query_string):
+    if b"_nocache=" not in query_string:
+        return False
+    value = urllib.parse.parse_qs(query_string.decode("latin-1")).get("_nocache", [""])[
+        0
+    ]
+    try:
+        return value_as_boolean(value)
+    except ValueAsBooleanError:
+        return False
+
+
 class DatasetteRouter:
     def __init__(self, datasette, routes):
         self.ds = datasette
@@ -2860,11 +3195,69 @@ class DatasetteRouter:
         from datasette.permissions import _permission_check_cache
 
         cache_token = _permission_check_cache.set({})
+        # ?_nocache=1 bypasses the query result cache for this request
+        nocache_token = _query_result_cache_disabled.set(
+            _nocache_requested(scope.get("query_string", b""))
+        )
         try:
+            if scope["type"] == "http" and scope.get("method") in ("GET", "HEAD"):
+                return await self.route_path_until_disconnect(
+                    scope, receive, send, path
+                )
             return await self.route_path(scope, receive, send, path)
         finally:
+            _query_result_cache_disabled.reset(nocache_token)
             _permission_check_cache.reset(cache_token)
 
+    async def route_path_until_disconnect(self, scope, receive, send, path):
+        # Runs route_path() in a task that is cancelled if the client sends
+        # http.disconnect before the response is complete, which interrupts
+        # any SQL query the view is waiting on. GET and HEAD requests have no
+        # body to apply backpressure to, so incoming messages are read here
+        # and handed on to the view through a queue.
+        messages = asyncio.Queue()
+        response_complete = False
+        disconnected = False
+
+        async def queued_receive():
+            return await messages.get()
+
+        async def tracking_send(message):
+            nonlocal response_complete
+            if message["type"] == "http.response.body" and not message.get("more_body"):
+                response_complete = True
+            await send(message)
+
+        with trace_child_tasks():
+            route_task = asyncio.ensure_future(
+                self.route_path(scope, queued_receive, tracking_send, path)
+            )
+
+        async def watch_for_disconnect():
+            nonlocal disconnected
+            while True:
+                try:
+                    message = await receive()
+                except Exception:
+                    return
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    if not response_complete:
+                        disconnected = True
+                        route_task.cancel()
+                    return
+
+        watcher = asyncio.ensure_future(watch_for_disconnect())
+        try:
+            return await route_task
+        except asyncio.CancelledError:
+            if disconnected and route_task.cancelled():
+                # Nobody is left to send a response to
+                return
+            raise
+        finally:
+            watcher.cancel()
+
     async def route_path(self, scope, receive, send, path):
         # Strip off base_url if present before routing
         base_url = self.ds.setting("base_url")
@@ -2894,26 +3287,12 @@ class DatasetteRouter:
             scope_modifications["scheme"] = "https"
         # Handle authentication
         default_actor = scope.get("actor") or None
-        actor = None
-        token_error = None
-        results = pm.hook.actor_from_request(datasette=self.ds, request=request)
-        for result in results:
-            try:
-                result = await await_me_maybe(result)
-            except TokenInvalid as ex:
-                # A presented token was recognized but rejected - fail the
-                # request with a 401 even if another credential is valid,
-                # but keep awaiting the remaining coroutines first
-                if token_error is None:
-                    token_error = ex
-                continue
-            if result and actor is None:
-                actor = result
-                # Don't break — we must await all coroutines to avoid
-                # "coroutine was never awaited" warnings
+        actor, token_error = await self.ds._actor_from_request(request)
         if token_error is not None:
             return await self.handle_401(request, send, token_error)
         scope_modifications["actor"] = actor or default_actor
+        if scope_modifications["actor"] and "_datasette_response_cache" in scope:
+            scope["_datasette_response_cache"]["uncacheable"] = True
         scope = dict(scope, **scope_modifications)
 
         match, view = resolve_routes(self.routes, path)
@@ -21,7 +21,13 @@ from .app import (
     SQLITE_LIMIT_ATTACHED,
     pm,
 )
-from .inspect import inspect_tables
+from .facets import table_facet_configs
+from .inspect import INSPECT_TOP_K, inspect_invalid_utf8, inspect_table
+from .sql_processes import (
+    create_sql_process_pool,
+    inspect_invalid_utf8_in_worker,
+    inspect_table_in_worker,
+)
 from .utils import (
     LoadExtension,
     StartupError,
@@ -135,15 +141,65 @@ def cli():
 @cli.command()
 @click.argument("files", type=click.Path(exists=True), nargs=-1)
 @click.option("--inspect-file", default="-")
+@click.option(
+    "--column-stats",
+    is_flag=True,
+    help="Also record null counts, distinct counts, min, max and most common values for every column",
+)
+@click.option(
+    "--top-k",
+    type=int,
+    default=INSPECT_TOP_K,
+    show_default=True,
+    help="Number of most common values to record for each column with --column-stats",
+)
+@click.option(
+    "--check-utf8",
+    is_flag=True,
+    help="Also scan every table for TEXT values that are not valid UTF-8, for the fast_text_decoding setting",
+)
+@click.option(
+    "-c",
+    "--config",
+    type=click.File(mode="r"),
+    help="Path to JSON/YAML Datasette configuration file - facets configured for tables will be precomputed",
+)
+@click.option(
+    "--processes",
+    type=int,
+    help="Number of worker processes to use, defaults to the number of CPUs",
+)
 @sqlite_extensions
-def inspect(files, inspect_file, sqlite_extensions):
+def inspect(
+    files,
+    inspect_file,
+    column_stats,
+    top_k,
+    check_utf8,
+    config,
+    processes,
+    sqlite_extensions,
+):
     """
     Generate JSON summary of provided database files
 
     This can then be passed to "datasette --inspect-file" to speed up count
     operations against immutable database files.
     """
-    inspect_data = run_sync(lambda: inspect_(files, sqlite_extensions))
+    config_data = None
+    if config:
+        config_data = parse_metadata(config.read())
+    inspect_data = run_sync(
+        lambda: inspect_(
+            files,
+            sqlite_extensions,
+            column_stats=column_stats,
+            top_k=top_k,
+            check_utf8=check_utf8,
+            processes=processes,
+            config=config_data,
+        )
+    )
     if inspect_file == "-":
         sys.stdout.write(json.dumps(inspect_data, indent=2))
     else:
@@ -151,21 +207,90 @@ def inspect(files, inspect_file, sqlite_extensions):
             fp.write(json.dumps(inspect_data, indent=2))
 
 
-async def inspect_(files, sqlite_extensions):
-    app = Datasette([], immutables=files, sqlite_extensions=sqlite_extensions)
-    data = {}
-    for name, database in app.databases.items():
-        tables = await database.execute_fn(lambda conn: inspect_tables(conn, {}))
-        data[name] = {
-            "hash": database.hash,
+async def inspect_(
+    files,
+    sqlite_extensions,
+    column_stats=False,
+    top_k=INSPECT_TOP_K,
+    check_utf8=False,
+    processes=None,
+    config=None,
+):
+    app = Datasette(
+        [], immutables=files, sqlite_extensions=sqlite_extensions, config=config
+    )
+    if processes is None:
+        if hasattr(os, "sched_getaffinity"):
+            processes = len(os.sched_getaffinity(0))
+        else:
+            processes = os.cpu_count() or 1
+    # Tables in every file are inspected at the same time, each in one of
+    # a pool of worker processes
+    pool = None
+    if processes > 1:
+        pool = create_sql_process_pool(app, processes)
+    loop = asyncio.get_running_loop()
+
+    def run(database, fn, worker_fn, *args):
+        if pool is None:
+            return database.execute_fn(lambda conn: fn(conn, *args))
+        return loop.run_in_executor(
+            pool, worker_fn, database.name, os.path.abspath(database.path), *args
+        )
+
+    async def configured_facets(database, table):
+        # Column and date facets configured for this table, to precompute
+        table_config = await app.table_config(database.name, table)
+        return [
+            (type, facet_config.get("column") or facet_config["simple"])
+            for type, facet_config in table_facet_configs(table_config)
+            if type in ("column", "date")
+        ]
+
+    async def inspect_database(database):
+        table_names = await database.table_names()
+        facets = [await configured_facets(database, table) for table in table_names]
+        # Reads every row of every table, so this check is opt-in
+        check_invalid_utf8 = (
+            run(database, inspect_invalid_utf8, inspect_invalid_utf8_in_worker)
+            if check_utf8
+            else asyncio.sleep(0)
+        )
+        hash_value, invalid_utf8, *tables = await asyncio.gather(
+            database.wait_for_hash(),
+            check_invalid_utf8,
+            *(
+                run(
+                    database,
+                    inspect_table,
+                    inspect_table_in_worker,
+                    table,
+                    column_stats,
+                    top_k,
+                    table_facets,
+                )
+                for table, table_facets in zip(table_names, facets)
+            ),
+        )
+        data = {
+            "hash": hash_value,
             "size": database.size,
             "file": database.path,
-            "tables": {
-                table_name: {"count": table["count"]}
-                for table_name, table in tables.items()
-            },
+            "tables": dict(zip(table_names, tables)),
         }
-    return data
+        if check_utf8:
+            data["invalid_utf8"] = invalid_utf8
+        return data
+
+    try:
+        names = list(app.databases.keys())
+        results = await asyncio.gather(
+            *(inspect_database(app.databases[name]) for name in names)
+        )
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return dict(zip(names, results))
 
 
 @cli.group()
@@ -1,16 +1,27 @@
 import asyncio
 import atexit
+import collections
+import contextvars
+import datetime
 from collections import namedtuple
+from concurrent import futures
 import inspect
 import os
+import re
 from pathlib import Path
 import queue
 import sqlite_utils
 import sys
 import tempfile
 import threading
+import time
 import uuid
 
+from .sql_processes import (
+    execute_in_worker,
+    prepare_connection_needs_datasette,
+    rows_from_tuples,
+)
 from .tracer import trace
 from .utils import (
     call_with_supported_arguments,
@@ -21,19 +32,46 @@ from .utils import (
     get_all_foreign_keys,
     get_outbound_foreign_keys,
     md5_not_usedforsecurity,
+    sqlite_interrupt,
+    sqlite_interrupt_reset,
     sqlite_timelimit,
     sqlite3,
+    _start_background_task,
+    _task_is_running,
     table_columns,
     table_column_details,
 )
 from .utils.sql_analysis import SQLAnalysis, analyze_sql_tables
-from .utils.sqlite import sqlite_hidden_table_names
-from .inspect import inspect_hash
-
-connections = threading.local()
+from .utils.sqlite import (
+    decode_text_replacing_errors,
+    is_text_decode_error,
+    sqlite_hidden_table_names,
+)
+from .inspect import (
+    inspect_fingerprint,
+    inspect_hash,
+    inspect_hash_with_sidecar,
+    read_hash_sidecar,
+)
 
 EXECUTE_WRITE_RETURNING_LIMIT = 10
 
+# SQLite functions that can return a different result each time they are
+# called, see https://www.sqlite.org/deterministic.html - 'now', or no
+# arguments at all, makes the date and time functions use the current time
+_nondeterministic_sql_re = re.compile(
+    r"\b(random|randomblob|changes|total_changes|last_insert_rowid"
+    r"|current_time|current_date|current_timestamp)\b"
+    r"|['\"]now['\"]"
+    r"|\b(date|time|datetime|julianday|unixepoch)\s*\(\s*\)",
+    re.IGNORECASE,
+)
+
+# Set for requests with ?_nocache=1, so they skip the QueryResultCache
+_query_result_cache_disabled = contextvars.ContextVar(
+    "query_result_cache_disabled", default=False
+)
+
 AttachedDatabase = namedtuple("AttachedDatabase", ("seq", "name", "file"))
 
 
@@ -42,12 +80,14 @@ class DatasetteClosedError(RuntimeError):
 
 
 _SHUTDOWN = object()
+_CACHE_HIT = object()
 
 
 class Database:
     # For table counts stop at this many rows:
     count_limit = 10000
-    _thread_local_id_counter = 1
+    # Immutable files larger than this are hashed in a background thread
+    hash_in_place_max_bytes = 32 * 1024 * 1024
 
     def __init__(
         self,
@@ -60,8 +100,6 @@ class Database:
         is_temp_disk=False,
     ):
         self.name = None
-        self._thread_local_id = f"x{self._thread_local_id_counter}"
-        Database._thread_local_id_counter += 1
         self.route = None
         self.ds = ds
         self.path = path
@@ -83,12 +121,54 @@ class Database:
             self._wal_enabled = False
         self.cached_hash = None
         self.cached_size = None
+        # See start_hashing()
+        self._hash_lock = threading.Lock()
+        self._hash_ready = threading.Event()
+        self._hash_thread = None
+        self._hashed_in_background = False
+        self.hash_error = None
+        self._cached_fingerprint = None
         self._cached_table_counts = None
+        # Cached counts for mutable databases, see table_counts()
+        self._mutable_table_counts = None
+        self._table_counts_refresh_task = None
+        # (data_generation(), estimates) from sqlite_stat1
+        self._table_count_estimates = None
+        # Incremented after each write made through this Database commits
+        self._completed_writes = 0
+        # See data_generation()
+        self._data_version_conn = None
+        self._data_version_lock = threading.Lock()
+        self._data_version_state = None
+        self._data_generation = 0
+        # Tables with triggers maintaining their count in _datasette_counts
+        self.exact_count_tables = set()
+        self._exact_counts_synced = False
+        self._invalid_utf8 = None
+        # Results of schema introspection methods, valid for the schema
+        # version recorded in _introspection_schema_version
+        self._introspection_cache = {}
+        self._introspection_schema_version = None
+        # What populate_schema_tables() last recorded in the catalog tables
+        self._catalog_signatures = None
+        # Samples used to suggest facets, see Facet.get_sample()
+        self._facet_samples = collections.OrderedDict()
+        self.introspection_cache_hits = 0
+        self.introspection_cache_misses = 0
+        self.introspection_cache_invalidations = 0
         self._write_thread = None
         self._write_queue = None
         self._closed = False
         self._pending_execute_futures = set()
         self._pending_execute_futures_lock = threading.Lock()
+        # Number of execute_fn() calls interrupted because the awaiting
+        # task was cancelled
+        self.cancelled_queries = 0
+        # execute() calls that joined an identical query already running
+        self._queries_in_flight = {}
+        self.deduplicated_queries = 0
+        # Read connections used by the executor threads, created on demand
+        self._read_pool = None
         # These are used when in non-threaded mode:
         self._read_connection = None
         self._write_connection = None
@@ -119,9 +199,64 @@ class Database:
             }
         return self._cached_table_counts
 
+    def column_stats(self, table):
+        """Statistics for each column of a table, as recorded by
+        ``datasette inspect --column-stats`` - or None if there are none.
+        Only used for immutable databases."""
+        if self.is_mutable or not self.ds.inspect_data:
+            return None
+        database_data = self.ds.inspect_data.get(self.name) or {}
+        table_data = database_data.get("tables", {}).get(table) or {}
+        return table_data.get("column_stats")
+
+    def precomputed_facets(self, table):
+        """Facet results for a whole table, as recorded by ``datasette
+        inspect --config`` - or None if there are none. Only used for
+        immutable databases."""
+        if self.is_mutable or not self.ds.inspect_data:
+            return None
+        database_data = self.ds.inspect_data.get(self.name) or {}
+        table_data = database_data.get("tables", {}).get(table) or {}
+        return table_data.get("facets")
+
+    @property
+    def invalid_utf8(self):
+        """True if this database is known to contain TEXT values that are not
+        valid UTF-8, False if it is known not to, None if unknown"""
+        if self._invalid_utf8 is not None:
+            return self._invalid_utf8
+        if self.ds.inspect_data and self.ds.inspect_data.get(self.name):
+            return self.ds.inspect_data[self.name].get("invalid_utf8")
+        return None
+
+    @invalid_utf8.setter
+    def invalid_utf8(self, value):
+        self._invalid_utf8 = value
+
+    def _use_native_text_decoding(self):
+        return bool(self.ds.setting("fast_text_decoding")) and not self.invalid_utf8
+
+    def _run_with_text_decoding_fallback(self, conn, fn):
+        # With fast_text_decoding read connections use the native str
+        # text_factory, which raises on invalid UTF-8. The first time that
+        # happens the database is flagged and switched to the lossy decoder
+        # for all of its read connections. Only execute() runs its query
+        # again - arbitrary functions are not safe to repeat.
+        if conn.text_factory is str and not self._use_native_text_decoding():
+            conn.text_factory = decode_text_replacing_errors
+        try:
+            return fn(conn)
+        except sqlite3.OperationalError as e:
+            if conn.text_factory is str and is_text_decode_error(e):
+                self.invalid_utf8 = True
+                conn.text_factory = decode_text_replacing_errors
+            raise
+
     @property
     def color(self):
-        if self.hash:
+        # Files hashed in the background always use their name, so their
+        # colour does not change once the hash is ready
+        if self.hash and not self._hashed_in_background:
             return self.hash[:6]
         return md5_not_usedforsecurity(self.name)[:6]
 
@@ -146,17 +281,13 @@ class Database:
             )
             if not write:
                 conn.execute("PRAGMA query_only=1")
+            elif self._triggers_configured():
+                conn.execute("PRAGMA recursive_triggers=on")
             return conn
         if self.is_memory:
-            return sqlite3.connect(":memory:", uri=True)
+            return sqlite3.connect(":memory:", uri=True, check_same_thread=False)
 
-        # mode=ro or immutable=1?
-        if self.is_mutable:
-            qs = "?mode=ro"
-            if self.ds.nolock:
-                qs += "&nolock=1"
-        else:
-            qs = "?immutable=1"
+        qs = self._read_only_query_string()
         assert not (write and not self.is_mutable)
         if write:
             qs = ""
@@ -169,8 +300,23 @@ class Database:
         if self.is_temp_disk and not self._wal_enabled:
             conn.execute("PRAGMA journal_mode=WAL")
             self._wal_enabled = True
+        if write and self._triggers_configured():
+            # Rows deleted by INSERT OR REPLACE only fire delete triggers,
+            # which keep _datasette_counts and the array index tables up
+            # to date, if this is on
+            conn.execute("PRAGMA recursive_triggers=on")
         return conn
 
+    def _read_only_query_string(self):
+        # mode=ro or immutable=1?
+        if self.is_mutable:
+            qs = "?mode=ro"
+            if self.ds.nolock:
+                qs += "&nolock=1"
+        else:
+            qs = "?immutable=1"
+        return qs
+
     def close(self):
         """Release all resources held by this database.
 
@@ -210,11 +356,10 @@ class Database:
             except Exception:
                 pass
         self._all_file_connections = []
-        # Drop per-thread cached read connections we can reach
-        try:
-            delattr(connections, self._thread_local_id)
-        except AttributeError:
-            pass
+        with self._data_version_lock:
+            self._data_version_conn = None
+        if self._read_pool is not None:
+            self._read_pool.close()
         # Close non-threaded-mode cached connections if still open
         if self._read_connection is not None:
             try:
@@ -324,9 +469,7 @@ class Database:
         if not write:
             # Immutable database - no writes can ever occur, so there is no
             # write queue to block; run against a fresh read-only connection
-            return await asyncio.get_running_loop().run_in_executor(
-                self.ds.executor, _run
-            )
+            return await asyncio.wrap_future(self.sql_thread_pool.submit(_run))
         # Threaded mode - send to write thread
         return await self._send_to_write_thread(fn, isolated_connection=True)
 
@@ -344,7 +487,25 @@ class Database:
         def track_event(event):
             pending_events.append(event)
 
-        fn = self._wrap_fn_with_hooks(fn, request, transaction, track_event)
+        wrapped_fn = self._wrap_fn_with_hooks(fn, request, transaction, track_event)
+        # PRAGMA schema_version before and after the write
+        schema_versions = []
+
+        def record_schema_version(conn):
+            try:
+                schema_versions.append(
+                    conn.execute("PRAGMA schema_version").fetchone()[0]
+                )
+            except sqlite3.Error:
+                pass
+
+        def fn(conn):
+            record_schema_version(conn)
+            try:
+                return wrapped_fn(conn)
+            finally:
+                record_schema_version(conn)
+
         if self.ds.executor is None:
             # non-threaded mode
             if self._write_connection is None:
@@ -361,6 +522,8 @@ class Database:
                 fn, block=block, transaction=transaction
             )
         if block:
+            self._completed_writes += 1
+            self._check_written_schema_version(schema_versions)
             for event in pending_events:
                 await self.ds.track_event(event)
         else:
@@ -374,6 +537,8 @@ class Database:
                 except Exception:
                     # if the write failed, don't emit success events
                     return
+                self._completed_writes += 1
+                self._check_written_schema_version(schema_versions)
                 for event in pending_events:
                     await self.ds.track_event(event)
 
@@ -381,6 +546,12 @@ class Database:
             result = task_id
         return result
 
+    def _check_written_schema_version(self, schema_versions):
+        # A write that changed the schema schedules a background refresh of
+        # the catalog tables for this database
+        if len(schema_versions) == 2 and schema_versions[0] != schema_versions[1]:
+            self.ds._schedule_schema_refresh(self.name)
+
     def _wrap_fn_with_hooks(self, fn, request, transaction, track_event):
         from .plugins import pm
 
@@ -449,8 +620,23 @@ class Database:
             self.ds._prepare_connection(conn, self.name)
         except Exception as e:
             conn_exception = e
+        batch_size = self.ds.setting("write_batch_size") or 1
+        batch_wait = (self.ds.setting("write_batch_wait_ms") or 0) / 1000
+        # A task taken from the queue while collecting a batch that could
+        # not be added to it, to be executed next
+        next_task = None
         while True:
-            task = self._write_queue.get()
+            if next_task is not None:
+                task, next_task = next_task, None
+            else:
+                task = self._write_queue.get()
+            if batch_size > 1 and conn_exception is None and _can_group_commit(task):
+                batch, next_task = self._collect_write_batch(
+                    task, batch_size, batch_wait
+                )
+                if len(batch) > 1:
+                    self._execute_write_batch(conn, batch)
+                    continue
             if task is _SHUTDOWN:
                 if conn is not None:
                     try:
@@ -492,6 +678,88 @@ class Database:
                     exception = e
             _deliver_write_result(task, result, exception)
 
+    def _collect_write_batch(self, task, batch_size, batch_wait):
+        # Returns (batch, next_task) - waits up to batch_wait seconds for
+        # further queued tasks that can share a transaction with task
+        batch = [task]
+        deadline = time.monotonic() + batch_wait
+        while len(batch) < batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    next_task = self._write_queue.get(timeout=timeout)
+                else:
+                    next_task = self._write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if not _can_group_commit(next_task):
+                return batch, next_task
+            batch.append(next_task)
+        return batch, None
+
+    def _execute_write_batch(self, conn, batch):
+        # Group commit: run each task inside its own SAVEPOINT within a
+        # single transaction, then COMMIT once for the whole batch. A task
+        # that raises is rolled back to its savepoint without affecting the
+        # other tasks in the batch.
+        outcomes = []
+        # Indexes into outcomes for tasks that succeeded but are not yet committed
+        uncommitted = []
+
+        def fail_uncommitted(exception):
+            for i in uncommitted:
+                outcomes[i] = (None, exception)
+            uncommitted.clear()
+
+        for task in batch:
+            try:
+                if not conn.in_transaction:
+                    conn.execute("BEGIN IMMEDIATE")
+                conn.execute("SAVEPOINT datasette_group_commit")
+            except Exception as e:
+                sys.stderr.write("{}\n".format(e))
+                sys.stderr.flush()
+                outcomes.append((None, e))
+                continue
+            try:
+                result = task.fn(conn)
+            except Exception as e:
+                sys.stderr.write("{}\n".format(e))
+                sys.stderr.flush()
+                outcomes.append((None, e))
+                if conn.in_transaction:
+                    try:
+                        conn.execute("ROLLBACK TO SAVEPOINT datasette_group_commit")
+                        conn.execute("RELEASE SAVEPOINT datasette_group_commit")
+                    except Exception as rollback_exception:
+                        # Roll back everything so the batch fails as a whole
+                        conn.rollback()
+                        fail_uncommitted(rollback_exception)
+                else:
+                    # SQLite rolled back the whole transaction
+                    fail_uncommitted(e)
+                continue
+            outcomes.append((result, None))
+            if conn.in_transaction:
+                conn.execute("RELEASE SAVEPOINT datasette_group_commit")
+                uncommitted.append(len(outcomes) - 1)
+            else:
+                # The task committed the transaction itself
+                uncommitted.clear()
+        if conn.in_transaction:
+            try:
+                conn.commit()
+            except Exception as e:
+                sys.stderr.write("{}\n".format(e))
+                sys.stderr.flush()
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                fail_uncommitted(e)
+        for task, (result, exception) in zip(batch, outcomes):
+            _deliver_write_result(task, result, exception)
+
     async def execute_fn(self, fn):
         self._check_not_closed()
         if self.ds.executor is None:
@@ -499,23 +767,79 @@ class Database:
             if self._read_connection is None:
                 self._read_connection = self.connect()
                 self.ds._prepare_connection(self._read_connection, self.name)
-            return fn(self._read_connection)
+                if self._use_native_text_decoding():
+                    self._read_connection.text_factory = str
+            return self._run_with_text_decoding_fallback(self._read_connection, fn)
 
         # threaded mode
+        read_pool = self.read_pool
+        cancellation = _QueryCancellation()
+
         def in_thread():
-            conn = getattr(connections, self._thread_local_id, None)
-            if not conn:
-                conn = self.connect()
-                self.ds._prepare_connection(conn, self.name)
-                setattr(connections, self._thread_local_id, conn)
-            return fn(conn)
+            self.ds._evict_idle_read_connections()
+            conn = read_pool.acquire()
+            try:
+                cancellation.start(conn)
+                try:
+                    return self._run_with_text_decoding_fallback(conn, fn)
+                finally:
+                    cancellation.finish()
+            finally:
+                read_pool.release(conn)
 
         with self._pending_execute_futures_lock:
             self._check_not_closed()
-            future = self.ds.executor.submit(in_thread)
+            future = self.sql_thread_pool.submit(in_thread)
             self._pending_execute_futures.add(future)
         future.add_done_callback(self._remove_pending_execute_future)
-        return await asyncio.wrap_future(future)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # The awaiting task was cancelled, for example because the client
+            # disconnected - interrupt the query so the thread is freed now
+            # rather than when sqlite_timelimit() fires
+            if cancellation.cancel():
+                self.cancelled_queries += 1
+            raise
+
+    @property
+    def sql_thread_pool(self):
+        "The SQLThreadPool used to execute read queries against this database"
+        return self.ds._sql_thread_pool_for_database(self.name)
+
+    @property
+    def read_pool(self):
+        if self._read_pool is None:
+            self._read_pool = ReadConnectionPool(
+                self._connect_for_read_pool,
+                max_size=self.ds.setting("max_read_connections")
+                or self.sql_thread_pool.num_threads,
+                idle_timeout=self.ds.setting("idle_connection_timeout"),
+                close_connection=self._close_pooled_connection,
+            )
+        return self._read_pool
+
+    def _connect_for_read_pool(self):
+        conn = self.connect()
+        try:
+            self.ds._prepare_connection(conn, self.name)
+        except Exception:
+            self._close_pooled_connection(conn)
+            raise
+        if self._use_native_text_decoding():
+            conn.text_factory = str
+        return conn
+
+    def _close_pooled_connection(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        try:
+            self._all_file_connections.remove(conn)
+        except ValueError:
+            # Memory connection, or already closed by close()
+            pass
 
     async def execute(
         self,
@@ -525,30 +849,63 @@ class Database:
         custom_time_limit=None,
         page_size=None,
         log_sql_errors=True,
+        use_cache=True,
     ):
         """Executes sql against db_name in a thread"""
         self._check_not_closed()
         page_size = page_size or self.ds.page_size
+        cache_key = None
+        result_cache = self.ds.query_result_cache
+        if (
+            use_cache
+            and result_cache is not None
+            and not self.is_memory
+            and not _query_result_cache_disabled.get()
+            and not _nondeterministic_sql_re.search(sql)
+        ):
+            cache_key = await self._result_cache_key(sql, params, truncate, page_size)
+            if cache_key is not None:
+                results = result_cache.get(cache_key)
+                if results is not None:
+                    return results
+
+        def fetch_rows(conn):
+            cursor = conn.cursor()
+            cursor.execute(sql, params if params is not None else {})
+            max_returned_rows = self.ds.max_returned_rows
+            if max_returned_rows == page_size:
+                max_returned_rows += 1
+            if max_returned_rows and truncate:
+                rows = cursor.fetchmany(max_returned_rows + 1)
+                truncated = len(rows) > max_returned_rows
+                rows = rows[:max_returned_rows]
+            else:
+                rows = cursor.fetchall()
+                truncated = False
+            # Reset the statement before leaving the time limit, so an
+            # interrupt arriving now cannot affect the next query
+            cursor.close()
+            return cursor, rows, truncated
 
         def sql_operation_in_thread(conn):
+            total_changes = conn.total_changes
             time_limit_ms = self.ds.sql_time_limit_ms
             if custom_time_limit and custom_time_limit < time_limit_ms:
                 time_limit_ms = custom_time_limit
 
             with sqlite_timelimit(conn, time_limit_ms):
                 try:
-                    cursor = conn.cursor()
-                    cursor.execute(sql, params if params is not None else {})
-                    max_returned_rows = self.ds.max_returned_rows
-                    if max_returned_rows == page_size:
-                        max_returned_rows += 1
-                    if max_returned_rows and truncate:
-                        rows = cursor.fetchmany(max_returned_rows + 1)
-                        truncated = len(rows) > max_returned_rows
-                        rows = rows[:max_returned_rows]
-                    else:
-                        rows = cursor.fetchall()
-                        truncated = False
+                    try:
+                        cursor, rows, truncated = fetch_rows(conn)
+                    except sqlite3.OperationalError as e:
+                        if not (is_text_decode_error(e) and conn.text_factory is str):
+                            raise
+                        self.invalid_utf8 = True
+                        conn.text_factory = decode_text_replacing_errors
+                        if conn.total_changes != total_changes:
+                            # Never repeat a statement that wrote something
+                            raise
+                        cursor, rows, truncated = fetch_rows(conn)
                 except (sqlite3.OperationalError, sqlite3.DatabaseError) as e:
                     if e.args == ("interrupted",):
                         raise QueryInterrupted(e, sql, params)
@@ -567,23 +924,346 @@ class Database:
             else:
                 return Results(rows, False, cursor.description)
 
+        async def run():
+            if self._sql_process_pool() is not None:
+                results = await self._execute_in_process(
+                    sql,
+                    params,
+                    truncate=truncate,
+                    custom_time_limit=custom_time_limit,
+                    page_size=page_size,
+                    log_sql_errors=log_sql_errors,
+                )
+            else:
+                results = await self.execute_fn(sql_operation_in_thread)
+            if cache_key is not None:
+                result_cache.put(cache_key, results)
+            return results
+
+        flight_key = self._single_flight_key(
+            sql, params, truncate, custom_time_limit, page_size, log_sql_errors
+        )
+        # Traced outside the shared flight, so every caller that joins a
+        # query is shown it in its own trace
         with trace("sql", database=self.name, sql=sql.strip(), params=params):
-            results = await self.execute_fn(sql_operation_in_thread)
-        return results
+            if flight_key is None:
+                return await run()
+            return await self._single_flight(flight_key, run)
+
+    def _single_flight_key(
+        self, sql, params, truncate, custom_time_limit, page_size, log_sql_errors
+    ):
+        if self.ds.executor is None:
+            # Queries run one at a time in non-threaded mode anyway
+            return None
+        # A query started before a write made through Datasette has
+        # completed must not be shared with callers that expect to see that
+        # write. Writes from other processes are not ordered with respect
+        # to Datasette's callers, so there is no need to check for them
+        # with a PRAGMA data_version on the event loop.
+        key = (
+            asyncio.get_running_loop(),
+            self._completed_writes,
+            sql,
+            _params_key(params),
+            bool(truncate),
+            custom_time_limit,
+            page_size,
+            log_sql_errors,
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    async def _single_flight(self, key, fn):
+        # Identical queries that are already running are joined rather than
+        # run again. The query runs in its own task so that one caller being
+        # cancelled does not affect the others - it is only cancelled, which
+        # interrupts the SQL, once every caller waiting on it has gone.
+        flight = self._queries_in_flight.get(key)
+        if flight is None:
+            flight = _QueryFlight(asyncio.ensure_future(fn()))
+            self._queries_in_flight[key] = flight
+
+            def done(task):
+                if self._queries_in_flight.get(key) is flight:
+                    del self._queries_in_flight[key]
+
+            flight.task.add_done_callback(done)
+        else:
+            self.deduplicated_queries += 1
+        flight.waiters += 1
+        try:
+            results = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                if self._queries_in_flight.get(key) is flight:
+                    del self._queries_in_flight[key]
+                flight.task.cancel()
+            raise
+        flight.waiters -= 1
+        # Each caller gets its own list of rows, which it may modify
+        return Results(list(results.rows), results.truncated, results.description)
+
+    async def _result_cache_key(self, sql, params, truncate, page_size):
+        if self.is_mutable:
+            # Checked before the query runs, so a write committed while it
+            # runs can only make the cached results newer than their tag
+            version = await self._data_generation_off_loop()
+            if version is None:
+                return None
+        # Immutable databases cannot change while Datasette is running, but
+        # the file could be replaced between a remove_database() and
+        # add_database() - so the key includes its hash, if known, or else
+        # its size and modification time
+        elif self.cached_hash is not None:
+            version = self.cached_hash
+        else:
+            version = (self.path, self.size, self.mtime_ns)
+        key = (self.name, version, sql, _params_key(params), bool(truncate), page_size)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    async def execute_stream(
+        self, sql, params=None, batch_size=1000, custom_time_limit=None
+    ):
+        """Executes sql and yields the rows in lists of up to batch_size rows.
+
+        All batches are read from a single cursor on a dedicated read-only
+        connection, which is closed once the generator is exhausted or
+        closed. A batch is only fetched when the consumer asks for it, and
+        each fetch is subject to the time limit.
+        """
+        self._check_not_closed()
+        if batch_size < 1:
+            raise ValueError("batch_size must be >= 1")
+        time_limit_ms = self.ds.sql_time_limit_ms
+        if custom_time_limit and custom_time_limit < time_limit_ms:
+            time_limit_ms = custom_time_limit
+        # The connection and cursor, once open_cursor() has run
+        stream = {}
+
+        def open_cursor():
+            conn = self._connect_for_read_pool()
+            stream["conn"] = conn
+            if self.invalid_utf8 is not False:
+                # Rows that have already been yielded cannot be decoded again,
+                # so only use the native decoder if the database is known to
+                # be valid UTF-8
+                conn.text_factory = decode_text_replacing_errors
+            with sqlite_timelimit(conn, time_limit_ms):
+                stream["cursor"] = conn.execute(
+                    sql, params if params is not None else {}
+                )
+                return stream["cursor"].fetchmany(batch_size)
+
+        def fetch_batch():
+            with sqlite_timelimit(stream["conn"], time_limit_ms):
+                return stream["cursor"].fetchmany(batch_size)
+
+        def close_stream(future=None):
+            if "cursor" in stream:
+                try:
+                    stream["cursor"].close()
+                except sqlite3.Error:
+                    pass
+            if "conn" in stream:
+                self._close_pooled_connection(stream["conn"])
+            stream.clear()
+
+        async def run(fn):
+            if self.ds.executor is None:
+                # non-threaded mode
+                return fn()
+            with self._pending_execute_futures_lock:
+                self._check_not_closed()
+                future = self.sql_thread_pool.submit(fn)
+                self._pending_execute_futures.add(future)
+            future.add_done_callback(self._remove_pending_execute_future)
+            stream["future"] = future
+            result = await asyncio.wrap_future(future)
+            del stream["future"]
+            return result
+
+        with trace("sql", database=self.name, sql=sql.strip(), params=params):
+            try:
+                rows = await run(open_cursor)
+                while rows:
+                    yield rows
+                    if len(rows) < batch_size:
+                        break
+                    rows = await run(fetch_batch)
+            except (sqlite3.OperationalError, sqlite3.DatabaseError) as e:
+                if e.args == ("interrupted",):
+                    raise QueryInterrupted(e, sql, params)
+                raise
+            finally:
+                future = stream.pop("future", None)
+                if future is not None and not future.done():
+                    # Cancelled while a batch was being fetched - interrupt
+                    # it and close the connection once the thread is done
+                    if "conn" in stream:
+                        stream["conn"].interrupt()
+                    future.add_done_callback(close_stream)
+                else:
+                    close_stream()
+
+    def _sql_process_pool(self):
+        # Only file-backed databases can be opened by the worker processes
+        if (
+            self.ds._sql_process_pool is None
+            or self.ds.executor is None
+            or self.path is None
+            or self.is_memory
+            or self.is_temp_disk
+            or self.mode is not None
+            or prepare_connection_needs_datasette()
+        ):
+            return None
+        return self.ds._sql_process_pool
+
+    async def _execute_in_process(
+        self, sql, params, truncate, custom_time_limit, page_size, log_sql_errors
+    ):
+        time_limit_ms = self.ds.sql_time_limit_ms
+        if custom_time_limit and custom_time_limit < time_limit_ms:
+            time_limit_ms = custom_time_limit
+        max_returned_rows = self.ds.max_returned_rows
+        if max_returned_rows == page_size:
+            max_returned_rows += 1
+        fetch_limit = None
+        if max_returned_rows and truncate:
+            fetch_limit = max_returned_rows + 1
+        if params is not None:
+            params = dict(params) if hasattr(params, "keys") else list(params)
+        with self._pending_execute_futures_lock:
+            self._check_not_closed()
+            future = self._sql_process_pool().submit(
+                execute_in_worker,
+                self.name,
+                self.path,
+                self._read_only_query_string(),
+                sql,
+                params,
+                time_limit_ms,
+                fetch_limit,
+                self.ds._databases_removed,
+            )
+            self._pending_execute_futures.add(future)
+        future.add_done_callback(self._remove_pending_execute_future)
+        try:
+            columns, rows = await asyncio.wrap_future(future)
+        except (sqlite3.OperationalError, sqlite3.DatabaseError) as e:
+            if e.args == ("interrupted",):
+                raise QueryInterrupted(e, sql, params)
+            if log_sql_errors:
+                sys.stderr.write(
+                    "ERROR: database={}, sql = {}, params = {}: {}\n".format(
+                        self.name, repr(sql), params, e
+                    )
+                )
+                sys.stderr.flush()
+            raise
+        truncated = False
+        if fetch_limit:
+            truncated = len(rows) > max_returned_rows
+            rows = rows[:max_returned_rows]
+        # Building a sqlite3.Row for every row is too slow for the event loop
+        rows, description = await asyncio.get_running_loop().run_in_executor(
+            None, rows_from_tuples, columns, rows
+        )
+        return Results(rows, truncated, description)
 
     @property
     def hash(self):
+        """SHA-256 of an immutable database file, or None while it is being
+        calculated in the background - see hash_status."""
+        if self.cached_hash is None:
+            self.start_hashing()
+        return self.cached_hash
+
+    @property
+    def hash_status(self):
         if self.cached_hash is not None:
-            return self.cached_hash
+            return "ready"
         elif self.is_mutable or self.is_memory or self.is_temp_disk:
             return None
-        elif self.ds.inspect_data and self.ds.inspect_data.get(self.name):
-            self.cached_hash = self.ds.inspect_data[self.name]["hash"]
-            return self.cached_hash
-        else:
-            p = Path(self.path)
-            self.cached_hash = inspect_hash(p)
-            return self.cached_hash
+        elif self.hash_error is not None:
+            return "error"
+        elif self._hash_thread is not None:
+            return "calculating"
+        return "pending"
+
+    def start_hashing(self):
+        """Make db.hash available, calculating it in a background thread for
+        large files.
+
+        Uses the hash from inspect data, or from a valid sidecar file written
+        by an earlier run if the hash_sidecar_files setting is on. Files no
+        larger than hash_in_place_max_bytes are hashed straight away.
+        """
+        if self.is_mutable or self.is_memory or self.is_temp_disk:
+            return
+        with self._hash_lock:
+            if self.cached_hash is not None or self._hash_thread is not None:
+                return
+            inspect_data = (self.ds.inspect_data or {}).get(self.name) or {}
+            if inspect_data.get("hash"):
+                self.cached_hash = inspect_data["hash"]
+            elif self.size <= self.hash_in_place_max_bytes:
+                self.cached_hash = inspect_hash(Path(self.path))
+            else:
+                self._hashed_in_background = True
+                if self.ds.setting("hash_sidecar_files"):
+                    self.cached_hash = read_hash_sidecar(self.path)
+            if self.cached_hash is not None:
+                self._hash_ready.set()
+                return
+            self._hash_thread = threading.Thread(
+                target=self._calculate_hash,
+                name="datasette-hash-{}".format(self.name),
+                daemon=True,
+            )
+            self._hash_thread.start()
+
+    def _calculate_hash(self):
+        try:
+            if self.ds.setting("hash_sidecar_files"):
+                self.cached_hash = inspect_hash_with_sidecar(self.path)
+            else:
+                self.cached_hash = inspect_hash(Path(self.path))
+        except OSError as ex:
+            self.hash_error = str(ex)
+        finally:
+            self._hash_ready.set()
+
+    async def wait_for_hash(self):
+        "Returns db.hash, waiting for a background calculation to finish"
+        self.start_hashing()
+        if self.cached_hash is None and self._hash_thread is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._hash_ready.wait
+            )
+        return self.cached_hash
+
+    @property
+    def fingerprint(self):
+        """A cheap identifier for the contents of a database file, based on
+        its size, modification time and a sample of its pages."""
+        if self.is_memory or self.path is None:
+            return None
+        if self._cached_fingerprint is not None:
+            return self._cached_fingerprint
+        fingerprint = inspect_fingerprint(self.path)
+        if not self.is_mutable:
+            self._cached_fingerprint = fingerprint
+        return fingerprint
 
     @property
     def size(self):
@@ -593,35 +1273,344 @@ class Database:
             return 0
         elif self.is_mutable:
             return Path(self.path).stat().st_size
-        elif self.ds.inspect_data and self.ds.inspect_data.get(self.name):
-            self.cached_size = self.ds.inspect_data[self.name]["size"]
-            return self.cached_size
+        inspect_data = (self.ds.inspect_data or {}).get(self.name) or {}
+        if inspect_data.get("size") is not None:
+            self.cached_size = inspect_data["size"]
         else:
             self.cached_size = Path(self.path).stat().st_size
-            return self.cached_size
+        return self.cached_size
+
+    async def table_counts(self, limit=10, allow_stale=False):
+        """Row counts for every table, capped at count_limit + 1.
 
-    async def table_counts(self, limit=10):
+        Counts that take longer than limit ms are returned as None. For
+        mutable databases the counts are cached until the database file
+        changes. With allow_stale=True the previously cached counts are
+        returned straight away if the file has changed, while fresh counts
+        are calculated in the background - table_counts_stale_as_of then
+        reports when those stale counts were taken.
+        """
         if not self.is_mutable and self.cached_table_counts is not None:
             return self.cached_table_counts
-        # Try to get counts for each table, $limit timeout for each count
-        counts = {}
-        for table in await self.table_names():
-            try:
-                table_count = (
-                    await self.execute(
-                        f"select count(*) from (select * from {escape_sqlite(table)} limit {self.count_limit + 1})",
-                        custom_time_limit=limit,
-                    )
-                ).rows[0][0]
-                counts[table] = table_count
-            # In some cases I saw "SQL Logic Error" here in addition to
-            # QueryInterrupted - so we catch that too:
-            except (QueryInterrupted, sqlite3.OperationalError, sqlite3.DatabaseError):
-                counts[table] = None
         if not self.is_mutable:
+            counts = await self._count_tables(limit)
             self._cached_table_counts = counts
+            return counts
+        if not self._exact_counts_synced:
+            # Otherwise synced on startup and when the schema changes
+            await self.sync_exact_counts()
+        counts = await self._mutable_table_counts_for(limit, allow_stale)
+        if self.exact_count_tables:
+            counts = {**counts, **await self.exact_counts()}
         return counts
 
+    async def _mutable_table_counts_for(self, limit, allow_stale):
+        if self.is_memory:
+            # No file to tell us if the data has changed
+            return await self._count_tables(limit)
+        key = self.data_generation()
+        cached = self._mutable_table_counts
+        if cached is not None and (
+            # Counts that timed out can be retried with a longer limit
+            limit <= cached["limit"]
+            or all(count is not None for count in cached["counts"].values())
+        ):
+            if key is not None and cached["key"] == key:
+                return cached["counts"]
+            if allow_stale:
+                table_names = await self.table_names()
+                # Started last, so the stale counts are still marked as
+                # stale when they are returned
+                self._start_table_counts_refresh(limit)
+                return {table: cached["counts"].get(table) for table in table_names}
+        return await self._refresh_table_counts(limit, key)
+
+    def _exact_counts_configured(self):
+        db_config = ((self.ds.config or {}).get("databases") or {}).get(self.name) or {}
+        return bool(db_config.get("exact_counts")) or any(
+            (table_config or {}).get("exact_counts")
+            for table_config in (db_config.get("tables") or {}).values()
+        )
+
+    def _triggers_configured(self):
+        # exact_counts and array_indexes both rely on delete triggers
+        return self._exact_counts_configured() or bool(self._configured_array_indexes())
+
+    async def _configured_exact_count_tables(self):
+        db_config = ((self.ds.config or {}).get("databases") or {}).get(self.name) or {}
+        table_names = await self.table_names()
+        tables = set()
+        if db_config.get("exact_counts"):
+            hidden = set(await self.hidden_table_names())
+            tables = {table for table in table_names if table not in hidden}
+        for table, table_config in (db_config.get("tables") or {}).items():
+            if "exact_counts" in (table_config or {}):
+                if table_config["exact_counts"]:
+                    tables.add(table)
+                else:
+                    tables.discard(table)
+        return tables.intersection(table_names)
+
+    async def _installed_exact_count_tables(self):
+        if not await self.table_exists(EXACT_COUNTS_TABLE):
+            return set()
+        return {row[0] for row in await self.execute(_installed_exact_count_tables_sql)}
+
+    async def sync_exact_counts(self):
+        """Install or remove the triggers that keep exact row counts in the
+        _datasette_counts table, to match the exact_counts configuration.
+
+        The triggers are changed using the write thread. Returns the set of
+        tables that now have exact counts.
+        """
+        if not self.is_mutable:
+            return set()
+        if not self._exact_counts_configured():
+            if self._exact_counts_synced and not self.exact_count_tables:
+                return set()
+            configured = set()
+        else:
+            configured = await self._configured_exact_count_tables()
+        installed = await self._installed_exact_count_tables()
+        if configured != installed:
+
+            def sync(conn):
+                for table in installed - configured:
+                    _remove_exact_count_triggers(conn, table)
+                for table in configured - installed:
+                    _install_exact_count_triggers(conn, table)
+
+            await self.execute_write_fn(sync)
+            installed = await self._installed_exact_count_tables()
+        self.exact_count_tables = installed
+        self._exact_counts_synced = True
+        return installed
+
+    def _configured_array_indexes(self):
+        # {table: [column, ...]} for tables with array_indexes configured
+        db_config = ((self.ds.config or {}).get("databases") or {}).get(self.name) or {}
+        return {
+            table: list(table_config["array_indexes"] or [])
+            for table, table_config in (db_config.get("tables") or {}).items()
+            if "array_indexes" in (table_config or {})
+        }
+
+    async def sync_array_indexes(self):
+        """Create or remove the tables indexing the values in JSON array
+        columns, to match the array_indexes configuration for each table.
+
+        The tables are changed using the write thread. Returns the
+        (table, column) pairs that were indexed.
+        """
+        if not self.is_mutable:
+            return []
+        configured = self._configured_array_indexes()
+        table_names = set(await self.table_names())
+        to_install = []
+        to_remove = []
+        for table, columns in configured.items():
+            if table not in table_names:
+                continue
+            installed = await self.array_indexes(table)
+            table_columns = await self.table_columns(table)
+            to_install.extend(
+                (table, column)
+                for column in columns
+                if column in table_columns and column not in installed
+            )
+            to_remove.extend(
+                (table, column) for column in installed if column not in columns
+            )
+        if not to_install and not to_remove:
+            return []
+
+        def sync(conn):
+            for table, column in to_remove:
+                _remove_array_index(conn, table, column)
+            return [
+                (table, column)
+                for table, column in to_install
+                if _install_array_index(conn, table, column)
+            ]
+
+        return await self.execute_write_fn(sync)
+
+    async def exact_counts(self):
+        """Exact row counts for the tables listed in exact_count_tables,
+        read from the trigger-maintained _datasette_counts table."""
+        if not self.exact_count_tables:
+            return {}
+        counts = {
+            row["table_name"]: row["count"]
+            for row in await self.execute(
+                "select table_name, count from {} where table_name in ({})".format(
+                    EXACT_COUNTS_TABLE,
+                    ", ".join("?" for _ in self.exact_count_tables),
+                ),
+                list(self.exact_count_tables),
+            )
+        }
+        return counts
+
+    async def table_count_estimates(self):
+        """Estimated row counts for tables, from the statistics gathered by
+        ANALYZE in sqlite_stat1. Tables without statistics are left out.
+
+        Cached until the database changes."""
+        version = self.data_generation()
+        cached = self._table_count_estimates
+        if version is not None and cached is not None and cached[0] == version:
+            return dict(cached[1])
+        estimates = {}
+        if await self.table_exists("sqlite_stat1"):
+            # The first number in each stat is the number of rows in the
+            # table, or in the index - which is smaller than the table for
+            # partial indexes, hence max()
+            for row in await self.execute("select tbl, stat from sqlite_stat1"):
+                estimate = _first_stat_number(row["stat"])
+                if estimate is not None:
+                    estimates[row["tbl"]] = max(estimates.get(row["tbl"], 0), estimate)
+        if version is not None:
+            self._table_count_estimates = (version, estimates)
+        return dict(estimates)
+
+    async def table_count_estimate(self, table):
+        "Estimated row count for a table, or None if it has not been analyzed"
+        return (await self.table_count_estimates()).get(table)
+
+    @property
+    def table_counts_stale_as_of(self):
+        """ISO timestamp of the cached table counts if the database has
+        changed since they were calculated, otherwise None"""
+        cached = self._mutable_table_counts
+        if cached is None or self.is_memory:
+            return None
+        key = self.data_generation()
+        if key is not None and cached["key"] == key:
+            return None
+        return cached["counted_at"]
+
+    def data_generation(self):
+        """A number that increases whenever the data in this database may
+        have changed, or None if that cannot currently be determined.
+
+        PRAGMA data_version on a long-lived connection changes when any
+        other connection commits, including ones in other processes. Writes
+        made through Datasette are counted too. Immutable databases always
+        return 0 and in-memory databases always return None.
+        """
+        if not self.is_mutable:
+            return 0
+        if self.is_memory:
+            return None
+        with self._data_version_lock:
+            if self._closed:
+                return None
+            try:
+                if self._data_version_conn is None:
+                    conn = self.connect()
+                    # Never wait for a lock on the event loop
+                    conn.execute("PRAGMA busy_timeout=0")
+                    self._data_version_conn = conn
+                version = self._data_version_conn.execute(
+                    "PRAGMA data_version"
+                ).fetchone()[0]
+            except sqlite3.Error:
+                version = None
+            state = (version, self._completed_writes)
+            if state != self._data_version_state:
+                self._data_version_state = state
+                self._data_generation += 1
+                result_cache = self.ds.query_result_cache
+                if result_cache is not None:
+                    result_cache.remove_database(self.name)
+            if version is None:
+                return None
+            return self._data_generation
+
+    async def _data_generation_off_loop(self):
+        # PRAGMA data_version can open a connection or wait on the file, so
+        # in threaded mode it is read in a thread
+        if self.ds.executor is None:
+            return self.data_generation()
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.data_generation
+        )
+
+    def _current_version(self):
+        # Like data_generation(), but in-memory databases can only be
+        # changed through Datasette so their completed writes are used
+        if self.is_memory:
+            return self._completed_writes
+        return self.data_generation()
+
+    def _start_table_counts_refresh(self, limit):
+        if _task_is_running(self._table_counts_refresh_task):
+            return
+
+        async def refresh():
+            try:
+                await self._refresh_table_counts(limit, self.data_generation())
+            except Exception:
+                pass
+            finally:
+                self._table_counts_refresh_task = None
+
+        self._table_counts_refresh_task = _start_background_task(refresh())
+
+    async def _refresh_table_counts(self, limit, key):
+        # key is calculated before counting, so any write made while the
+        # counts are running leaves the result marked as stale
+        counts = await self._count_tables(limit)
+        self._mutable_table_counts = {
+            "key": key,
+            "limit": limit,
+            "counts": counts,
+            "counted_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        return counts
+
+    async def _count_tables(self, limit):
+        # Try to get counts for each table, $limit timeout for each count.
+        # Counts run concurrently, using at most half of the threads in the
+        # pool so other queries against this database can still run
+        if self.ds.executor is None:
+            concurrency = 1
+        else:
+            concurrency = max(1, self.sql_thread_pool.num_threads // 2)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def count(table):
+            async with semaphore:
+                try:
+                    return (
+                        await self.execute(
+                            f"select count(*) from (select * from {escape_sqlite(table)} limit {self.count_limit + 1})",
+                            custom_time_limit=limit,
+                        )
+                    ).rows[0][0]
+                # In some cases I saw "SQL Logic Error" here in addition to
+                # QueryInterrupted - so we catch that too:
+                except (
+                    QueryInterrupted,
+                    sqlite3.OperationalError,
+                    sqlite3.DatabaseError,
+                ):
+                    return None
+
+        # Exact counts are read from _datasette_counts instead
+        table_names = [
+            table
+            for table in await self.table_names()
+            if table not in self.exact_count_tables
+        ]
+        return dict(
+            zip(
+                table_names,
+                await asyncio.gather(*(count(table) for table in table_names)),
+            )
+        )
+
     @property
     def mtime_ns(self):
         if self.is_memory:
@@ -659,17 +1648,89 @@ class Database:
         )
         return [r[0] for r in results.rows]
 
+    async def _cached_introspection(self, key, fn, copy=list):
+        """Return fn(conn) run in a thread, cached until the schema changes.
+
+        copy is applied to the cached value before it is returned, so
+        callers can modify the result without affecting the cache.
+        """
+        cached_version = self._introspection_schema_version
+        has_cached = key in self._introspection_cache
+        if not self.is_mutable and not self.is_memory:
+            # Immutable files can never change, so there is no need to check
+            # the schema version
+            if not has_cached:
+                self.introspection_cache_misses += 1
+                self._introspection_cache[key] = await self.execute_fn(fn)
+            else:
+                self.introspection_cache_hits += 1
+            value = self._introspection_cache[key]
+            return copy(value) if copy is not None else value
+
+        def check_version_then_run(conn):
+            # Reading the schema version is far cheaper than fn, and is done
+            # in the same thread hop - another process could have changed
+            # the schema at any time
+            schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+            if has_cached and schema_version == cached_version:
+                return schema_version, _CACHE_HIT
+            return schema_version, fn(conn)
+
+        schema_version, value = await self.execute_fn(check_version_then_run)
+        if value is _CACHE_HIT and key in self._introspection_cache:
+            self.introspection_cache_hits += 1
+            value = self._introspection_cache[key]
+        else:
+            if value is _CACHE_HIT:
+                # Invalidated by another call while this one was running
+                value = await self.execute_fn(fn)
+            self.introspection_cache_misses += 1
+            if schema_version != self._introspection_schema_version:
+                if self._introspection_cache:
+                    self.introspection_cache_invalidations += 1
+                self._introspection_cache = {}
+                self._introspection_schema_version = schema_version
+            self._introspection_cache[key] = value
+        return copy(value) if copy is not None else value
+
+    def introspection_cache_stats(self):
+        return {
+            "entries": len(self._introspection_cache),
+            "schema_version": self._introspection_schema_version,
+            "hits": self.introspection_cache_hits,
+            "misses": self.introspection_cache_misses,
+            "invalidations": self.introspection_cache_invalidations,
+        }
+
     async def table_columns(self, table):
-        return await self.execute_fn(lambda conn: table_columns(conn, table))
+        return await self._cached_introspection(
+            ("table_columns", table), lambda conn: table_columns(conn, table)
+        )
 
     async def table_column_details(self, table):
-        return await self.execute_fn(lambda conn: table_column_details(conn, table))
+        return await self._cached_introspection(
+            ("table_column_details", table),
+            lambda conn: table_column_details(conn, table),
+        )
 
     async def primary_keys(self, table):
-        return await self.execute_fn(lambda conn: detect_primary_keys(conn, table))
+        return await self._cached_introspection(
+            ("primary_keys", table), lambda conn: detect_primary_keys(conn, table)
+        )
 
     async def fts_table(self, table):
-        return await self.execute_fn(lambda conn: detect_fts(conn, table))
+        return await self._cached_introspection(
+            ("fts_table", table), lambda conn: detect_fts(conn, table), copy=None
+        )
+
+    async def array_indexes(self, table):
+        """Returns {column: index_table} for columns of table that have an
+        index table of their JSON array values, see sync_array_indexes()"""
+        return await self._cached_introspection(
+            ("array_indexes", table),
+            lambda conn: _detect_array_indexes(conn, table),
+            copy=dict,
+        )
 
     async def label_column_for_table(self, table):
         explicit_label_column = (await self.ds.table_config(self.name, table)).get(
@@ -693,7 +1754,9 @@ class Database:
                 details[name] = (columns[name], is_unique)
             return details
 
-        column_details = await self.execute_fn(column_details)
+        column_details = await self._cached_introspection(
+            ("label_column_details", table), column_details, copy=dict
+        )
         # Is there just one unique column that's text?
         unique_text_columns = [
             name
@@ -720,8 +1783,10 @@ class Database:
         return None
 
     async def foreign_keys_for_table(self, table):
-        return await self.execute_fn(
-            lambda conn: get_outbound_foreign_keys(conn, table)
+        return await self._cached_introspection(
+            ("foreign_keys_for_table", table),
+            lambda conn: get_outbound_foreign_keys(conn, table),
+            copy=lambda fks: [dict(fk) for fk in fks],
         )
 
     async def hidden_table_names(self):
@@ -732,33 +1797,9 @@ class Database:
             hidden_tables += [
                 t for t in db_config["tables"] if db_config["tables"][t].get("hidden")
             ]
-
-        hidden_tables += await self.execute_fn(sqlite_hidden_table_names)
-
-        has_spatialite = await self.execute_fn(detect_spatialite)
-        if has_spatialite:
-            # Also hide Spatialite internal tables
-            hidden_tables += [
-                "ElementaryGeometries",
-                "SpatialIndex",
-                "geometry_columns",
-                "spatial_ref_sys",
-                "spatialite_history",
-                "sql_statements_log",
-                "sqlite_sequence",
-                "views_geometry_columns",
-                "virts_geometry_columns",
-                "data_licenses",
-                "KNN",
-                "KNN2",
-            ] + [
-                r[0] for r in (await self.execute("""
-                        select name from sqlite_master
-                        where name like "idx_%"
-                        and type = "table"
-                    """)).rows
-            ]
-
+        hidden_tables += await self._cached_introspection(
+            ("hidden_table_names",), _schema_hidden_table_names
+        )
         return hidden_tables
 
     async def view_names(self):
@@ -810,6 +1851,34 @@ class Database:
         return f"<Database: {self.name}{tags_str}>"
 
 
+def _schema_hidden_table_names(conn):
+    # Hidden tables that can be detected from the schema alone
+    hidden_tables = sqlite_hidden_table_names(conn)
+    if detect_spatialite(conn):
+        # Also hide Spatialite internal tables
+        hidden_tables += [
+            "ElementaryGeometries",
+            "SpatialIndex",
+            "geometry_columns",
+            "spatial_ref_sys",
+            "spatialite_history",
+            "sql_statements_log",
+            "sqlite_sequence",
+            "views_geometry_columns",
+            "virts_geometry_columns",
+            "data_licenses",
+            "KNN",
+            "KNN2",
+        ] + [
+            r[0] for r in conn.execute("""
+                    select name from sqlite_master
+                    where name like "idx_%"
+                    and type = "table"
+                """).fetchall()
+        ]
+    return hidden_tables
+
+
 def _apply_write_wrapper(fn, wrapper_factory, track_event):
     """Apply a single write_wrapper context manager around fn.
 
@@ -875,6 +1944,225 @@ class WriteTask:
         self.transaction = transaction
 
 
+def _can_group_commit(task):
+    return task is not _SHUTDOWN and task.transaction and not task.isolated_connection
+
+
+EXACT_COUNTS_TABLE = "_datasette_counts"
+
+_installed_exact_count_tables_sql = """
+select table_name from {counts_table}
+where exists (
+    select 1 from sqlite_master where type = 'trigger'
+    and name = '{counts_table}_insert_' || table_name
+) and exists (
+    select 1 from sqlite_master where type = 'trigger'
+    and name = '{counts_table}_delete_' || table_name
+)
+""".format(counts_table=EXACT_COUNTS_TABLE)
+
+
+def _exact_count_trigger_names(table):
+    return (
+        "{}_insert_{}".format(EXACT_COUNTS_TABLE, table),
+        "{}_delete_{}".format(EXACT_COUNTS_TABLE, table),
+    )
+
+
+def _install_exact_count_triggers(conn, table):
+    row = conn.execute(
+        "select sql from sqlite_master where type = 'table' and name = ?", [table]
+    ).fetchone()
+    if row is None or "virtual table" in (row[0] or "").lower():
+        # Triggers cannot be created on virtual tables
+        return
+    conn.execute(
+        "create table if not exists {} "
+        "(table_name text primary key, count integer not null)".format(
+            EXACT_COUNTS_TABLE
+        )
+    )
+    insert_trigger, delete_trigger = _exact_count_trigger_names(table)
+    for trigger, event, change in (
+        (insert_trigger, "insert", "+ 1"),
+        (delete_trigger, "delete", "- 1"),
+    ):
+        conn.execute(
+            "create trigger if not exists {trigger} after {event} on {table} "
+            "begin update {counts} set count = count {change} "
+            "where table_name = {name}; end".format(
+                trigger=escape_sqlite(trigger),
+                event=event,
+                table=escape_sqlite(table),
+                counts=EXACT_COUNTS_TABLE,
+                change=change,
+                name="'{}'".format(table.replace("'", "''")),
+            )
+        )
+    # Same transaction as the triggers, so no write can be missed
+    conn.execute(
+        "insert or replace into {} (table_name, count) "
+        "select ?, count(*) from {}".format(EXACT_COUNTS_TABLE, escape_sqlite(table)),
+        [table],
+    )
+
+
+def _remove_exact_count_triggers(conn, table):
+    for trigger in _exact_count_trigger_names(table):
+        conn.execute("drop trigger if exists {}".format(escape_sqlite(trigger)))
+    conn.execute(
+        "delete from {} where table_name = ?".format(EXACT_COUNTS_TABLE), [table]
+    )
+
+
+ARRAY_INDEXES_TABLE = "_datasette_array_indexes"
+
+
+def _detect_array_indexes(conn, table):
+    # Index tables are looked up in ARRAY_INDEXES_TABLE, rather than from
+    # their names, which could be the same for two (table, column) pairs
+    try:
+        rows = conn.execute(
+            "select column_name, index_table from {} where table_name = ? "
+            "and index_table in (select name from sqlite_master "
+            "where type = 'table')".format(ARRAY_INDEXES_TABLE),
+            [table],
+        ).fetchall()
+    except sqlite3.OperationalError:
+        # No array indexes have been created in this database
+        return {}
+    columns = set(table_columns(conn, table))
+    return {column: index_table for column, index_table in rows if column in columns}
+
+
+def _array_index_table_name(conn, table, column):
+    # _array_index_{table}_{column}, with a number added if that name, or
+    # the name of one of its indexes or triggers, is already in use
+    existing = {
+        name.lower() for (name,) in conn.execute("select name from sqlite_master")
+    }
+    base = "_array_index_{}_{}".format(table, column)
+    name = base
+    suffix = 1
+    while {
+        candidate.lower()
+        for candidate in (name, name + "_value", name + "_source_rowid")
+        + _array_index_trigger_names(name)
+    } & existing:
+        suffix += 1
+        name = "{}_{}".format(base, suffix)
+    return name
+
+
+def _array_index_trigger_names(index_table):
+    return tuple(
+        "{}_{}".format(index_table, event) for event in ("insert", "update", "delete")
+    )
+
+
+def _install_array_index(conn, table, column):
+    # A (source_rowid, value) row for each distinct value in the JSON array
+    # in column for every row of table, kept up to date by triggers
+    row = conn.execute(
+        "select sql from sqlite_master where type = 'table' and name = ?", [table]
+    ).fetchone()
+    sql = (row[0] or "").lower() if row else ""
+    if not sql or "virtual table" in sql or "without rowid" in sql:
+        # These do not have triggers or a rowid
+        return False
+    conn.execute(
+        "create table if not exists {} (table_name text, column_name text, "
+        "index_table text not null unique, "
+        "primary key (table_name, column_name))".format(ARRAY_INDEXES_TABLE)
+    )
+    # Anything left over from an index that was not fully removed
+    _remove_array_index(conn, table, column)
+    index_table_name = _array_index_table_name(conn, table, column)
+    conn.execute(
+        "insert into {} (table_name, column_name, index_table) "
+        "values (?, ?, ?)".format(ARRAY_INDEXES_TABLE),
+        [table, column, index_table_name],
+    )
+    index_table = escape_sqlite(index_table_name)
+    # Values that are not valid JSON are skipped, rather than causing errors
+    json_array = "case when json_valid({value}) then {value} end"
+    conn.execute("create table {} (source_rowid integer, value)".format(index_table))
+    conn.execute(
+        "insert into {index_table} (source_rowid, value) "
+        "select distinct {table}.rowid, j.value "
+        "from {table} join json_each({array}) j".format(
+            index_table=index_table,
+            table=escape_sqlite(table),
+            array=json_array.format(
+                value="{}.{}".format(escape_sqlite(table), escape_sqlite(column))
+            ),
+        )
+    )
+    for suffix, columns in (
+        ("_value", "value, source_rowid"),
+        ("_source_rowid", "source_rowid"),
+    ):
+        conn.execute(
+            "create index {} on {} ({})".format(
+                escape_sqlite(index_table_name + suffix), index_table, columns
+            )
+        )
+    insert_new = (
+        "insert into {} (source_rowid, value) "
+        "select distinct new.rowid, value from json_each({})".format(
+            index_table, json_array.format(value="new." + escape_sqlite(column))
+        )
+    )
+    delete_old = "delete from {} where source_rowid = old.rowid".format(index_table)
+    insert_trigger, update_trigger, delete_trigger = _array_index_trigger_names(
+        index_table_name
+    )
+    for trigger, event, statements in (
+        (insert_trigger, "insert", [insert_new]),
+        (update_trigger, "update", [delete_old, insert_new]),
+        (delete_trigger, "delete", [delete_old]),
+    ):
+        conn.execute(
+            "create trigger {trigger} after {event} on {table} "
+            "begin {statements}; end".format(
+                trigger=escape_sqlite(trigger),
+                event=event,
+                table=escape_sqlite(table),
+                statements="; ".join(statements),
+            )
+        )
+    return True
+
+
+def _remove_array_index(conn, table, column):
+    row = conn.execute(
+        "select index_table from {} where table_name = ? and column_name = ?".format(
+            ARRAY_INDEXES_TABLE
+        ),
+        [table, column],
+    ).fetchone()
+    if row is None:
+        return
+    index_table = row[0]
+    for trigger in _array_index_trigger_names(index_table):
+        conn.execute("drop trigger if exists {}".format(escape_sqlite(trigger)))
+    # Dropping the table also drops its indexes
+    conn.execute("drop table if exists {}".format(escape_sqlite(index_table)))
+    conn.execute(
+        "delete from {} where table_name = ? and column_name = ?".format(
+            ARRAY_INDEXES_TABLE
+        ),
+        [table, column],
+    )
+
+
+def _first_stat_number(stat):
+    try:
+        return int((stat or "").split()[0])
+    except (IndexError, ValueError):
+        return None
+
+
 def _deliver_write_result(task, result, exception):
     # Called from the write thread. Delivers the result back to the
     # awaiting coroutine on its event loop via call_soon_threadsafe.
@@ -894,6 +2182,259 @@ def _deliver_write_result(task, result, exception):
         pass
 
 
+class SQLThreadPool:
+    """A named pool of threads used to execute read queries.
+
+    Wraps a ThreadPoolExecutor, keeping track of how many submitted
+    functions are waiting for a free thread and how many are running.
+    """
+
+    def __init__(self, name, num_threads):
+        self.name = name
+        self.num_threads = num_threads
+        self.executor = futures.ThreadPoolExecutor(
+            max_workers=num_threads,
+            thread_name_prefix="datasette-sql-{}".format(name),
+        )
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+
+    def submit(self, fn):
+        with self._lock:
+            self.queued += 1
+
+        def run():
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+            try:
+                return fn()
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        try:
+            return self.executor.submit(run)
+        except RuntimeError:
+            with self._lock:
+                self.queued -= 1
+            raise
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "num_threads": self.num_threads,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+            }
+
+
+class ReadConnectionPool:
+    """A bounded pool of read-only connections for a single database.
+
+    Connections are opened on demand by calling ``connect()``, up to
+    ``max_size`` of them. Threads that need a connection when all of them
+    are in use wait for one to be released. Connections left idle for more
+    than ``idle_timeout`` seconds are closed, and connections that fail a
+    health check on checkout are replaced.
+    """
+
+    def __init__(self, connect, max_size, idle_timeout=0, close_connection=None):
+        self._connect = connect
+        self._close_connection = close_connection or (lambda conn: conn.close())
+        self.max_size = max(max_size, 1)
+        self.idle_timeout = idle_timeout
+        # (connection, time it was released) - most recently used on the right
+        self._idle = collections.deque()
+        self._num_open = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self.waiting = 0
+        self.checkouts = 0
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.evicted = 0
+        self.discarded = 0
+        self.checkout_ms_total = 0.0
+        self.checkout_ms_max = 0.0
+
+    def acquire(self):
+        start = time.perf_counter()
+        with self._condition:
+            self._check_not_closed()
+            to_close = self._pop_expired(time.monotonic())
+            waited = False
+            while not self._idle and self._num_open >= self.max_size:
+                waited = True
+                self.waiting += 1
+                try:
+                    self._condition.wait()
+                finally:
+                    self.waiting -= 1
+                self._check_not_closed()
+            conn = None
+            if self._idle:
+                # Most recently used first, so the least used ones can expire
+                conn, _ = self._idle.pop()
+            else:
+                self._num_open += 1
+        self._close_all(to_close)
+        if conn is not None and not _connection_is_healthy(conn):
+            self._close_connection(conn)
+            conn = None
+            with self._condition:
+                self.discarded += 1
+        hit = conn is not None
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._condition:
+                    self._num_open -= 1
+                    self._condition.notify()
+                raise
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._condition:
+            self.checkouts += 1
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if waited:
+                self.waits += 1
+            self.checkout_ms_total += elapsed_ms
+            self.checkout_ms_max = max(self.checkout_ms_max, elapsed_ms)
+        return conn
+
+    def release(self, conn):
+        with self._condition:
+            if not self._closed:
+                self._idle.append((conn, time.monotonic()))
+                self._condition.notify()
+                return
+            self._num_open -= 1
+        self._close_connection(conn)
+
+    def evict_idle(self):
+        "Close connections that have been idle for longer than idle_timeout"
+        with self._condition:
+            to_close = self._pop_expired(time.monotonic())
+        self._close_all(to_close)
+        return len(to_close)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            to_close = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._num_open -= len(to_close)
+            self._condition.notify_all()
+        self._close_all(to_close)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "max_size": self.max_size,
+                "open": self._num_open,
+                "idle": len(self._idle),
+                "in_use": self._num_open - len(self._idle),
+                "waiting": self.waiting,
+                "checkouts": self.checkouts,
+                "hits": self.hits,
+                "misses": self.misses,
+                "waits": self.waits,
+                "evicted": self.evicted,
+                "discarded": self.discarded,
+                "checkout_ms_avg": (
+                    round(self.checkout_ms_total / self.checkouts, 3)
+                    if self.checkouts
+                    else 0
+                ),
+                "checkout_ms_max": round(self.checkout_ms_max, 3),
+            }
+
+    def _check_not_closed(self):
+        if self._closed:
+            raise DatasetteClosedError("Connection pool has been closed")
+
+    def _pop_expired(self, now):
+        # Must be called while holding self._condition
+        expired = []
+        if not self.idle_timeout:
+            return expired
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            expired.append(self._idle.popleft()[0])
+        self._num_open -= len(expired)
+        self.evicted += len(expired)
+        if expired:
+            self._condition.notify(len(expired))
+        return expired
+
+    def _close_all(self, conns):
+        for conn in conns:
+            self._close_connection(conn)
+
+
+def _connection_is_healthy(conn):
+    try:
+        if conn.in_transaction:
+            # Left over from a callback that did not finish its transaction
+            conn.rollback()
+        conn.execute("select 1").fetchone()
+    except sqlite3.Error:
+        return False
+    return True
+
+
+class _QueryCancellation:
+    """Lets the event loop interrupt a function running in a SQL thread.
+
+    The thread calls ``start(conn)`` before running the function and
+    ``finish()`` afterwards. ``cancel()`` can be called at any time from
+    another thread: it causes ``start()`` to raise if the function has not
+    started yet. Otherwise it interrupts the running statement, and any
+    statement the function runs later inside ``sqlite_timelimit()``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn = None
+        self._cancelled = False
+        self._finished = False
+
+    def start(self, conn):
+        with self._lock:
+            if self._cancelled:
+                raise futures.CancelledError()
+            self._conn = conn
+
+    def finish(self):
+        with self._lock:
+            if self._cancelled and self._conn is not None:
+                sqlite_interrupt_reset(self._conn)
+            self._conn = None
+            self._finished = True
+
+    def cancel(self):
+        "Returns True if this prevented or interrupted the function"
+        with self._lock:
+            if self._finished or self._cancelled:
+                return False
+            self._cancelled = True
+            if self._conn is not None:
+                # Also covers a statement that has not started yet
+                sqlite_interrupt(self._conn)
+            return True
+
+
 class QueryInterrupted(Exception):
     def __init__(self, e, sql, params):
         self.e = e
@@ -946,6 +2487,98 @@ class ExecuteWriteResult:
         return rows
 
 
+class _QueryFlight:
+    "A query being run by Database.execute() and the number of callers waiting on it"
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+def _params_key(params):
+    if isinstance(params, dict):
+        return tuple(sorted(params.items()))
+    elif params is not None:
+        return tuple(params)
+    return None
+
+
+class QueryResultCache:
+    """Byte-bounded LRU cache of Results objects.
+
+    Results for mutable databases are keyed on Database.data_generation(),
+    and all of a database's entries are dropped when that advances.
+
+    Sizes are estimates based on the lengths of the values in each row.
+    Results larger than a quarter of the budget are not cached.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        results, _ = entry
+        # Callers may modify the list of rows they are given
+        return Results(list(results.rows), results.truncated, results.description)
+
+    def put(self, key, results):
+        size = _estimate_results_size(key, results)
+        if size > self.max_bytes // 4:
+            return
+        results = Results(list(results.rows), results.truncated, results.description)
+        with self._lock:
+            existing = self._entries.pop(key, None)
+            if existing is not None:
+                self.bytes -= existing[1]
+            self._entries[key] = (results, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def remove_database(self, name):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == name]:
+                self.bytes -= self._entries.pop(key)[1]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "bytes": self.bytes,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def _estimate_results_size(key, results):
+    size = 200 + len(key[2])
+    for row in results.rows:
+        size += 64
+        for value in row:
+            if isinstance(value, (str, bytes)):
+                size += 50 + len(value)
+            else:
+                size += 24
+    return size
+
+
 class Results:
     def __init__(self, rows, truncated, description):
         self.rows = rows
@@ -1,7 +1,8 @@
 import json
+import time
 import urllib
 from datasette import hookimpl
-from datasette.database import QueryInterrupted
+from datasette.database import QueryInterrupted, _params_key
 from datasette.utils import (
     escape_sqlite,
     path_with_added_args,
@@ -20,19 +21,7 @@ def load_facet_configs(request, table_config):
     #       {"source": "metadata", "config": config1},
     #       {"source": "request", "config": config2}]}
     facet_configs = {}
-    table_config = table_config or {}
-    table_facet_configs = table_config.get("facets", [])
-    for facet_config in table_facet_configs:
-        if isinstance(facet_config, str):
-            type = "column"
-            facet_config = {"simple": facet_config}
-        else:
-            assert (
-                len(facet_config.values()) == 1
-            ), "Metadata config dicts should be {type: config}"
-            type, facet_config = list(facet_config.items())[0]
-            if isinstance(facet_config, str):
-                facet_config = {"simple": facet_config}
+    for type, facet_config in table_facet_configs(table_config):
         facet_configs.setdefault(type, []).append(
             {"source": "metadata", "config": facet_config}
         )
@@ -55,6 +44,30 @@ def load_facet_configs(request, table_config):
     return facet_configs
 
 
+# Number of FacetSample objects cached for each database
+FACET_SAMPLE_CACHE_SIZE = 32
+
+
+def table_facet_configs(table_config):
+    # Returns a list of (type, config) pairs for the facets in the
+    # configuration for a table
+    configs = []
+    table_config = table_config or {}
+    for facet_config in table_config.get("facets", []):
+        if isinstance(facet_config, str):
+            type = "column"
+            facet_config = {"simple": facet_config}
+        else:
+            assert (
+                len(facet_config.values()) == 1
+            ), "Metadata config dicts should be {type: config}"
+            type, facet_config = list(facet_config.items())[0]
+            if isinstance(facet_config, str):
+                facet_config = {"simple": facet_config}
+        configs.append((type, facet_config))
+    return configs
+
+
 @hookimpl
 def register_facet_classes():
     classes = [ColumnFacet, DateFacet]
@@ -139,6 +152,114 @@ class Facet:
         # defined in metadata (in which case you cannot turn it off)
         raise NotImplementedError
 
+    async def get_sample(self):
+        """Returns a FacetSample summarizing the first suggest_consider rows
+        of self.sql, or None if they could not be read in time.
+
+        The sample is read with a single query, shared by the suggest()
+        methods of every facet class and cached until the database changes.
+        """
+        db = self.ds.get_database(self.database)
+        version = db._current_version()
+        key = (self.sql, _params_key(self.params), self.suggest_consider)
+        cached = db._facet_samples.get(key)
+        if cached is not None and version is not None and cached[0] == version:
+            db._facet_samples.move_to_end(key)
+            return cached[1]
+        columns = await self.get_columns(self.sql, self.params)
+        # The sample rows, plus a summary row flagged by facet_summary that
+        # counts the distinct and non-null values in each column. These are
+        # counted by SQLite so that each column's collation is respected.
+        sample_sql = """
+            with facet_sample as (
+                select * from ({sql}) limit {suggest_consider}
+            )
+            select 0 as facet_summary, {columns}{date_columns} from facet_sample
+            union all
+            select 1, {distinct_counts}{value_counts} from facet_sample
+        """.format(
+            columns=", ".join(escape_sqlite(column) for column in columns),
+            date_columns="".join(
+                ", case when {column} glob '????-??-*' then date({column}) end".format(
+                    column=escape_sqlite(column)
+                )
+                for column in columns
+            ),
+            distinct_counts=", ".join(
+                "count(distinct {})".format(escape_sqlite(column)) for column in columns
+            ),
+            value_counts="".join(
+                ", count({})".format(escape_sqlite(column)) for column in columns
+            ),
+            sql=self.sql,
+            suggest_consider=self.suggest_consider,
+        )
+        try:
+            results = await self.ds.execute(
+                self.database,
+                sample_sql,
+                self.params,
+                truncate=False,
+                custom_time_limit=self.ds.setting("facet_suggest_time_limit_ms")
+                * max(len(columns), 1),
+                log_sql_errors=False,
+            )
+        except (QueryInterrupted, sqlite3.OperationalError):
+            return None
+        rows = []
+        summary = None
+        for row in results.rows:
+            if row[0]:
+                summary = row
+            else:
+                rows.append(tuple(row)[1:])
+        num_columns = len(columns)
+        sample = FacetSample(
+            columns,
+            rows,
+            distinct=dict(zip(columns, summary[1 : num_columns + 1])),
+            non_null=dict(zip(columns, summary[num_columns + 1 :])),
+        )
+        if version is not None:
+            db._facet_samples[key] = (version, sample)
+            db._facet_samples.move_to_end(key)
+            while len(db._facet_samples) > FACET_SAMPLE_CACHE_SIZE:
+                db._facet_samples.popitem(last=False)
+        return sample
+
+    def get_column_stats(self, column):
+        """Statistics for a column from ``datasette inspect --column-stats``,
+        if this facet is against a whole table in an immutable database"""
+        if not self._against_whole_table():
+            return None
+        stats = self.ds.get_database(self.database).column_stats(self.table)
+        return (stats or {}).get(column)
+
+    def get_precomputed_facet_rows(self, column, facet_size):
+        """Up to facet_size + 1 facet rows for this type of facet against a
+        column, as recorded by ``datasette inspect --config``, if this facet
+        is against a whole table in an immutable database"""
+        if not self._against_whole_table():
+            return None
+        facets = self.ds.get_database(self.database).precomputed_facets(self.table)
+        facet = (facets or {}).get(self.type, {}).get(column)
+        if facet is None:
+            return None
+        results = facet["results"]
+        if facet["truncated"] and len(results) <= facet_size:
+            # Too few values were recorded to know which are the top ones
+            return None
+        return [
+            {"value": value, "count": count}
+            for value, count in results[: facet_size + 1]
+        ]
+
+    def _against_whole_table(self):
+        # Statistics describe the whole table, so skip them for filtered SQL
+        if not self.table or self.request.args.get("_where"):
+            return False
+        return self.sql.endswith(" from {} ".format(escape_sqlite(self.table)))
+
     async def get_columns(self, sql, params=None):
         # Detect column names using the "limit 0" trick
         return (
@@ -148,73 +269,120 @@ class Facet:
         ).columns
 
 
+class FacetSample:
+    """Summaries of each column in the first rows returned by a query, used
+    to decide which facets to suggest.
+
+    rows should have a value for each column followed by, for each column,
+    its date() if that value looks like it starts with a date. distinct
+    and non_null are the number of distinct and non-null values in each
+    column, counted by SQLite using the column's collation.
+    """
+
+    # Only the first this-many rows are checked for dates and arrays:
+    first_rows = 100
+
+    def __init__(self, columns, rows, distinct, non_null):
+        self.columns = list(columns)
+        self.row_count = len(rows)
+        # Number of distinct non-null values in each column
+        self.distinct = dict(distinct)
+        # Does any non-null value appear more than once?
+        self.repeated = {
+            column: self.distinct[column] < non_null[column] for column in self.columns
+        }
+        # Is every value null, empty or a JSON array, with the first arrays
+        # that have items all being arrays of strings?
+        self.arrays_of_strings = {}
+        # Do any of the first rows have a date in this column?
+        self.dates = {}
+        num_columns = len(self.columns)
+        for i, column in enumerate(self.columns):
+            values = [row[i] for row in rows if row[i] is not None]
+            self.arrays_of_strings[column] = _arrays_of_strings(
+                [value for value in values if value != ""], self.first_rows
+            )
+            self.dates[column] = any(
+                row[num_columns + i] for row in rows[: self.first_rows]
+            )
+
+
+def _arrays_of_strings(values, first_rows):
+    arrays = []
+    for value in values:
+        if not isinstance(value, str):
+            return False
+        try:
+            array = json.loads(value)
+        except ValueError:
+            return False
+        if not isinstance(array, list):
+            return False
+        if array:
+            arrays.append(array)
+    first_arrays = arrays[:first_rows]
+    return bool(first_arrays) and all(
+        isinstance(item, str) for array in first_arrays for item in array
+    )
+
+
 class ColumnFacet(Facet):
     type = "column"
+    # Requests for this many column facets count them all using a single
+    # query, rather than running a GROUP BY query for each column:
+    single_scan_min_columns = 2
+    # Facets that time out are estimated from a sample of rows spread
+    # across the table, if they are against a table with a rowid. The estimate gets one
+    # facet_time_limit_ms in total, and samples as many rows as should be
+    # read in the time left at this many rows per millisecond:
+    approximate_rows_per_ms = 100
 
     async def suggest(self):
-        row_count = await self.get_row_count()
         columns = await self.get_columns(self.sql, self.params)
         facet_size = self.get_facet_size()
         suggested_facets = []
         already_enabled = [c["config"]["simple"] for c in self.get_configs()]
+        sample = None
         for column in columns:
             if column in already_enabled:
                 continue
-            suggested_facet_sql = """
-                with limited as (select * from ({sql}) limit {suggest_consider})
-                select {column} as value, count(*) as n from limited
-                where value is not null
-                group by value
-                limit {limit}
-            """.format(
-                column=escape_sqlite(column),
-                sql=self.sql,
-                limit=facet_size + 1,
-                suggest_consider=self.suggest_consider,
-            )
-            distinct_values = None
-            try:
-                distinct_values = await self.ds.execute(
-                    self.database,
-                    suggested_facet_sql,
-                    self.params,
-                    truncate=False,
-                    custom_time_limit=self.ds.setting("facet_suggest_time_limit_ms"),
-                )
-                num_distinct_values = len(distinct_values)
+            stats = self.get_column_stats(column)
+            if stats is not None:
+                # Decide using statistics for the whole table
                 if (
-                    1 < num_distinct_values < row_count
-                    and num_distinct_values <= facet_size
-                    # And at least one has n > 1
-                    and any(r["n"] > 1 for r in distinct_values)
+                    1 < stats["distinct"] <= facet_size
+                    and stats.get("top")
+                    and stats["top"][0][1] > 1
                 ):
-                    suggested_facets.append(
-                        {
-                            "name": column,
-                            "toggle_url": self.ds.absolute_url(
-                                self.request,
-                                self.ds.urls.path(
-                                    path_with_added_args(
-                                        self.request, {"_facet": column}
-                                    )
-                                ),
-                            ),
-                        }
-                    )
-            except QueryInterrupted:
+                    suggested_facets.append(self._suggestion(column))
                 continue
+            if sample is None:
+                sample = await self.get_sample()
+                if sample is None:
+                    break
+            row_count = self.row_count
+            if row_count is None:
+                row_count = sample.row_count
+            num_distinct_values = sample.distinct[column]
+            if (
+                1 < num_distinct_values < row_count
+                and num_distinct_values <= facet_size
+                # And at least one value appears more than once
+                and sample.repeated[column]
+            ):
+                suggested_facets.append(self._suggestion(column))
         return suggested_facets
 
-    async def get_row_count(self):
-        if self.row_count is None:
-            self.row_count = (
-                await self.ds.execute(
-                    self.database,
-                    f"select count(*) from (select * from ({self.sql}) limit {self.suggest_consider})",
-                    self.params,
-                )
-            ).rows[0][0]
-        return self.row_count
+    def _suggestion(self, column):
+        return {
+            "name": column,
+            "toggle_url": self.ds.absolute_url(
+                self.request,
+                self.ds.urls.path(
+                    path_with_added_args(self.request, {"_facet": column})
+                ),
+            ),
+        }
 
     async def facet_results(self):
         facet_results = []
@@ -223,158 +391,294 @@ class ColumnFacet(Facet):
         qs_pairs = self.get_querystring_pairs()
 
         facet_size = self.get_facet_size()
-        for source_and_config in self.get_configs():
+        configs = self.get_configs()
+        all_facet_rows, timed_out = await self._facet_rows_for_columns(
+            [
+                config["config"].get("column") or config["config"]["simple"]
+                for config in configs
+            ],
+            facet_size,
+            self.sql,
+        )
+        approximate = {}
+        if timed_out:
+            approximate = await self._approximate_facet_rows(timed_out, facet_size)
+            all_facet_rows.update(approximate)
+        for source_and_config in configs:
             config = source_and_config["config"]
             source = source_and_config["source"]
             column = config.get("column") or config["simple"]
+            facet_rows = all_facet_rows.get(column)
+            if facet_rows is None:
+                facets_timed_out.append(column)
+                continue
+            facet_results_values = []
+            facet_results.append(
+                {
+                    "name": column,
+                    "type": self.type,
+                    "hideable": source != "metadata",
+                    "toggle_url": self.ds.urls.path(
+                        path_with_removed_args(self.request, {"_facet": column})
+                    ),
+                    "results": facet_results_values,
+                    "truncated": len(facet_rows) > facet_size,
+                }
+            )
+            if column in approximate:
+                facet_results[-1]["approximate"] = True
+            facet_rows = facet_rows[:facet_size]
+            if self.table:
+                # Attempt to expand foreign keys into labels
+                values = [row["value"] for row in facet_rows]
+                expanded = await self.ds.expand_foreign_keys(
+                    self.request.actor, self.database, self.table, column, values
+                )
+            else:
+                expanded = {}
+            for row in facet_rows:
+                column_qs = column
+                if column.startswith("_"):
+                    column_qs = "{}__exact".format(column)
+                selected = (column_qs, str(row["value"])) in qs_pairs
+                if selected:
+                    toggle_path = path_with_removed_args(
+                        self.request, {column_qs: str(row["value"])}
+                    )
+                else:
+                    toggle_path = path_with_added_args(
+                        self.request, {column_qs: row["value"]}
+                    )
+                facet_results_values.append(
+                    {
+                        "value": row["value"],
+                        "label": expanded.get((column, row["value"]), row["value"]),
+                        "count": row["count"],
+                        "toggle_url": self.ds.absolute_url(
+                            self.request, self.ds.urls.path(toggle_path)
+                        ),
+                        "selected": selected,
+                    }
+                )
+
+        return facet_results, facets_timed_out
+
+    def _facet_rows_from_stats(self, column):
+        # Only possible if the most common values include every value
+        stats = self.get_column_stats(column)
+        if stats is None or len(stats.get("top") or []) != stats["distinct"]:
+            return None
+        return [{"value": value, "count": count} for value, count in stats["top"]]
+
+    async def _facet_rows_for_columns(self, columns, facet_size, sql, deadline=None):
+        """Returns ({column: facet_rows}, timed_out_columns) for facets
+        against sql, using precomputed facets or inspect statistics where
+        possible. Two or more other columns are counted using a single
+        query. Each column gets its own GROUP BY query if there is only one,
+        or if that single query fails or times out - so that only the facets
+        that are actually slow are reported as timed out.
+
+        All of the queries share a single deadline, facet_time_limit_ms
+        from now unless deadline is given. The single query gets half of
+        the time, leaving the rest for the per-column queries if it times
+        out."""
+        if deadline is None:
+            deadline = (
+                time.perf_counter() + self.ds.setting("facet_time_limit_ms") / 1000
+            )
+        facet_rows = {}
+        to_query = []
+        for column in columns:
+            if column in facet_rows or column in to_query:
+                continue
+            rows = self.get_precomputed_facet_rows(column, facet_size)
+            if rows is None:
+                rows = self._facet_rows_from_stats(column)
+            if rows is not None:
+                facet_rows[column] = rows
+            else:
+                to_query.append(column)
+        time_limit_ms = (self._facet_time_limit_ms(deadline) or 0) // 2
+        if len(to_query) >= self.single_scan_min_columns and time_limit_ms:
+            try:
+                facet_rows.update(
+                    await self._facet_rows_single_scan(
+                        to_query, facet_size, sql, time_limit_ms
+                    )
+                )
+                return facet_rows, []
+            except (QueryInterrupted, sqlite3.DatabaseError):
+                # For example a column that does not exist, which the
+                # per-column queries report in the usual way
+                pass
+        timed_out = []
+        for column in to_query:
+            time_limit_ms = self._facet_time_limit_ms(deadline)
+            if time_limit_ms is None:
+                timed_out.append(column)
+                continue
             facet_sql = """
                 select {col} as value, count(*) as count from (
                     {sql}
                 )
                 where {col} is not null
                 group by {col} order by count desc, value limit {limit}
-            """.format(col=escape_sqlite(column), sql=self.sql, limit=facet_size + 1)
+            """.format(col=escape_sqlite(column), sql=sql, limit=facet_size + 1)
             try:
-                facet_rows_results = await self.ds.execute(
+                facet_rows[column] = (
+                    await self.ds.execute(
+                        self.database,
+                        facet_sql,
+                        self.params,
+                        truncate=False,
+                        custom_time_limit=time_limit_ms,
+                    )
+                ).rows
+            except QueryInterrupted:
+                timed_out.append(column)
+        return facet_rows, timed_out
+
+    def _facet_time_limit_ms(self, deadline):
+        # None if the deadline has already passed
+        remaining_ms = int((deadline - time.perf_counter()) * 1000)
+        return remaining_ms if remaining_ms >= 1 else None
+
+    async def _approximate_facet_rows(self, columns, facet_size):
+        """Estimates the facets for columns whose exact counts timed out,
+        using a sample of rowids spread across the table. Returns
+        {column: facet_rows} for the columns that could be estimated in
+        time."""
+        deadline = time.perf_counter() + self.ds.setting("facet_time_limit_ms") / 1000
+        sampled = await self._rowid_sample_sql(deadline)
+        if sampled is None:
+            return {}
+        sql, scale = sampled
+        facet_rows, _ = await self._facet_rows_for_columns(
+            columns, facet_size, sql, deadline
+        )
+        return {
+            column: [
+                {"value": row["value"], "count": row["count"] * scale} for row in rows
+            ]
+            for column, rows in facet_rows.items()
+        }
+
+    async def _rowid_sample_sql(self, deadline):
+        # Returns (sql, scale) - self.sql restricted to a sample of rowids
+        # spread across the table, sized to the time left before deadline,
+        # and the number of rows each sampled row stands for. Returns None
+        # for SQL that is not against a table with a rowid, for small tables
+        # or if there is no time left.
+        if not self.table:
+            return None
+        time_limit_ms = self._facet_time_limit_ms(deadline)
+        if time_limit_ms is None:
+            return None
+        table = escape_sqlite(self.table)
+        try:
+            first, last = (
+                await self.ds.execute(
                     self.database,
-                    facet_sql,
-                    self.params,
-                    truncate=False,
-                    custom_time_limit=self.ds.setting("facet_time_limit_ms"),
+                    "select (select min(rowid) from {table}), "
+                    "(select max(rowid) from {table})".format(table=table),
+                    custom_time_limit=time_limit_ms,
+                    log_sql_errors=False,
                 )
-                facet_results_values = []
-                facet_results.append(
-                    {
-                        "name": column,
-                        "type": self.type,
-                        "hideable": source != "metadata",
-                        "toggle_url": self.ds.urls.path(
-                            path_with_removed_args(self.request, {"_facet": column})
-                        ),
-                        "results": facet_results_values,
-                        "truncated": len(facet_rows_results) > facet_size,
-                    }
+            ).rows[0]
+        except (QueryInterrupted, sqlite3.OperationalError):
+            # Views and WITHOUT ROWID tables do not have a rowid
+            return None
+        time_limit_ms = self._facet_time_limit_ms(deadline)
+        if first is None or time_limit_ms is None:
+            return None
+        sample_size = max(time_limit_ms * self.approximate_rows_per_ms, 1)
+        stride = -(-(last - first + 1) // sample_size)
+        if stride < 2:
+            return None
+        # One random rowid from each block of stride rowids, so that values
+        # repeating every few rows cannot line up with the sample. A CTE with
+        # the same name as the table takes its place in self.sql, so the
+        # facet queries only see the sampled rows.
+        return (
+            "with recursive _sampled_rowids(n) as ("
+            "select {first} union all select n + {stride} from _sampled_rowids "
+            "where n + {stride} <= {last}), "
+            "{table} as (select rowid, * from main.{table} "
+            "where rowid in (select n + abs(random() % {stride}) "
+            "from _sampled_rowids)) "
+            "select * from ({sql})"
+        ).format(
+            first=first, stride=stride, last=last, table=table, sql=self.sql
+        ), stride
+
+    async def _facet_rows_single_scan(self, columns, facet_size, sql, time_limit_ms):
+        # A single query returning the facet rows for every column: a
+        # GROUP BY for each column, combined using UNION ALL. SQLite
+        # materializes a CTE used more than once, so sql is only run once.
+        # Each column keeps its own collation, as with per-column queries,
+        # by ranking its rows with a window function that uses it.
+        facet_sql = (
+            "with facet_source as (select {} from ({}))\n{}\n"
+            "order by facet_index, facet_rank"
+        ).format(
+            ", ".join(escape_sqlite(column) for column in columns),
+            sql,
+            "\nunion all\n".join(
+                "select {index} as facet_index, value, count, facet_rank from ("
+                "select {col} as value, count(*) as count, "
+                "row_number() over (order by count(*) desc, {col}) as facet_rank "
+                "from facet_source where {col} is not null "
+                "group by {col} order by count desc, value limit {limit})".format(
+                    index=index, col=escape_sqlite(column), limit=facet_size + 1
                 )
-                facet_rows = facet_rows_results.rows[:facet_size]
-                if self.table:
-                    # Attempt to expand foreign keys into labels
-                    values = [row["value"] for row in facet_rows]
-                    expanded = await self.ds.expand_foreign_keys(
-                        self.request.actor, self.database, self.table, column, values
-                    )
-                else:
-                    expanded = {}
-                for row in facet_rows:
-                    column_qs = column
-                    if column.startswith("_"):
-                        column_qs = "{}__exact".format(column)
-                    selected = (column_qs, str(row["value"])) in qs_pairs
-                    if selected:
-                        toggle_path = path_with_removed_args(
-                            self.request, {column_qs: str(row["value"])}
-                        )
-                    else:
-                        toggle_path = path_with_added_args(
-                            self.request, {column_qs: row["value"]}
-                        )
-                    facet_results_values.append(
-                        {
-                            "value": row["value"],
-                            "label": expanded.get((column, row["value"]), row["value"]),
-                            "count": row["count"],
-                            "toggle_url": self.ds.absolute_url(
-                                self.request, self.ds.urls.path(toggle_path)
-                            ),
-                            "selected": selected,
-                        }
-                    )
-            except QueryInterrupted:
-                facets_timed_out.append(column)
-
-        return facet_results, facets_timed_out
+                for index, column in enumerate(columns)
+            ),
+        )
+        results = await self.ds.execute(
+            self.database,
+            facet_sql,
+            self.params,
+            truncate=False,
+            custom_time_limit=time_limit_ms,
+            log_sql_errors=False,
+        )
+        facet_rows = {column: [] for column in columns}
+        for row in results.rows:
+            facet_rows[columns[row["facet_index"]]].append(
+                {"value": row["value"], "count": row["count"]}
+            )
+        return facet_rows
 
 
 class ArrayFacet(Facet):
     type = "array"
 
-    def _is_json_array_of_strings(self, json_string):
-        try:
-            array = json.loads(json_string)
-        except ValueError:
-            return False
-        for item in array:
-            if not isinstance(item, str):
-                return False
-        return True
-
     async def suggest(self):
-        columns = await self.get_columns(self.sql, self.params)
+        sample = await self.get_sample()
+        if sample is None:
+            return []
         suggested_facets = []
         already_enabled = [c["config"]["simple"] for c in self.get_configs()]
-        for column in columns:
+        for column in sample.columns:
             if column in already_enabled:
                 continue
-            # Is every value in this column either null or a JSON array?
-            suggested_facet_sql = """
-                with limited as (select * from ({sql}) limit {suggest_consider})
-                select distinct json_type({column})
-                from limited
-                where {column} is not null and {column} != ''
-            """.format(
-                column=escape_sqlite(column),
-                sql=self.sql,
-                suggest_consider=self.suggest_consider,
-            )
-            try:
-                results = await self.ds.execute(
-                    self.database,
-                    suggested_facet_sql,
-                    self.params,
-                    truncate=False,
-                    custom_time_limit=self.ds.setting("facet_suggest_time_limit_ms"),
-                    log_sql_errors=False,
-                )
-                types = tuple(r[0] for r in results.rows)
-                if types in (("array",), ("array", None)):
-                    # Now check that first 100 arrays contain only strings
-                    first_100 = [
-                        v[0]
-                        for v in await self.ds.execute(
-                            self.database,
-                            (
-                                "select {column} from ({sql}) "
-                                "where {column} is not null "
-                                "and {column} != '' "
-                                "and json_array_length({column}) > 0 "
-                                "limit 100"
-                            ).format(column=escape_sqlite(column), sql=self.sql),
-                            self.params,
-                            truncate=False,
-                            custom_time_limit=self.ds.setting(
-                                "facet_suggest_time_limit_ms"
+            # Is every value in this column either null or a JSON array,
+            # and are the first 100 non-empty arrays all arrays of strings?
+            if sample.arrays_of_strings[column]:
+                suggested_facets.append(
+                    {
+                        "name": column,
+                        "type": "array",
+                        "toggle_url": self.ds.absolute_url(
+                            self.request,
+                            self.ds.urls.path(
+                                path_with_added_args(
+                                    self.request, {"_facet_array": column}
+                                )
                             ),
-                            log_sql_errors=False,
-                        )
-                    ]
-                    if first_100 and all(
-                        self._is_json_array_of_strings(r) for r in first_100
-                    ):
-                        suggested_facets.append(
-                            {
-                                "name": column,
-                                "type": "array",
-                                "toggle_url": self.ds.absolute_url(
-                                    self.request,
-                                    self.ds.urls.path(
-                                        path_with_added_args(
-                                            self.request, {"_facet_array": column}
-                                        )
-                                    ),
-                                ),
-                            }
-                        )
-            except (QueryInterrupted, sqlite3.OperationalError):
-                continue
+                        ),
+                    }
+                )
         return suggested_facets
 
     async def facet_results(self):
@@ -383,35 +687,53 @@ class ArrayFacet(Facet):
         facets_timed_out = []
 
         facet_size = self.get_facet_size()
+        array_indexes = {}
+        if self.table:
+            array_indexes = await self.ds.get_database(self.database).array_indexes(
+                self.table
+            )
         for source_and_config in self.get_configs():
             config = source_and_config["config"]
             source = source_and_config["source"]
             column = config.get("column") or config["simple"]
-            # https://github.com/simonw/datasette/issues/448
-            facet_sql = """
-                with inner as ({sql}),
-                deduped_array_items as (
+            facet_sql = None
+            if column in array_indexes:
+                facet_sql = self._indexed_facet_sql(
+                    array_indexes[column], facet_size + 1
+                )
+            if facet_sql is None:
+                # Each array is only counted once per row, so only the row
+                # number and the array are needed for the distinct step
+                # https://github.com/simonw/datasette/issues/448
+                facet_sql = """
+                    with inner as (
+                        select
+                            row_number() over () as row_number,
+                            {col} as array_value
+                        from ({sql})
+                    ),
+                    deduped_array_items as (
+                        select
+                            distinct j.value,
+                            inner.row_number
+                        from
+                            json_each([inner].array_value) j
+                            join inner
+                    )
                     select
-                        distinct j.value,
-                        inner.*
+                        value as value,
+                        count(*) as count
                     from
-                        json_each([inner].{col}) j
-                        join inner
+                        deduped_array_items
+                    group by
+                        value
+                    order by
+                        count(*) desc, value limit {limit}
+                """.format(
+                    col=escape_sqlite(column),
+                    sql=self.sql,
+                    limit=facet_size + 1,
                 )
-                select
-                    value as value,
-                    count(*) as count
-                from
-                    deduped_array_items
-                group by
-                    value
-                order by
-                    count(*) desc, value limit {limit}
-            """.format(
-                col=escape_sqlite(column),
-                sql=self.sql,
-                limit=facet_size + 1,
-            )
             try:
                 facet_rows_results = await self.ds.execute(
                     self.database,
@@ -464,50 +786,53 @@ class ArrayFacet(Facet):
 
         return facet_results, facets_timed_out
 
+    def _indexed_facet_sql(self, index_table, limit):
+        # Counts values from the table created by Database.sync_array_indexes(),
+        # for the rows of the table matched by self.sql. Returns None if
+        # self.sql is not a filtered select against the table.
+        table = escape_sqlite(self.table)
+        _, from_table, where = self.sql.partition(" from {} ".format(table))
+        if not from_table or (where.strip() and not where.startswith("where ")):
+            return None
+        rowids = ""
+        if where.strip():
+            rowids = "where source_rowid in (select {table}.rowid from {table} {where})".format(
+                table=table, where=where
+            )
+        return (
+            "select value, count(*) as count from {index_table} {rowids} "
+            "group by value order by count desc, value limit {limit}"
+        ).format(index_table=escape_sqlite(index_table), rowids=rowids, limit=limit)
+
 
 class DateFacet(Facet):
     type = "date"
 
     async def suggest(self):
-        columns = await self.get_columns(self.sql, self.params)
+        sample = await self.get_sample()
+        if sample is None:
+            return []
         already_enabled = [c["config"]["simple"] for c in self.get_configs()]
         suggested_facets = []
-        for column in columns:
+        for column in sample.columns:
             if column in already_enabled:
                 continue
             # Does this column contain any dates in the first 100 rows?
-            suggested_facet_sql = """
-                select date({column}) from (
-                    select * from ({sql}) limit 100
-                ) where {column} glob "????-??-*"
-            """.format(column=escape_sqlite(column), sql=self.sql)
-            try:
-                results = await self.ds.execute(
-                    self.database,
-                    suggested_facet_sql,
-                    self.params,
-                    truncate=False,
-                    custom_time_limit=self.ds.setting("facet_suggest_time_limit_ms"),
-                    log_sql_errors=False,
-                )
-                values = tuple(r[0] for r in results.rows)
-                if any(values):
-                    suggested_facets.append(
-                        {
-                            "name": column,
-                            "type": "date",
-                            "toggle_url": self.ds.absolute_url(
-                                self.request,
-                                self.ds.urls.path(
-                                    path_with_added_args(
-                                        self.request, {"_facet_date": column}
-                                    )
-                                ),
+            if sample.dates[column]:
+                suggested_facets.append(
+                    {
+                        "name": column,
+                        "type": "date",
+                        "toggle_url": self.ds.absolute_url(
+                            self.request,
+                            self.ds.urls.path(
+                                path_with_added_args(
+                                    self.request, {"_facet_date": column}
+                                )
                             ),
-                        }
-                    )
-            except (QueryInterrupted, sqlite3.OperationalError):
-                continue
+                        ),
+                    }
+                )
         return suggested_facets
 
     async def facet_results(self):
@@ -528,13 +853,17 @@ class DateFacet(Facet):
                 group by date({col}) order by count desc, value limit {limit}
             """.format(col=escape_sqlite(column), sql=self.sql, limit=facet_size + 1)
             try:
-                facet_rows_results = await self.ds.execute(
-                    self.database,
-                    facet_sql,
-                    self.params,
-                    truncate=False,
-                    custom_time_limit=self.ds.setting("facet_time_limit_ms"),
-                )
+                facet_rows_results = self.get_precomputed_facet_rows(column, facet_size)
+                if facet_rows_results is None:
+                    facet_rows_results = (
+                        await self.ds.execute(
+                            self.database,
+                            facet_sql,
+                            self.params,
+                            truncate=False,
+                            custom_time_limit=self.ds.setting("facet_time_limit_ms"),
+                        )
+                    ).rows
                 facet_results_values = []
                 facet_results.append(
                     {
@@ -548,7 +877,7 @@ class DateFacet(Facet):
                         "truncated": len(facet_rows_results) > facet_size,
                     }
                 )
-                facet_rows = facet_rows_results.rows[:facet_size]
+                facet_rows = facet_rows_results[:facet_size]
                 for row in facet_rows:
                     selected = str(args.get(f"{column}__date")) == str(row["value"])
                     if selected:
@@ -223,6 +223,24 @@ class TemplatedFilter(Filter):
             return template.format(c=column, v=value)
 
 
+class ArrayFilter(TemplatedFilter):
+    # Uses indexed_sql_template if the column has a table created by
+    # Database.sync_array_indexes(), in place of parsing the JSON
+    def __init__(
+        self, key, display, sql_template, indexed_sql_template, human_template
+    ):
+        super().__init__(key, display, sql_template, human_template)
+        self.indexed_sql_template = indexed_sql_template
+
+    def where_clause(self, table, column, value, param_counter, index_table=None):
+        sql, converted = super().where_clause(table, column, value, param_counter)
+        if index_table is not None:
+            sql = self.indexed_sql_template.format(
+                t=table, i=index_table, p=f"p{param_counter}"
+            )
+        return sql, converted
+
+
 class InFilter(Filter):
     key = "in"
     display = "in"
@@ -319,16 +337,18 @@ class Filters:
         ]
         + (
             [
-                TemplatedFilter(
+                ArrayFilter(
                     "arraycontains",
                     "array contains",
                     """:{p} in (select value from json_each([{t}].[{c}]))""",
+                    """[{t}].rowid in (select source_rowid from [{i}] where value = :{p})""",
                     '{c} contains "{v}"',
                 ),
-                TemplatedFilter(
+                ArrayFilter(
                     "arraynotcontains",
                     "array does not contain",
                     """:{p} not in (select value from json_each([{t}].[{c}]))""",
+                    """[{t}].rowid not in (select source_rowid from [{i}] where value = :{p})""",
                     '{c} does not contain "{v}"',
                 ),
             ]
@@ -367,8 +387,10 @@ class Filters:
     )
     _filters_by_key = {f.key: f for f in _filters}
 
-    def __init__(self, pairs):
+    def __init__(self, pairs, array_indexes=None):
         self.pairs = pairs
+        # {column: index_table} from Database.array_indexes()
+        self.array_indexes = array_indexes or {}
 
     def lookups(self):
         """Yields (lookup, display, no_argument) pairs"""
@@ -415,7 +437,12 @@ class Filters:
         for column, lookup, value in self.selections():
             filter = self._filters_by_key.get(lookup, None)
             if filter:
-                sql_bit, param = filter.where_clause(table, column, value, i)
+                if isinstance(filter, ArrayFilter) and column in self.array_indexes:
+                    sql_bit, param = filter.where_clause(
+                        table, column, value, i, self.array_indexes[column]
+                    )
+                else:
+                    sql_bit, param = filter.where_clause(table, column, value, i)
                 sql_bits.append(sql_bit)
                 if param is not None:
                     if not isinstance(param, list):
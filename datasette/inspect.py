@@ -1,4 +1,7 @@
 import hashlib
+import json
+import os
+from pathlib import Path
 
 from .utils import (
     detect_spatialite,
@@ -9,8 +12,18 @@ from .utils import (
     table_columns,
     sqlite3,
 )
+from .utils.sqlite import is_text_decode_error
 
 HASH_BLOCK_SIZE = 1024 * 1024
+FINGERPRINT_SAMPLES = 16
+# Most common values recorded for each column by inspect_column_stats()
+INSPECT_TOP_K = 50
+# Columns summarized by each query in inspect_column_stats()
+_STATS_COLUMNS_PER_QUERY = 100
+# Values recorded for each facet by inspect_facets()
+INSPECT_FACET_LIMIT = 1000
+# SQL expressions counted by inspect_facets(), for each type of facet
+_FACET_EXPRESSIONS = {"column": "{column}", "date": "date({column})"}
 
 
 def inspect_hash(path):
@@ -26,6 +39,75 @@ def inspect_hash(path):
     return m.hexdigest()
 
 
+def hash_sidecar_path(path):
+    return "{}.datasette-hash.json".format(path)
+
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return {"inode": stat.st_ino, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def read_hash_sidecar(path):
+    """Return the hash recorded next to a database file, if it is still valid."""
+    try:
+        with open(hash_sidecar_path(path)) as fp:
+            data = json.load(fp)
+        if not isinstance(data, dict) or data.get("stat") != _stat_key(path):
+            return None
+    except (OSError, ValueError):
+        return None
+    return data.get("hash")
+
+
+def inspect_hash_with_sidecar(path):
+    """Calculate the hash of a database, recording it in a sidecar file.
+
+    The sidecar is keyed on the inode, size and modification time of the
+    file, so a later call for the same unchanged file can skip reading it.
+    """
+    path = str(path)
+    stat_key = _stat_key(path)
+    hash_value = inspect_hash(Path(path))
+    if _stat_key(path) == stat_key:
+        try:
+            with open(hash_sidecar_path(path), "w") as fp:
+                json.dump({"stat": stat_key, "hash": hash_value}, fp)
+        except OSError:
+            # The directory might be read-only
+            pass
+    return hash_value
+
+
+def inspect_fingerprint(path, samples=FINGERPRINT_SAMPLES):
+    """A cheap fingerprint of a database file.
+
+    Combines the size and modification time of the file with a sample of
+    its pages, evenly spaced through the file and including the first and
+    last pages.
+    """
+    stat = os.stat(path)
+    m = hashlib.sha256("{}:{}".format(stat.st_size, stat.st_mtime_ns).encode("ascii"))
+    with open(path, "rb") as fp:
+        header = fp.read(100)
+        m.update(header)
+        page_size = 4096
+        if len(header) >= 18:
+            page_size = int.from_bytes(header[16:18], "big")
+            if page_size == 1:
+                page_size = 65536
+            elif page_size < 512:
+                page_size = 4096
+        num_pages = max(1, -(-stat.st_size // page_size))
+        page_numbers = sorted(
+            {i * (num_pages - 1) // max(1, samples - 1) for i in range(samples)}
+        )
+        for page_number in page_numbers:
+            fp.seek(page_number * page_size)
+            m.update(fp.read(page_size))
+    return m.hexdigest()
+
+
 def inspect_views(conn):
     """List views in a database."""
     return [
@@ -43,16 +125,7 @@ def inspect_tables(conn, database_metadata):
 
     for table in table_names:
         table_metadata = database_metadata.get("tables", {}).get(table, {})
-
-        try:
-            count = conn.execute(
-                f"select count(*) from {escape_sqlite(table)}"
-            ).fetchone()[0]
-        except sqlite3.OperationalError:
-            # This can happen when running against a FTS virtual table
-            # e.g. "select count(*) from some_fts;"
-            count = 0
-
+        count = inspect_count(conn, table)
         column_names = table_columns(conn, table)
 
         tables[table] = {
@@ -102,3 +175,145 @@ def inspect_tables(conn, database_metadata):
                 continue
 
     return tables
+
+
+def inspect_count(conn, table):
+    """Count the rows in a table."""
+    try:
+        return conn.execute(f"select count(*) from {escape_sqlite(table)}").fetchone()[
+            0
+        ]
+    except sqlite3.OperationalError:
+        # This can happen when running against a FTS virtual table
+        # e.g. "select count(*) from some_fts;"
+        return 0
+
+
+def inspect_table(conn, table, column_stats=False, top_k=INSPECT_TOP_K, facets=None):
+    """Row count and, optionally, column statistics and facets for a table."""
+    info = {"count": inspect_count(conn, table)}
+    if column_stats:
+        stats = inspect_column_stats(conn, table, top_k)
+        if stats is not None:
+            info["column_stats"] = stats
+    if facets:
+        precomputed = inspect_facets(conn, table, facets)
+        if precomputed:
+            info["facets"] = precomputed
+    return info
+
+
+def inspect_facets(conn, table, facets, limit=INSPECT_FACET_LIMIT):
+    """Facet results for a whole table.
+
+    facets is a list of (type, column) pairs, where type is "column" or
+    "date". Returns {type: {column: {"results": [[value, count], ...],
+    "truncated": bool}}} with up to limit values for each facet, in the
+    same order as facet results. Facets that cannot be calculated, or that
+    have binary values, are skipped.
+    """
+    precomputed = {}
+    table_sql = escape_sqlite(table)
+    for type, column in facets:
+        if type not in _FACET_EXPRESSIONS:
+            continue
+        expression = _FACET_EXPRESSIONS[type].format(column=escape_sqlite(column))
+        try:
+            rows = conn.execute(
+                f"select {expression} as value, count(*) as count "
+                f"from {table_sql} where {expression} is not null "
+                f"group by {expression} order by count desc, value limit ?",
+                [limit + 1],
+            ).fetchall()
+        except sqlite3.OperationalError:
+            continue
+        if any(isinstance(row[0], bytes) for row in rows):
+            continue
+        precomputed.setdefault(type, {})[column] = {
+            "results": [[value, count] for value, count in rows[:limit]],
+            "truncated": len(rows) > limit,
+        }
+    return precomputed
+
+
+def inspect_column_stats(conn, table, top_k=INSPECT_TOP_K):
+    """Statistics for each column in a table.
+
+    Records the number of nulls, the number of distinct values, the minimum
+    and maximum values and the top_k most common values with their counts,
+    ordered in the same way as facet results. The most common values are
+    skipped for columns where every value is different. Returns None if the
+    table cannot be read, e.g. a virtual table using an unavailable module.
+    """
+    columns = table_columns(conn, table)
+    table_sql = escape_sqlite(table)
+    stats = {}
+    try:
+        for start in range(0, max(len(columns), 1), _STATS_COLUMNS_PER_QUERY):
+            chunk = columns[start : start + _STATS_COLUMNS_PER_QUERY]
+            selects = ["count(*)"]
+            for column in chunk:
+                column_sql = escape_sqlite(column)
+                selects.extend(
+                    (
+                        f"count({column_sql})",
+                        f"count(distinct {column_sql})",
+                        f"min({column_sql})",
+                        f"max({column_sql})",
+                    )
+                )
+            row = conn.execute(
+                "select {} from {}".format(", ".join(selects), table_sql)
+            ).fetchone()
+            count = row[0]
+            for i, column in enumerate(chunk):
+                non_null, distinct, min_value, max_value = row[1 + i * 4 : 5 + i * 4]
+                column_stats = {
+                    "nulls": count - non_null,
+                    "distinct": distinct,
+                    "min": _json_value(min_value),
+                    "max": _json_value(max_value),
+                }
+                if 0 < distinct < non_null:
+                    column_sql = escape_sqlite(column)
+                    column_stats["top"] = [
+                        [value, n]
+                        for value, n in conn.execute(
+                            f"select {column_sql} as value, count(*) as count "
+                            f"from {table_sql} where {column_sql} is not null "
+                            "group by value order by count desc, value limit ?",
+                            [top_k],
+                        )
+                        if not isinstance(value, bytes)
+                    ]
+                stats[column] = column_stats
+    except sqlite3.OperationalError:
+        return None
+    return stats
+
+
+def _json_value(value):
+    # Binary values cannot be stored in the JSON inspect file
+    return None if isinstance(value, bytes) else value
+
+
+def inspect_invalid_utf8(conn):
+    """Check if any TEXT value in any table is not valid UTF-8."""
+    table_names = [
+        r[0] for r in conn.execute('select name from sqlite_master where type="table"')
+    ]
+    previous_text_factory = conn.text_factory
+    # The native decoder raises an error on invalid UTF-8
+    conn.text_factory = str
+    try:
+        for table in table_names:
+            try:
+                for _ in conn.execute(f"select * from {escape_sqlite(table)}"):
+                    pass
+            except sqlite3.OperationalError as e:
+                if is_text_decode_error(e):
+                    return True
+                # e.g. a virtual table using a module that is not available
+    finally:
+        conn.text_factory = previous_text_factory
+    return False
@@ -0,0 +1,268 @@
+import asyncio
+import collections
+import threading
+import time
+import urllib.parse
+
+from .utils import tilde_decode
+from .utils.asgi import Request
+
+# Requests using any of these query string parameters are never cached
+BYPASS_PARAMETERS = {"_trace", "_context", "_nocache"}
+
+# Response headers that mean a response is specific to the client
+UNCACHEABLE_HEADERS = {b"set-cookie", b"vary"}
+
+
+class ResponseCache:
+    """Byte-bounded LRU cache of complete HTTP responses.
+
+    Entries are fresh for ttl seconds, then served stale for up to another
+    ttl seconds while a background request refreshes them. Responses larger
+    than a quarter of the budget are not cached.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self.bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        "Returns (response, is_stale), or None if there is no usable entry"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = time.monotonic() - entry.created
+                if age >= 2 * self.ttl:
+                    self._entries.pop(key)
+                    self.bytes -= entry.size
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            is_stale = age >= self.ttl
+            if is_stale:
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+            return entry, is_stale
+
+    def put(self, key, status, headers, body):
+        size = 200 + len(body) + sum(len(k) + len(v) for k, v in headers)
+        if size > self.max_bytes // 4:
+            return
+        entry = _CachedResponse(status, headers, body, size)
+        with self._lock:
+            existing = self._entries.pop(key, None)
+            if existing is not None:
+                self.bytes -= existing.size
+            self._entries[key] = entry
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+
+    def start_refresh(self, key):
+        "Returns True if the caller should refresh this entry"
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "bytes": self.bytes,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class _CachedResponse:
+    def __init__(self, status, headers, body, size):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.size = size
+        self.created = time.monotonic()
+
+    async def asgi_send(self, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status,
+                "headers": self.headers,
+            }
+        )
+        await send({"type": "http.response.body", "body": self.body})
+
+
+class AsgiResponseCache:
+    """
+    Serves anonymous GET requests from datasette.response_cache.
+
+    Requests with cookies, an Authorization header or an actor are passed
+    straight through, as are responses that set cookies. The router flags
+    requests that plugins authenticated in some other way using the dict
+    stored in scope["_datasette_response_cache"], and before a cached
+    response is served the actor_from_request hooks are run to check that
+    the request is anonymous.
+    """
+
+    def __init__(self, app, datasette):
+        self.app = app
+        self.datasette = datasette
+
+    async def __call__(self, scope, receive, send):
+        cache = self.datasette.response_cache
+        key = self.cache_key(scope) if cache is not None else None
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+        cached = cache.get(key)
+        if cached is not None and await self.authenticated(scope, receive):
+            # Plugins may authenticate requests without a cookie or header
+            await self.app(scope, receive, send)
+            return
+        if cached is not None:
+            response, is_stale = cached
+            if is_stale and cache.start_refresh(key):
+                asyncio.ensure_future(self.refresh(cache, key, scope))
+            await response.asgi_send(send)
+            return
+        await self.fetch(cache, key, scope, receive, send)
+
+    def cache_key(self, scope):
+        if scope["type"] != "http" or scope.get("method") != "GET":
+            return None
+        if scope.get("actor"):
+            return None
+        query_string = scope.get("query_string", b"")
+        if query_string and BYPASS_PARAMETERS.intersection(
+            urllib.parse.parse_qs(
+                query_string.decode("latin-1"), keep_blank_values=True
+            )
+        ):
+            return None
+        host = b""
+        for name, value in scope.get("headers") or []:
+            name = name.lower()
+            if name in (b"cookie", b"authorization"):
+                return None
+            if name == b"host":
+                host = value
+        versions = []
+        for name, db in self.databases_for_path(scope):
+            version = db._current_version()
+            if version is None:
+                return None
+            versions.append((name, version))
+        return (
+            scope.get("scheme"),
+            host,
+            scope.get("root_path", ""),
+            scope.get("raw_path") or scope["path"],
+            query_string,
+            tuple(versions),
+        )
+
+    def databases_for_path(self, scope):
+        # Pages under /{database} only depend on that database, other than
+        # _memory when it has the other databases attached
+        databases = self.datasette.databases
+        path = (scope.get("raw_path") or scope["path"].encode("utf-8")).decode(
+            "latin-1"
+        )
+        base_url = self.datasette.setting("base_url")
+        if base_url != "/" and path.startswith(base_url):
+            path = "/" + path[len(base_url) :]
+        route = path.split("/")[1].split(".")[0]
+        if route and route != "-":
+            route = tilde_decode(route)
+            for name, db in databases.items():
+                if db.route == route and not (
+                    self.datasette.crossdb and name == "_memory"
+                ):
+                    return [(name, db)]
+        return list(databases.items())
+
+    async def authenticated(self, scope, receive):
+        actor, token_error = await self.datasette._actor_from_request(
+            Request(scope, receive)
+        )
+        return bool(actor) or token_error is not None
+
+    async def fetch(self, cache, key, scope, receive, send):
+        state = {}
+        scope = dict(scope, _datasette_response_cache=state)
+        status = None
+        headers = []
+        body = []
+        body_size = 0
+        cacheable = True
+
+        async def capturing_send(message):
+            nonlocal status, headers, body_size, cacheable
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers") or [])
+                cacheable = status == 200 and _cacheable_headers(headers)
+            elif message["type"] == "http.response.body" and cacheable:
+                body.append(message.get("body", b""))
+                body_size += len(body[-1])
+                if body_size > cache.max_bytes // 4:
+                    cacheable = False
+                    body.clear()
+                elif not message.get("more_body") and not state.get("uncacheable"):
+                    cache.put(key, status, headers, b"".join(body))
+            if send is not None:
+                await send(message)
+
+        await self.app(scope, receive, capturing_send)
+
+    async def refresh(self, cache, key, scope):
+        async def receive():
+            if not requested:
+                requested.append(True)
+                return {"type": "http.request", "body": b"", "more_body": False}
+            # Never disconnects
+            await asyncio.Future()
+
+        requested = []
+        try:
+            await self.fetch(cache, key, scope, receive, None)
+        except Exception:
+            pass
+        finally:
+            cache.end_refresh(key)
+
+
+def _cacheable_headers(headers):
+    for name, value in headers:
+        name = name.lower()
+        if name in UNCACHEABLE_HEADERS:
+            return False
+        if name == b"cache-control" and (
+            b"no-store" in value.lower() or b"private" in value.lower()
+        ):
+            return False
+    return True
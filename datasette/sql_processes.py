@@ -0,0 +1,159 @@
+"""
+Execute read-only SQL queries in a pool of worker processes.
+
+Used when the num_sql_processes setting is greater than 0. Each worker
+process opens its own read-only (or immutable) connections to database
+files, runs queries under the same time limit as the threaded mode and
+sends back the column names and a list of row tuples, which are turned
+back into sqlite3.Row objects by a thread in the parent process.
+"""
+
+from concurrent import futures
+import glob
+import multiprocessing
+import os
+import threading
+
+from .utils import module_from_path, sqlite_timelimit
+from .utils.sqlite import decode_text_replacing_errors, sqlite3
+
+# Worker process state, populated by _initialize_worker()
+_worker_config = {}
+_worker_connections = {}
+# Datasette._databases_removed for the connections in _worker_connections
+_worker_databases_removed = [0]
+
+_row_builder = threading.local()
+
+
+def create_sql_process_pool(datasette, num_processes):
+    config = {
+        "sqlite_extensions": datasette.sqlite_extensions,
+        "cache_size_kb": datasette.setting("cache_size_kb"),
+        "plugins_dir": datasette.plugins_dir,
+    }
+    return futures.ProcessPoolExecutor(
+        max_workers=num_processes,
+        # Forking a process that is running threads is unsafe
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_initialize_worker,
+        initargs=(config,),
+    )
+
+
+def prepare_connection_needs_datasette():
+    """True if any prepare_connection() plugin hook takes the datasette
+    argument, which is not available in the worker processes"""
+    from .plugins import pm
+
+    return any(
+        "datasette" in hookimpl.argnames
+        for hookimpl in pm.hook.prepare_connection.get_hookimpls()
+    )
+
+
+def _initialize_worker(config):
+    from .plugins import pm
+
+    _worker_config.update(config)
+    if config["plugins_dir"]:
+        for filepath in glob.glob(os.path.join(config["plugins_dir"], "*.py")):
+            if not os.path.isfile(filepath):
+                continue
+            mod = module_from_path(filepath, name=os.path.basename(filepath))
+            try:
+                pm.register(mod)
+            except ValueError:
+                # Plugin already registered
+                pass
+
+
+def _worker_connection(database_name, path, qs):
+    from .plugins import pm
+
+    key = (database_name, path, qs)
+    conn = _worker_connections.get(key)
+    if conn is not None:
+        return conn
+    conn = sqlite3.connect(f"file:{path}{qs}", uri=True)
+    conn.text_factory = decode_text_replacing_errors
+    if _worker_config.get("sqlite_extensions"):
+        conn.enable_load_extension(True)
+        for extension in _worker_config["sqlite_extensions"]:
+            if isinstance(extension, (tuple, list)):
+                ext_path, entrypoint = extension
+                conn.execute("SELECT load_extension(?, ?)", [ext_path, entrypoint])
+            else:
+                conn.execute("SELECT load_extension(?)", [extension])
+    if _worker_config.get("cache_size_kb"):
+        conn.execute(f"PRAGMA cache_size=-{_worker_config['cache_size_kb']}")
+    # There is no Datasette instance in the worker process - queries are
+    # not sent to workers if a plugin needs it
+    pm.hook.prepare_connection(conn=conn, database=database_name, datasette=None)
+    _worker_connections[key] = conn
+    return conn
+
+
+def execute_in_worker(
+    database_name,
+    path,
+    qs,
+    sql,
+    params,
+    time_limit_ms,
+    fetch_limit,
+    databases_removed=0,
+):
+    """Runs in a worker process. Returns (column names, list of row tuples)"""
+    if databases_removed != _worker_databases_removed[0]:
+        # Close connections that may be to databases that were removed,
+        # they are opened again as they are needed
+        for worker_conn in _worker_connections.values():
+            worker_conn.close()
+        _worker_connections.clear()
+        _worker_databases_removed[0] = databases_removed
+    conn = _worker_connection(database_name, path, qs)
+    with sqlite_timelimit(conn, time_limit_ms):
+        cursor = conn.execute(sql, params if params is not None else {})
+        if fetch_limit:
+            rows = cursor.fetchmany(fetch_limit)
+        else:
+            rows = cursor.fetchall()
+    columns = [d[0] for d in cursor.description] if cursor.description else None
+    return columns, rows
+
+
+def inspect_table_in_worker(database_name, path, table, column_stats, top_k, facets):
+    """Runs in a worker process. Returns the inspect data for one table"""
+    from .inspect import inspect_table
+
+    conn = _worker_connection(database_name, path, "?immutable=1")
+    return inspect_table(conn, table, column_stats, top_k, facets)
+
+
+def inspect_invalid_utf8_in_worker(database_name, path):
+    """Runs in a worker process. Returns True if a file has invalid UTF-8"""
+    from .inspect import inspect_invalid_utf8
+
+    conn = _worker_connection(database_name, path, "?immutable=1")
+    return inspect_invalid_utf8(conn)
+
+
+def rows_from_tuples(columns, rows):
+    """Convert worker results into (list of sqlite3.Row, cursor description)"""
+    if columns is None:
+        return rows, None
+    conn = getattr(_row_builder, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(":memory:")
+        _row_builder.conn = conn
+    # sqlite3.Row can only be constructed from a cursor with a matching
+    # description, so run a query that returns the same column names
+    cursor = conn.execute(
+        "select {}".format(
+            ", ".join(
+                'null as "{}"'.format(column.replace('"', '""')) for column in columns
+            )
+        )
+    )
+    return [sqlite3.Row(cursor, row) for row in rows], cursor.description
@@ -3,6 +3,7 @@ import binascii
 from contextlib import contextmanager
 import aiofiles
 import click
+import contextvars
 from collections import OrderedDict, namedtuple, Counter
 import copy
 import dataclasses
@@ -177,6 +178,21 @@ async def await_me_maybe(value: typing.Any) -> typing.Any:
     return value
 
 
+def _start_background_task(coro):
+    # The task must not inherit the context of the request that started it,
+    # or its queries would show up in that request's ?_trace=1 output
+    return contextvars.Context().run(asyncio.ensure_future, coro)
+
+
+def _task_is_running(task):
+    # Tasks left pending by an event loop that has since stopped never finish
+    return (
+        task is not None
+        and not task.done()
+        and task.get_loop() is asyncio.get_running_loop()
+    )
+
+
 def urlsafe_components(token):
     """Splits token on commas and tilde-decodes each component"""
     return [tilde_decode(b) for b in token.split(",")]
@@ -290,6 +306,22 @@ def decode_write_json_rows(rows):
     return [decode_write_json_row(row) for row in rows]
 
 
+# Connections that sqlite_timelimit() interrupts regardless of the time
+# left, see sqlite_interrupt()
+_interrupted_connections = set()
+
+
+def sqlite_interrupt(conn):
+    """Interrupt the statement running on conn, and any statement that
+    runs inside sqlite_timelimit() on it until sqlite_interrupt_reset()"""
+    _interrupted_connections.add(conn)
+    conn.interrupt()
+
+
+def sqlite_interrupt_reset(conn):
+    _interrupted_connections.discard(conn)
+
+
 @contextmanager
 def sqlite_timelimit(conn, ms):
     deadline = time.perf_counter() + (ms / 1000)
@@ -302,7 +334,7 @@ def sqlite_timelimit(conn, ms):
         n = 1
 
     def handler():
-        if time.perf_counter() >= deadline:
+        if time.perf_counter() >= deadline or conn in _interrupted_connections:
             # Returning 1 terminates the query with an error
             return 1
 
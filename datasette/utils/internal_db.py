@@ -1,3 +1,7 @@
+import asyncio
+import json
+import re
+import string
 import textwrap
 
 from sqlite_utils import Database as SQLiteUtilsDatabase
@@ -180,30 +184,76 @@ async def init_internal_db(db):
     await db.execute_write_fn(apply_migrations, transaction=False)
 
 
-async def populate_schema_tables(internal_db, db, schema_version):
+CATALOG_CHILD_TABLES = (
+    "catalog_columns",
+    "catalog_foreign_keys",
+    "catalog_indexes",
+)
+
+
+async def populate_schema_tables(internal_db, db, schema_version, incremental=True):
+    """Record the tables, views, columns, foreign keys and indexes of db in
+    the catalog tables.
+
+    With incremental=True, and if the catalog for db was last populated by
+    this process, only tables whose definition or indexes have changed since
+    then are introspected again and rewritten. Other rows keep their place,
+    so catalog_tables stays in sqlite_master order.
+    """
     database_name = db.name
 
-    tables = (await db.execute("select * from sqlite_master WHERE type = 'table'")).rows
-    views = (await db.execute("select * from sqlite_master WHERE type = 'view'")).rows
+    tables = {}
+    views = {}
+    indexes = {}
+    for row in (
+        await db.execute(
+            "select type, name, tbl_name, rootpage, sql from sqlite_master"
+        )
+    ).rows:
+        if row["type"] == "table":
+            tables[row["name"]] = (row["rootpage"], row["sql"])
+        elif row["type"] == "view":
+            views[row["name"]] = (row["rootpage"], row["sql"])
+        elif row["type"] == "index":
+            indexes.setdefault(row["tbl_name"], []).append((row["name"], row["sql"]))
+    signatures = {
+        ("table", name): (rootpage, sql, tuple(sorted(indexes.get(name, []))))
+        for name, (rootpage, sql) in tables.items()
+    }
+    signatures.update(
+        {("view", name): (rootpage, sql) for name, (rootpage, sql) in views.items()}
+    )
+
+    previous = db._catalog_signatures if incremental else None
+
+    def diff(type_, names):
+        # Returns (new, changed, removed) names of this type
+        if previous is None:
+            return list(names), [], []
+        new = [name for name in names if (type_, name) not in previous]
+        changed = [
+            name
+            for name in names
+            if (type_, name) in previous
+            and previous[(type_, name)] != signatures[(type_, name)]
+        ]
+        removed = [
+            name
+            for (previous_type, name) in previous
+            if previous_type == type_ and name not in names
+        ]
+        return new, changed, removed
+
+    new_tables, changed_tables, removed_tables = diff("table", tables)
+    new_views, changed_views, removed_views = diff("view", views)
+    tables_to_introspect = new_tables + changed_tables
 
     def collect_info(conn):
-        tables_to_insert = []
-        views_to_insert = []
         columns_to_insert = []
         foreign_keys_to_insert = []
         indexes_to_insert = []
 
-        for view in views:
-            view_name = view["name"]
-            views_to_insert.append(
-                (database_name, view_name, view["rootpage"], view["sql"])
-            )
-
-        for table in tables:
-            table_name = table["name"]
-            tables_to_insert.append(
-                (database_name, table_name, table["rootpage"], table["sql"])
-            )
+        for table_name in tables_to_introspect:
             columns = table_column_details(conn, table_name)
             columns_to_insert.extend(
                 {
@@ -233,35 +283,61 @@ async def populate_schema_tables(internal_db, db, schema_version):
                 for index in indexes
             )
         return (
-            tables_to_insert,
-            views_to_insert,
             columns_to_insert,
             foreign_keys_to_insert,
             indexes_to_insert,
         )
 
-    (
-        tables_to_insert,
-        views_to_insert,
-        columns_to_insert,
-        foreign_keys_to_insert,
-        indexes_to_insert,
-    ) = await db.execute_fn(collect_info)
+    if tables_to_introspect:
+        (
+            columns_to_insert,
+            foreign_keys_to_insert,
+            indexes_to_insert,
+        ) = await db.execute_fn(collect_info)
+    else:
+        columns_to_insert = foreign_keys_to_insert = indexes_to_insert = []
 
     def replace_catalog(conn):
         # Delete child rows before their catalog_tables parents so this also
         # works if a prepare_connection plugin enables foreign key enforcement.
-        for table in (
-            "catalog_columns",
-            "catalog_foreign_keys",
-            "catalog_indexes",
-            "catalog_views",
-            "catalog_tables",
-        ):
-            conn.execute(
-                "DELETE FROM {} WHERE database_name = ?".format(table),
-                [database_name],
-            )
+        if previous is None:
+            for table in CATALOG_CHILD_TABLES + ("catalog_views", "catalog_tables"):
+                conn.execute(
+                    "DELETE FROM {} WHERE database_name = ?".format(table),
+                    [database_name],
+                )
+        else:
+            for table in CATALOG_CHILD_TABLES:
+                conn.executemany(
+                    "DELETE FROM {} WHERE database_name = ? AND table_name = ?".format(
+                        table
+                    ),
+                    [
+                        (database_name, name)
+                        for name in new_tables + changed_tables + removed_tables
+                    ],
+                )
+            for table, name_column, removed, changed, definitions in (
+                (
+                    "catalog_tables",
+                    "table_name",
+                    removed_tables,
+                    changed_tables,
+                    tables,
+                ),
+                ("catalog_views", "view_name", removed_views, changed_views, views),
+            ):
+                conn.executemany(
+                    "DELETE FROM {} WHERE database_name = ? AND {} = ?".format(
+                        table, name_column
+                    ),
+                    [(database_name, name) for name in removed],
+                )
+                conn.executemany(
+                    "UPDATE {} SET rootpage = ?, sql = ? "
+                    "WHERE database_name = ? AND {} = ?".format(table, name_column),
+                    [(*definitions[name], database_name, name) for name in changed],
+                )
         conn.execute(
             """
             INSERT OR REPLACE INTO catalog_databases (
@@ -277,17 +353,17 @@ async def populate_schema_tables(internal_db, db, schema_version):
         )
         conn.executemany(
             """
-            INSERT INTO catalog_tables (database_name, table_name, rootpage, sql)
+            INSERT OR REPLACE INTO catalog_tables (database_name, table_name, rootpage, sql)
             values (?, ?, ?, ?)
             """,
-            tables_to_insert,
+            [(database_name, name, *tables[name]) for name in new_tables],
         )
         conn.executemany(
             """
-            INSERT INTO catalog_views (database_name, view_name, rootpage, sql)
+            INSERT OR REPLACE INTO catalog_views (database_name, view_name, rootpage, sql)
             values (?, ?, ?, ?)
             """,
-            views_to_insert,
+            [(database_name, name, *views[name]) for name in new_views],
         )
         conn.executemany(
             """
@@ -320,4 +396,116 @@ async def populate_schema_tables(internal_db, db, schema_version):
             indexes_to_insert,
         )
 
+        # Recorded here rather than after the write returns, so the catalog
+        # and the signatures stay in step even if the caller is cancelled
+        db._catalog_signatures = signatures
+
     await internal_db.execute_write_fn(replace_catalog)
+
+
+_fts_content_re = re.compile(r'content="([^"]*)"|content=\[([^\]]*)\]', re.IGNORECASE)
+# The LIKE patterns used by detect_fts() only ignore the case of ASCII letters
+_ascii_lower = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+async def get_table_details(datasette, dbs):
+    """Columns, primary keys and FTS table for every table in these databases.
+
+    Returns {database_name: {table_name: {"columns": [...], "primary_keys":
+    [...], "fts_table": str or None}}}. These are read from the catalog
+    tables using a fixed number of queries however many tables there are.
+    Databases whose schema has changed since the catalog was last refreshed
+    are introspected directly instead.
+    """
+    internal_db = datasette.get_internal_database()
+    names = json.dumps([db.name for db in dbs])
+    catalog_versions = {
+        row["database_name"]: row["schema_version"]
+        for row in await internal_db.execute(
+            """
+            select database_name, schema_version from catalog_databases
+            where database_name in (select value from json_each(:names))
+            """,
+            {"names": names},
+        )
+    }
+
+    async def is_current(db):
+        if db.name not in catalog_versions:
+            return False
+        if not db.is_mutable and not db.is_memory:
+            # Immutable, so the catalog entry can never be out of date
+            return True
+        schema_version = (await db.execute("PRAGMA schema_version")).first()[0]
+        return schema_version == catalog_versions[db.name]
+
+    # Each database is probed in its own thread, so check them all at once
+    checks = await asyncio.gather(*(is_current(db) for db in dbs))
+    current = [db for db, ok in zip(dbs, checks) if ok]
+    stale = [db for db, ok in zip(dbs, checks) if not ok]
+
+    details = {db.name: {} for db in dbs}
+    current_names = json.dumps([db.name for db in current])
+    fts_tables = {}
+    for row in await internal_db.execute(
+        """
+        select database_name, table_name, sql from catalog_tables
+        where database_name in (select value from json_each(:names))
+        order by rowid
+        """,
+        {"names": current_names},
+    ):
+        details[row["database_name"]][row["table_name"]] = {
+            "columns": [],
+            "primary_keys": [],
+            "fts_table": None,
+        }
+        sql = row["sql"] or ""
+        if re.search(r"VIRTUAL TABLE.*USING FTS", sql, re.IGNORECASE | re.DOTALL):
+            fts_tables.setdefault(row["database_name"], []).append(
+                (row["table_name"], sql)
+            )
+    # Mirrors detect_fts(): an FTS table is used for the table it is named
+    # after, or for its external content= table
+    for database_name, candidates in fts_tables.items():
+        tables = details[database_name]
+        tables_by_name = {
+            table_name.translate(_ascii_lower): table
+            for table_name, table in tables.items()
+        }
+        for fts_name, sql in reversed(candidates):
+            for match in _fts_content_re.finditer(sql):
+                content = (match.group(1) or match.group(2)).translate(_ascii_lower)
+                if content in tables_by_name:
+                    tables_by_name[content]["fts_table"] = fts_name
+            tables[fts_name]["fts_table"] = fts_name
+    primary_keys = {}
+    for row in await internal_db.execute(
+        """
+        select database_name, table_name, name, is_pk from catalog_columns
+        where database_name in (select value from json_each(:names))
+        order by database_name, table_name, cid
+        """,
+        {"names": current_names},
+    ):
+        table = details[row["database_name"]].get(row["table_name"])
+        if table is None:
+            continue
+        table["columns"].append(row["name"])
+        if row["is_pk"]:
+            primary_keys.setdefault(
+                (row["database_name"], row["table_name"]), []
+            ).append((row["is_pk"], row["name"]))
+    for (database_name, table_name), pks in primary_keys.items():
+        details[database_name][table_name]["primary_keys"] = [
+            name for _, name in sorted(pks, key=lambda pk: pk[0])
+        ]
+
+    for db in stale:
+        for table in await db.table_names():
+            details[db.name][table] = {
+                "columns": await db.table_columns(table),
+                "primary_keys": await db.primary_keys(table),
+                "fts_table": await db.fts_table(table),
+            }
+    return details
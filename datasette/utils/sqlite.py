@@ -28,6 +28,20 @@ _VIRTUAL_TABLE_SHADOW_SUFFIXES = {
 }
 
 
+def decode_text_replacing_errors(value):
+    "text_factory that replaces invalid UTF-8 rather than raising an error"
+    return str(value, "utf-8", "replace")
+
+
+def is_text_decode_error(e):
+    "Was this error raised by the native str text_factory on invalid UTF-8?"
+    return (
+        isinstance(e, sqlite3.OperationalError)
+        and bool(e.args)
+        and str(e.args[0]).startswith("Could not decode to UTF-8")
+    )
+
+
 def sqlite_version():
     global _cached_sqlite_version
     if _cached_sqlite_version is None:
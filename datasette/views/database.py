@@ -33,6 +33,7 @@ from datasette.utils import (
     InvalidSql,
 )
 from datasette.utils.asgi import AsgiFileDownload, NotFound, Response, Forbidden
+from datasette.utils.internal_db import get_table_details
 from datasette.plugins import pm
 
 from .base import DatasetteError, View, stream_csv
@@ -55,6 +56,7 @@ class DatabaseTable:
     primary_keys: list[str]
     count: int | None
     count_truncated: bool
+    count_estimate: int | None
     hidden: bool
     fts_table: str | None
     foreign_keys: dict[str, list[dict[str, str]]]
@@ -195,6 +197,7 @@ class DatabaseView(View):
             "size": db.size,
             "tables": [asdict(table) for table in tables],
             "hidden_count": len([table for table in tables if table.hidden]),
+            "table_counts_stale_as_of": db.table_counts_stale_as_of,
             "views": [asdict(view) for view in sql_views],
             "queries": [stored_query_to_dict(query) for query in stored_queries],
             "queries_more": queries_more,
@@ -236,6 +239,7 @@ class DatabaseView(View):
                     size=db.size,
                     tables=tables,
                     hidden_count=len([table for table in tables if table.hidden]),
+                    table_counts_stale_as_of=db.table_counts_stale_as_of,
                     views=sql_views,
                     queries=stored_queries,
                     queries_more=queries_more,
@@ -292,10 +296,15 @@ class DatabaseContext(Context):
     size: int = field(metadata={"help": "The size of the database in bytes"})
     tables: list[DatabaseTable] = field(
         metadata={
-            "help": "List of ``DatabaseTable`` objects describing tables in the database. Each item has ``name``, ``columns``, ``primary_keys``, ``count``, ``count_truncated``, ``hidden``, ``fts_table``, ``foreign_keys`` and ``private`` attributes. ``count_truncated`` is true if ``count`` is a capped lower bound rather than an exact total."
+            "help": "List of ``DatabaseTable`` objects describing tables in the database. Each item has ``name``, ``columns``, ``primary_keys``, ``count``, ``count_truncated``, ``count_estimate``, ``hidden``, ``fts_table``, ``foreign_keys`` and ``private`` attributes. ``count_truncated`` is true if ``count`` is a capped lower bound rather than an exact total, in which case ``count_estimate`` may hold an estimated total from SQLite's table statistics."
         }
     )
     hidden_count: int = field(metadata={"help": "Count of hidden tables"})
+    table_counts_stale_as_of: str | None = field(
+        metadata={
+            "help": "ISO timestamp of when the table counts were calculated, if the database has changed since then and fresh counts are still being calculated"
+        }
+    )
     views: list[DatabaseViewInfo] = field(
         metadata={
             "help": "List of ``DatabaseViewInfo`` objects describing SQLite views in the database. Each item has ``name`` and ``private`` attributes."
@@ -417,7 +426,7 @@ class QueryContext(Context):
     )
     tables: list[DatabaseTable] = field(
         metadata={
-            "help": "List of ``DatabaseTable`` objects describing tables in the database. Each item has ``name``, ``columns``, ``primary_keys``, ``count``, ``count_truncated``, ``hidden``, ``fts_table``, ``foreign_keys`` and ``private`` attributes. ``count_truncated`` is true if ``count`` is a capped lower bound rather than an exact total."
+            "help": "List of ``DatabaseTable`` objects describing tables in the database. Each item has ``name``, ``columns``, ``primary_keys``, ``count``, ``count_truncated``, ``count_estimate``, ``hidden``, ``fts_table``, ``foreign_keys`` and ``private`` attributes. ``count_truncated`` is true if ``count`` is a capped lower bound rather than an exact total, in which case ``count_estimate`` may hold an estimated total from SQLite's table statistics."
         }
     )
     named_parameter_values: dict = field(
@@ -491,26 +500,44 @@ async def get_tables(datasette, request, db, allowed_dict) -> list[DatabaseTable
         allowed_dict: Dict mapping table name -> Resource object with .private attribute
     """
     tables = []
-    table_counts = await db.table_counts(100)
+    table_counts = await db.table_counts(100, allow_stale=True)
     hidden_table_names = set(await db.hidden_table_names())
     all_foreign_keys = await db.get_all_foreign_keys()
+    table_details = (await get_table_details(datasette, [db]))[db.name]
+    count_estimates = None
 
     for table in table_counts:
         if table not in allowed_dict:
             continue
 
-        table_columns = await db.table_columns(table)
+        count_truncated = _table_count_truncated(
+            datasette, db, table, table_counts[table]
+        )
+        count_estimate = None
+        if count_truncated:
+            if count_estimates is None:
+                count_estimates = await db.table_count_estimates()
+            count_estimate = count_estimates.get(table)
+            if count_estimate is not None and count_estimate < table_counts[table]:
+                count_estimate = None
+        details = table_details.get(table)
+        if details is None:
+            # Created since the catalog was read
+            details = {
+                "columns": await db.table_columns(table),
+                "primary_keys": await db.primary_keys(table),
+                "fts_table": await db.fts_table(table),
+            }
         tables.append(
             DatabaseTable(
                 name=table,
-                columns=table_columns,
-                primary_keys=await db.primary_keys(table),
+                columns=details["columns"],
+                primary_keys=details["primary_keys"],
                 count=table_counts[table],
-                count_truncated=_table_count_truncated(
-                    datasette, db, table, table_counts[table]
-                ),
+                count_truncated=count_truncated,
+                count_estimate=count_estimate,
                 hidden=table in hidden_table_names,
-                fts_table=await db.fts_table(table),
+                fts_table=details["fts_table"],
                 foreign_keys=all_foreign_keys[table],
                 private=allowed_dict[table].private,
             )
@@ -522,6 +549,8 @@ async def get_tables(datasette, request, db, allowed_dict) -> list[DatabaseTable
 def _table_count_truncated(datasette, db, table, count):
     if count != db.count_limit + 1:
         return False
+    if table in db.exact_count_tables:
+        return False
     if not db.is_mutable and datasette.inspect_data:
         try:
             datasette.inspect_data[db.name]["tables"][table]["count"]
@@ -555,13 +584,13 @@ async def database_download(request, datasette):
     headers = {}
     if datasette.cors:
         add_cors_headers(headers)
-    if db.hash:
-        etag = '"{}"'.format(db.hash)
-        headers["Etag"] = etag
-        # Has user seen this already?
-        if_none_match = request.headers.get("if-none-match")
-        if if_none_match and if_none_match == etag:
-            return Response("", status=304)
+    # Use the cheaper fingerprint while the hash is being calculated
+    etag = '"{}"'.format(db.hash or db.fingerprint)
+    headers["Etag"] = etag
+    # Has user seen this already?
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and if_none_match == etag:
+        return Response("", status=304)
     headers["Transfer-Encoding"] = "chunked"
     return AsgiFileDownload(
         filepath,
@@ -806,8 +835,10 @@ class QueryView(View):
                     # Stored queries can run magic parameters
                     params_for_query = MagicParameters(sql, params, request, datasette)
                     await params_for_query.execute_params()
-                results = await datasette.execute(
-                    database, sql, params_for_query, truncate=True, **extra_args
+                # Arbitrary SQL can call nondeterministic functions, including
+                # ones registered by plugins, so it skips the result cache
+                results = await db.execute(
+                    sql, params_for_query, truncate=True, use_cache=False, **extra_args
                 )
                 columns = results.columns
                 rows = results.rows
@@ -856,7 +887,7 @@ class QueryView(View):
                 raise DatasetteError("?sql= is required", status=400)
 
             async def fetch_data_for_csv(request, _next=None):
-                results = await db.execute(sql, params, truncate=True)
+                results = await db.execute(sql, params, truncate=True, use_cache=False)
                 data = {"rows": results.rows, "columns": results.columns}
                 return data, None, None
 
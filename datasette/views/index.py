@@ -9,6 +9,7 @@ from datasette.utils import (
     UNSTABLE_API_MESSAGE,
 )
 from datasette.utils.asgi import Response
+from datasette.utils.internal_db import get_table_details
 from datasette.version import __version__
 
 from .base import BaseView
@@ -44,6 +45,11 @@ class IndexView(BaseView):
                 tables_by_db[t.parent] = {}
             tables_by_db[t.parent][t.child] = t
 
+        # Columns, primary keys and FTS tables for every database at once
+        table_details = await get_table_details(
+            self.ds, [self.ds.databases[name] for name in allowed_db_dict]
+        )
+
         databases = []
         # Iterate over allowed databases instead of all databases
         for name in allowed_db_dict.keys():
@@ -72,7 +78,7 @@ class IndexView(BaseView):
             # Perform counts only for immutable or DBS with <= COUNT_TABLE_LIMIT tables
             table_counts = {}
             if not db.is_mutable or db.size < COUNT_DB_SIZE_LIMIT:
-                table_counts = await db.table_counts(10)
+                table_counts = await db.table_counts(10, allow_stale=True)
                 # If any of these are None it means at least one timed out - ignore them all
                 if any(v is None for v in table_counts.values()):
                     table_counts = {}
@@ -83,14 +89,21 @@ class IndexView(BaseView):
                 if table not in allowed_for_db:
                     continue
 
-                table_columns = await db.table_columns(table)
+                details = table_details[name].get(table)
+                if details is None:
+                    # Created since the catalog was read
+                    details = {
+                        "columns": await db.table_columns(table),
+                        "primary_keys": await db.primary_keys(table),
+                        "fts_table": await db.fts_table(table),
+                    }
                 tables[table] = {
                     "name": table,
-                    "columns": table_columns,
-                    "primary_keys": await db.primary_keys(table),
+                    "columns": details["columns"],
+                    "primary_keys": details["primary_keys"],
                     "count": table_counts.get(table),
                     "hidden": table in hidden_table_names,
-                    "fts_table": await db.fts_table(table),
+                    "fts_table": details["fts_table"],
                     "num_relationships_for_sorting": 0,
                     "private": allowed_for_db[table].private,
                 }
@@ -142,6 +155,9 @@ class IndexView(BaseView):
                     "hidden_tables_count": len(hidden_tables),
                     "views_count": len(views),
                     "private": database_private,
+                    "table_counts_stale_as_of": (
+                        db.table_counts_stale_as_of if table_counts else None
+                    ),
                 }
             )
 
@@ -93,6 +93,7 @@ class TableContext(Context):
     all_columns: list = from_extra()
     columns: list = from_extra()
     count: int = from_extra()
+    count_estimate: int = from_extra()
     count_sql: str = from_extra()
     custom_table_templates: list = from_extra()
     database: str = from_extra()
@@ -1874,6 +1875,7 @@ async def table_view_traced(datasette, request):
             all_columns=data["all_columns"],
             columns=data["columns"],
             count=data["count"],
+            count_estimate=data["count_estimate"],
             count_sql=data["count_sql"],
             custom_table_templates=data["custom_table_templates"],
             database=data["database"],
@@ -2041,7 +2043,9 @@ async def table_view_data(
                 filter_args.append((key, v))
 
     # Build where clauses from query string arguments
-    filters = Filters(sorted(filter_args))
+    filters = Filters(
+        sorted(filter_args), array_indexes=await db.array_indexes(table_name)
+    )
     where_clauses, params = filters.build_where_clauses(table_name)
 
     # Execute filters_from_request plugin hooks - including the default
@@ -1,5 +1,6 @@
 import itertools
 from dataclasses import dataclass
+from typing import ClassVar
 
 from datasette.column_types import SQLiteType
 from datasette.database import QueryInterrupted
@@ -9,6 +10,7 @@ from datasette.resources import DatabaseResource, TableResource
 from datasette.utils import (
     await_me_maybe,
     call_with_supported_arguments,
+    escape_sqlite,
     path_with_added_args,
     path_with_format,
     path_with_removed_args,
@@ -127,6 +129,15 @@ class CountExtra(Extra):
             except KeyError:
                 pass
 
+        if (
+            count is None
+            and not context.nocount
+            and context.table_name in context.db.exact_count_tables
+            and context.from_sql.strip()
+            == "from {}".format(escape_sqlite(context.table_name))
+        ):
+            count = (await context.db.exact_counts()).get(context.table_name)
+
         if context.count_sql and count is None and not context.nocount:
             count_sql_limited = "select count(*) from (select * {} limit {})".format(
                 context.from_sql, context.db.count_limit + 1
@@ -144,6 +155,11 @@ class CountExtra(Extra):
 def count_is_truncated(datasette, db, database_name, table_name, count_sql, count):
     if count != db.count_limit + 1:
         return False
+    if (
+        table_name in db.exact_count_tables
+        and count_sql == f"select count(*) from {escape_sqlite(table_name)} "
+    ):
+        return False
     if (
         not db.is_mutable
         and datasette.inspect_data
@@ -174,6 +190,36 @@ class CountTruncatedExtra(Extra):
         )
 
 
+class CountEstimateExtra(Extra):
+    description = (
+        "Estimated total number of rows in the table, from SQLite's table "
+        "statistics. Only provided if the count hit Datasette's counting limit "
+        "and no filters are applied, otherwise null."
+    )
+    example = ExtraExample("/fixtures/facetable.json?_extra=count,count_estimate")
+    scopes: ClassVar[set[ExtraScope]] = {ExtraScope.TABLE}
+
+    async def resolve(self, context, count):
+        if not count_is_truncated(
+            context.datasette,
+            context.db,
+            context.database_name,
+            context.table_name,
+            context.count_sql,
+            count,
+        ):
+            return None
+        if context.is_view or context.from_sql.strip() != "from {}".format(
+            escape_sqlite(context.table_name)
+        ):
+            return None
+        estimate = await context.db.table_count_estimate(context.table_name)
+        if estimate is None or estimate < count:
+            # Out of date statistics can be lower than rows already counted
+            return None
+        return estimate
+
+
 class FacetInstancesProvider(Provider):
     scopes = {ExtraScope.TABLE}
 
@@ -1233,6 +1279,7 @@ TABLE_EXTRA_BUNDLES = {
         "facet_results",
         "facets_timed_out",
         "count",
+        "count_estimate",
         "count_sql",
         "human_description_en",
         "metadata",
@@ -1264,6 +1311,7 @@ TABLE_EXTRA_BUNDLES = {
 TABLE_EXTRA_CLASSES = [
     CountExtra,
     CountTruncatedExtra,
+    CountEstimateExtra,
     CountSqlExtra,
     FacetResultsExtra,
     FacetsTimedOutExtra,
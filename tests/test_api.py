@@ -268,6 +268,7 @@ def test_no_files_uses_memory_database(app_client_no_files):
                 "hidden_tables_count": 0,
                 "views_count": 0,
                 "private": False,
+                "table_counts_stale_as_of": None,
             },
         ],
         "metadata": {},
@@ -599,7 +600,15 @@ async def test_threads_json(ds_client):
         response = await ds_client.get("/-/threads.json", actor={"id": "root"})
     finally:
         ds_client.ds.root_enabled = False
-    expected_keys = {"ok", "threads", "num_threads"}
+    expected_keys = {
+        "ok",
+        "threads",
+        "num_threads",
+        "sql_thread_pools",
+        "query_result_cache",
+        "response_cache",
+        "databases",
+    }
     if sys.version_info >= (3, 7, 0):
         expected_keys.update({"tasks", "num_tasks"})
     data = response.json()
@@ -607,6 +616,16 @@ async def test_threads_json(ds_client):
     # Should be at least one _execute_writes thread for __INTERNAL__
     thread_names = [thread["name"] for thread in data["threads"]]
     assert "_execute_writes for database __INTERNAL__" in thread_names
+    assert set(data["sql_thread_pools"]["default"]) == {
+        "num_threads",
+        "queued",
+        "running",
+        "completed",
+    }
+    assert data["databases"]["fixtures"]["sql_thread_pool"] == "default"
+    assert set(data["databases"]["fixtures"]["read_connections"]).issuperset(
+        {"max_size", "open", "waiting", "hits", "misses", "checkout_ms_avg"}
+    )
 
 
 @pytest.mark.asyncio
@@ -701,7 +720,17 @@ async def test_settings_json(ds_client):
         "suggest_facets": True,
         "default_cache_ttl": 5,
         "num_sql_threads": 1,
+        "max_read_connections": 0,
+        "idle_connection_timeout": 300,
+        "num_sql_processes": 0,
+        "write_batch_size": 1,
+        "write_batch_wait_ms": 0,
         "cache_size_kb": 0,
+        "query_cache_size_kb": 0,
+        "response_cache_size_kb": 0,
+        "response_cache_ttl": 5,
+        "fast_text_decoding": False,
+        "hash_sidecar_files": False,
         "allow_csv_stream": True,
         "max_csv_mb": 100,
         "truncate_cells_html": 2048,
@@ -12,6 +12,7 @@ from datasette.utils.sqlite import sqlite3
 from click.testing import CliRunner
 import io
 import json
+import os
 import pathlib
 import pytest
 import sys
@@ -33,6 +34,20 @@ def test_inspect_cli(app_client):
         "facetable": 15,
     }.items():
         assert expected_count == database["tables"][table_name]["count"]
+    # Only checked with --check-utf8
+    assert "invalid_utf8" not in database
+
+
+def test_inspect_cli_detects_invalid_utf8(tmp_path):
+    db_path = tmp_path / "latin1.db"
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("create table t (id integer primary key, name text)")
+        conn.execute("insert into t (name) values (cast(x'436166e9' as text))")
+    conn.close()
+    result = CliRunner().invoke(cli, ["inspect", str(db_path), "--check-utf8"])
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.output)["latin1"]["invalid_utf8"] is True
 
 
 def test_inspect_cli_counts_all_rows(tmp_path):
@@ -600,3 +615,39 @@ def test_duplicate_database_files_error(tmpdir):
     )
     assert result5.exit_code == 1
     assert "Cannot pass multiple directories" in result5.output
+
+
+def test_inspect_cli_column_stats_in_processes(tmp_path):
+    # Worker processes need a current directory that exists
+    os.chdir(tmp_path)
+    db_paths = []
+    for name in ("one", "two"):
+        db_path = tmp_path / "{}.db".format(name)
+        conn = sqlite3.connect(db_path)
+        with conn:
+            conn.execute("create table t (id integer primary key, tag text)")
+            conn.executemany(
+                "insert into t (tag) values (?)", [("a",), ("a",), ("b",), (None,)]
+            )
+        conn.close()
+        db_paths.append(str(db_path))
+    result = CliRunner().invoke(
+        cli,
+        ["inspect", *db_paths, "--column-stats", "--top-k", "1", "--processes", "2"],
+    )
+    assert result.exit_code == 0, result.output
+    data = json.loads(result.output)
+    assert set(data.keys()) == {"one", "two"}
+    assert data["two"]["tables"]["t"] == {
+        "count": 4,
+        "column_stats": {
+            "id": {"nulls": 0, "distinct": 4, "min": 1, "max": 4},
+            "tag": {
+                "nulls": 1,
+                "distinct": 2,
+                "min": "a",
+                "max": "b",
+                "top": [["a", 2]],
+            },
+        },
+    }
@@ -1,5 +1,5 @@
 from datasette.app import Datasette
-from datasette.database import Database
+from datasette.database import Database, QueryInterrupted
 from datasette.facets import Facet, ColumnFacet, ArrayFacet, DateFacet
 from datasette.utils.asgi import Request
 from datasette.utils import detect_json1
@@ -8,6 +8,24 @@ import json
 import pytest
 
 
+@pytest.fixture
+def log_sql(monkeypatch):
+    "log_sql(db) returns a list that collects the SQL of each db.execute() call"
+
+    def log(db):
+        sqls = []
+        original_execute = db.execute
+
+        async def logging_execute(sql, *args, **kwargs):
+            sqls.append(sql)
+            return await original_execute(sql, *args, **kwargs)
+
+        monkeypatch.setattr(db, "execute", logging_execute)
+        return sqls
+
+    return log
+
+
 @pytest.mark.asyncio
 async def test_column_facet_suggest(ds_client):
     facet = ColumnFacet(
@@ -458,6 +476,135 @@ async def test_array_facet_handle_duplicate_tags():
     }
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(not detect_json1(), reason="Requires the SQLite json1 module")
+async def test_array_facet_uses_array_index(log_sql):
+    plain = Datasette([], memory=True)
+    db = plain.add_database(Database(plain, memory_name="test_array_index"))
+    await db.execute_write("create table otters(name text, tags text)")
+    await db.execute_write_many(
+        "insert into otters (name, tags) values (?, ?)",
+        [
+            ("Charles", '["friendly", "cunning", "friendly"]'),
+            ("Shaun", '["cunning", "empathetic", "friendly"]'),
+            ("Tracy", '["empathetic", "eager"]'),
+            ("Vera", None),
+        ],
+    )
+    paths = (
+        "/test_array_index/otters.json?_facet_array=tags",
+        "/test_array_index/otters.json?_facet_array=tags&name__not=Shaun",
+        "/test_array_index/otters.json?_facet_array=tags&tags__arraycontains=cunning",
+        "/test_array_index/otters.json?_facet_array=tags&tags__arraynotcontains=eager",
+    )
+
+    async def fetch_all(ds):
+        responses = [(await ds.client.get(path)).json() for path in paths]
+        return [(r["rows"], r["facet_results"]) for r in responses]
+
+    expected = await fetch_all(plain)
+    config = {
+        "databases": {
+            "test_array_index": {"tables": {"otters": {"array_indexes": ["tags"]}}}
+        }
+    }
+    ds = Datasette([], memory=True, config=config)
+    indexed_db = ds.add_database(Database(ds, memory_name="test_array_index"))
+    await ds.invoke_startup()
+    assert await indexed_db.array_indexes("otters") == {
+        "tags": "_array_index_otters_tags"
+    }
+    assert "_array_index_otters_tags" in await indexed_db.hidden_table_names()
+    sqls = log_sql(indexed_db)
+    assert await fetch_all(ds) == expected
+    assert not [sql for sql in sqls if "json_each" in sql]
+    # Writes to the table keep the index up to date
+    await indexed_db.execute_write(
+        "update otters set tags = '[\"eager\"]' where name = 'Charles'"
+    )
+    response = await ds.client.get(paths[0])
+    counts = {
+        r["value"]: r["count"]
+        for r in response.json()["facet_results"]["results"]["tags"]["results"]
+    }
+    assert counts == {"cunning": 1, "eager": 2, "empathetic": 2, "friendly": 1}
+    # Removing the configuration removes the index
+    ds.config["databases"]["test_array_index"]["tables"]["otters"]["array_indexes"] = []
+    await indexed_db.sync_array_indexes()
+    assert await indexed_db.array_indexes("otters") == {}
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not detect_json1(), reason="Requires the SQLite json1 module")
+async def test_array_indexes_with_overlapping_names():
+    # Table a_b column c and table a column b_c would both be _array_index_a_b_c
+    config = {
+        "databases": {
+            "test_array_index_names": {
+                "tables": {
+                    "a_b": {"array_indexes": ["c"]},
+                    "a": {"array_indexes": ["b_c"]},
+                }
+            }
+        }
+    }
+    ds = Datasette([], memory=True, config=config)
+    db = ds.add_database(Database(ds, memory_name="test_array_index_names"))
+    await db.execute_write("create table a_b(c text)")
+    await db.execute_write("create table a(b_c text)")
+    await db.execute_write("""insert into a_b (c) values ('["one"]')""")
+    await db.execute_write("""insert into a (b_c) values ('["two"]')""")
+    await ds.invoke_startup()
+    index_tables = {
+        "a_b": await db.array_indexes("a_b"),
+        "a": await db.array_indexes("a"),
+    }
+    assert index_tables == {
+        "a_b": {"c": "_array_index_a_b_c"},
+        "a": {"b_c": "_array_index_a_b_c_2"},
+    }
+    assert "_datasette_array_indexes" in await db.hidden_table_names()
+    for table, column, value in (("a_b", "c", "one"), ("a", "b_c", "two")):
+        response = await ds.client.get(
+            "/test_array_index_names/{}.json?_facet_array={}".format(table, column)
+        )
+        facet = response.json()["facet_results"]["results"][column]
+        assert [r["value"] for r in facet["results"]] == [value]
+    # Removing one index leaves the other in place
+    ds.config["databases"]["test_array_index_names"]["tables"]["a_b"][
+        "array_indexes"
+    ] = []
+    await db.sync_array_indexes()
+    assert await db.array_indexes("a_b") == {}
+    assert await db.array_indexes("a") == {"b_c": "_array_index_a_b_c_2"}
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not detect_json1(), reason="Requires the SQLite json1 module")
+async def test_array_index_insert_or_replace():
+    config = {
+        "databases": {
+            "test_array_index_replace": {"tables": {"t": {"array_indexes": ["tags"]}}}
+        }
+    }
+    ds = Datasette([], memory=True, config=config)
+    db = ds.add_database(Database(ds, memory_name="test_array_index_replace"))
+    await db.execute_write("create table t(id integer primary key, tags text)")
+    await db.execute_write("""insert into t (id, tags) values (1, '["a", "b"]')""")
+    await ds.invoke_startup()
+    # Replacing the row has to remove its old values from the index
+    await db.execute_write(
+        """insert or replace into t (id, tags) values (1, '["c"]')"""
+    )
+    response = await ds.client.get(
+        "/test_array_index_replace/t.json?_facet_array=tags&tags__arraycontains=b"
+    )
+    assert response.json()["rows"] == []
+    response = await ds.client.get("/test_array_index_replace/t.json?_facet_array=tags")
+    facet = response.json()["facet_results"]["results"]["tags"]
+    assert [(r["value"], r["count"]) for r in facet["results"]] == [("c", 1)]
+
+
 @pytest.mark.asyncio
 async def test_date_facet_results(ds_client):
     facet = DateFacet(
@@ -734,3 +881,370 @@ async def test_facet_only_considers_first_x_rows():
         assert data2["suggested_facets"] == []
     finally:
         Facet.suggest_consider = original_suggest_consider
+
+
+@pytest.mark.asyncio
+async def test_facets_use_inspect_column_stats(tmp_path, log_sql):
+    from datasette.cli import inspect_
+    import sqlite3
+
+    path = str(tmp_path / "stats.db")
+    conn = sqlite3.connect(path)
+    conn.execute("create table t (id integer primary key, state text, n integer)")
+    conn.executemany(
+        "insert into t (state, n) values (?, ?)",
+        [(["CA", "MI", "MC"][i % 3 if i < 7 else 0], i) for i in range(10)],
+    )
+    conn.commit()
+    conn.close()
+    inspect_data = await inspect_([path], [], column_stats=True, processes=1)
+    stats = inspect_data["stats"]["tables"]["t"]["column_stats"]
+    assert stats["state"] == {
+        "nulls": 0,
+        "distinct": 3,
+        "min": "CA",
+        "max": "MI",
+        "top": [["CA", 6], ["MC", 2], ["MI", 2]],
+    }
+    assert "top" not in stats["n"]
+
+    plain = Datasette(immutables=[path])
+    with_stats = Datasette(immutables=[path], inspect_data=inspect_data)
+    db = with_stats.get_database("stats")
+    sqls = log_sql(db)
+    url = "/stats/t.json?_facet=state&_extra=facet_results,suggested_facets"
+    expected = (await plain.client.get(url)).json()
+    response = (await with_stats.client.get(url)).json()
+    assert response["facet_results"] == expected["facet_results"]
+    assert response["suggested_facets"] == expected["suggested_facets"] == []
+    assert not [sql for sql in sqls if "group by" in sql or "count(*) as n" in sql]
+    suggested = (
+        await with_stats.client.get("/stats/t.json?_extra=suggested_facets")
+    ).json()["suggested_facets"]
+    assert [s["name"] for s in suggested] == ["state"]
+    assert not [sql for sql in sqls if "count(*) as n" in sql]
+    # Filtered tables still run the queries
+    sqls.clear()
+    filtered = (await with_stats.client.get(url + "&n__gt=2")).json()
+    assert filtered["facet_results"]["results"]["state"]["results"][0]["count"] == 5
+    assert [sql for sql in sqls if "group by" in sql]
+    plain.close()
+    with_stats.close()
+
+
+@pytest.mark.asyncio
+async def test_facets_use_precomputed_inspect_facets(tmp_path, log_sql):
+    from datasette.cli import inspect_
+    import sqlite3
+
+    path = str(tmp_path / "pre.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "create table t (id integer primary key, state text, created text, n integer)"
+    )
+    conn.executemany(
+        "insert into t (state, created, n) values (?, ?, ?)",
+        [
+            (
+                ["CA", "MI", "MC", None][i % 4],
+                "2019-01-{:02d} 10:00:00".format(i % 3 + 1),
+                i,
+            )
+            for i in range(12)
+        ],
+    )
+    conn.commit()
+    conn.close()
+    config = {
+        "databases": {
+            "pre": {"tables": {"t": {"facets": ["state", "n", {"date": "created"}]}}}
+        }
+    }
+    inspect_data = await inspect_([path], [], processes=1, config=config)
+    facets = inspect_data["pre"]["tables"]["t"]["facets"]
+    assert facets["column"]["state"] == {
+        "results": [["CA", 3], ["MC", 3], ["MI", 3]],
+        "truncated": False,
+    }
+    assert facets["date"]["created"]["results"] == [
+        ["2019-01-01", 4],
+        ["2019-01-02", 4],
+        ["2019-01-03", 4],
+    ]
+
+    plain = Datasette(immutables=[path], config=config)
+    precomputed = Datasette(immutables=[path], config=config, inspect_data=inspect_data)
+    db = precomputed.get_database("pre")
+    sqls = log_sql(db)
+    for url in (
+        "/pre/t.json?_extra=facet_results",
+        "/pre/t.json?_extra=facet_results&_facet_size=2",
+    ):
+        expected = (await plain.client.get(url)).json()
+        response = (await precomputed.client.get(url)).json()
+        assert response["facet_results"] == expected["facet_results"]
+    assert not [sql for sql in sqls if "group by" in sql]
+    # Filtered tables still run the queries
+    filtered = (
+        await precomputed.client.get("/pre/t.json?_extra=facet_results&n__gt=5")
+    ).json()
+    assert [
+        (r["value"], r["count"])
+        for r in filtered["facet_results"]["results"]["state"]["results"]
+    ] == [("MC", 2), ("CA", 1), ("MI", 1)]
+    assert [sql for sql in sqls if "group by" in sql]
+    plain.close()
+    precomputed.close()
+
+
+@pytest.mark.asyncio
+async def test_column_facets_counted_in_single_scan(monkeypatch, log_sql):
+    ds = Datasette()
+    db = ds.add_memory_database("test_single_scan_facets")
+    await db.execute_write(
+        "create table t (id integer primary key, mixed, tag text, _under text)"
+    )
+    await db.execute_write_many(
+        "insert into t (mixed, tag, _under) values (?, ?, ?)",
+        [
+            (value, "tag{}".format(i % 7) if i % 5 else None, "u{}".format(i % 2))
+            for i, value in enumerate(
+                [1, "1", 2.5, b"\x00", None, "b", "a", 1, 2.5, "a", b"\x00", 10, 2] * 3
+            )
+        ],
+    )
+    sqls = log_sql(db)
+    url = (
+        "/test_single_scan_facets/t.json?_facet=mixed&_facet=tag&_facet=_under"
+        "&_facet_size=4&_extra=facet_results,facets_timed_out&id__gt=1"
+    )
+    response = (await ds.client.get(url)).json()
+    facet_sqls = [sql for sql in sqls if "group by" in sql]
+    assert len(facet_sqls) == 1
+    assert facet_sqls[0].count("union all") == 2
+    assert response["facets_timed_out"] == []
+    # Same results as one GROUP BY query per column
+    monkeypatch.setattr(ColumnFacet, "single_scan_min_columns", 100)
+    expected = (await ds.client.get(url)).json()
+    assert len([sql for sql in sqls if "group by" in sql]) == 4
+    assert response["facet_results"] == expected["facet_results"]
+    results = response["facet_results"]["results"]
+    assert len(results["mixed"]["results"]) == 4
+    assert results["mixed"]["truncated"]
+
+
+@pytest.mark.asyncio
+async def test_column_facets_single_scan_respects_collation():
+    ds = Datasette()
+    db = ds.add_memory_database("test_single_scan_collation")
+    await db.execute_write(
+        "create table t (id integer primary key, name text collate nocase, other)"
+    )
+    await db.execute_write_many(
+        "insert into t (name, other) values (?, ?)",
+        [("A", 1), ("a", 1), ("b", 2)],
+    )
+    url = (
+        "/test_single_scan_collation/t.json?_facet=name&_facet=other"
+        "&_extra=facet_results"
+    )
+    results = (await ds.client.get(url)).json()["facet_results"]["results"]
+    assert [r["count"] for r in results["name"]["results"]] == [2, 1]
+    assert [r["count"] for r in results["other"]["results"]] == [2, 1]
+    # Ties are ordered using the collation of each column too
+    await db.execute_write("delete from t")
+    await db.execute_write_many(
+        "insert into t (name, other) values (?, ?)",
+        [("C", "C"), ("a", "a"), ("B", "B")],
+    )
+    results = (await ds.client.get(url)).json()["facet_results"]["results"]
+    assert [r["value"] for r in results["name"]["results"]] == ["a", "B", "C"]
+    assert [r["value"] for r in results["other"]["results"]] == ["B", "C", "a"]
+
+
+@pytest.mark.asyncio
+async def test_column_facets_single_scan_time_limit():
+    ds = Datasette(settings={"facet_time_limit_ms": 1})
+    db = ds.add_memory_database("test_single_scan_time_limit")
+    await db.execute_write(
+        "create view v as with recursive counter(x) as "
+        "(select 1 union all select x + 1 from counter limit 10000000) "
+        "select x as a, x % 3 as b from counter"
+    )
+    response = (
+        await ds.client.get(
+            "/test_single_scan_time_limit/v.json?_facet=a&_facet=b"
+            "&_extra=facet_results,facets_timed_out"
+        )
+    ).json()
+    assert response["facets_timed_out"] == ["a", "b"]
+    assert response["facet_results"]["results"] == {}
+
+
+@pytest.mark.asyncio
+async def test_column_facets_single_scan_times_out_per_facet(monkeypatch):
+    # If the combined query times out each facet is tried separately, so a
+    # slow column does not cause the others to be reported as timed out
+    ds = Datasette(settings={"facet_time_limit_ms": 50, "sql_time_limit_ms": 20000})
+    time_limits = []
+    original_execute = Database.execute
+
+    async def execute(self, sql, *args, **kwargs):
+        if "facet_source" in sql or "group by" in sql:
+            time_limits.append(kwargs.get("custom_time_limit"))
+        return await original_execute(self, sql, *args, **kwargs)
+
+    monkeypatch.setattr(Database, "execute", execute)
+    db = ds.add_memory_database("test_single_scan_per_facet")
+    await db.execute_write(
+        "create view v as select x as fast, x + ("
+        "with recursive counter(n) as (select 1 union all select n + 1 "
+        "from counter limit 1000000) select count(*) from counter"
+        ") as slow from (select 1 as x union all select 2 union all select 1)"
+    )
+    response = (
+        await ds.client.get(
+            "/test_single_scan_per_facet/v.json?_facet=fast&_facet=slow"
+            "&_extra=facet_results,facets_timed_out&_size=0"
+        )
+    ).json()
+    assert response["facets_timed_out"] == ["slow"]
+    fast = response["facet_results"]["results"]["fast"]["results"]
+    assert [(r["value"], r["count"]) for r in fast] == [(1, 2), (2, 1)]
+    # The combined query and the per-facet queries share one time limit
+    scan_limit, *fallback_limits = time_limits
+    assert scan_limit <= 25
+    assert len(fallback_limits) == 2
+    assert all(limit <= 50 - scan_limit for limit in fallback_limits)
+
+
+@pytest.mark.asyncio
+async def test_suggested_facets_from_single_cached_sample(tmp_path, log_sql):
+    import sqlite3
+
+    path = str(tmp_path / "sample.db")
+    conn = sqlite3.connect(path)
+    columns = ["c{}".format(i) for i in range(20)]
+    conn.execute(
+        "create table t (id integer primary key, tags text, created text, {})".format(
+            ", ".join(columns)
+        )
+    )
+    conn.executemany(
+        "insert into t (tags, created, {}) values (?, ?, {})".format(
+            ", ".join(columns), ", ".join("?" for _ in columns)
+        ),
+        [
+            [json.dumps(["a", "b"][: i % 3]), "2024-01-0{}".format(i % 9 + 1)]
+            + [i % (c * 3 + 2) for c in range(len(columns))]
+            for i in range(50)
+        ],
+    )
+    conn.commit()
+    conn.close()
+    ds = Datasette([path])
+    db = ds.get_database("sample")
+    sqls = log_sql(db)
+    url = "/sample/t.json?_extra=suggested_facets"
+    suggested = (await ds.client.get(url)).json()["suggested_facets"]
+    names_and_types = {(s["name"], s.get("type", "column")) for s in suggested}
+    assert ("tags", "array") in names_and_types
+    assert ("created", "date") in names_and_types
+    assert ("c0", "column") in names_and_types
+    assert ("c19", "column") not in names_and_types
+    # One query reads the sample used by every facet type
+    sample_queries = [sql for sql in sqls if "glob" in sql]
+    assert len(sample_queries) == 1
+    sqls.clear()
+    again = (await ds.client.get(url)).json()["suggested_facets"]
+    assert again == suggested
+    assert not [sql for sql in sqls if "glob" in sql]
+    # Filters use a different sample
+    await ds.client.get(url + "&id__gt=10")
+    assert len([sql for sql in sqls if "glob" in sql]) == 1
+    # Writes invalidate the cached sample
+    sqls.clear()
+    await db.execute_write("update t set c19 = id % 3")
+    suggested = (await ds.client.get(url)).json()["suggested_facets"]
+    assert ("c19", "column") in {
+        (s["name"], s.get("type", "column")) for s in suggested
+    }
+    assert len([sql for sql in sqls if "glob" in sql]) == 1
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_suggested_facets_respect_collation():
+    ds = Datasette()
+    db = ds.add_memory_database("test_suggest_collation")
+    await db.execute_write(
+        "create table t (id integer primary key, name text collate nocase, other)"
+    )
+    await db.execute_write_many(
+        "insert into t (name, other) values (?, ?)",
+        [("A", "A"), ("a", "a"), ("B", "B"), ("b", "b")],
+    )
+    suggested = (
+        await ds.client.get("/test_suggest_collation/t.json?_extra=suggested_facets")
+    ).json()["suggested_facets"]
+    # name has two distinct values under NOCASE, other has four
+    assert [s["name"] for s in suggested] == ["name"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("facets", (["a"], ["a", "b"]))
+async def test_column_facets_approximate_after_time_limit(monkeypatch, facets):
+    # About 7,500 of the 30,000 rows sampled in the 1,000ms allowed for the
+    # estimate - enough that the random sample is always within 20%
+    monkeypatch.setattr(ColumnFacet, "approximate_rows_per_ms", 10)
+    ds = Datasette(settings={"facet_time_limit_ms": 1000})
+    db = ds.add_memory_database("test_approximate_facets_" + "".join(facets))
+    await db.execute_write(
+        "create table t (id integer primary key, a integer, b text, c text)"
+    )
+    await db.execute_write(
+        "with recursive counter(x) as "
+        "(select 1 union all select x + 1 from counter limit 30000) "
+        "insert into t (a, b, c) select x % 7, 'b' || (x % 2), "
+        "'padding padding padding' || x from counter"
+    )
+    # Exact facet counts against the whole, unfiltered table always time out
+    time_limits = []
+    original_execute = db.execute
+
+    async def execute(sql, *args, **kwargs):
+        if "_sampled_rowids" in sql or "max(rowid)" in sql:
+            time_limits.append(kwargs["custom_time_limit"])
+        elif "group by" in sql and ":p0" not in sql:
+            raise QueryInterrupted(None, sql, None)
+        return await original_execute(sql, *args, **kwargs)
+
+    monkeypatch.setattr(db, "execute", execute)
+    path = "/{}/t".format(db.name)
+    qs = "?" + "&".join("_facet={}".format(facet) for facet in facets)
+    data = (
+        await ds.client.get(
+            path + ".json" + qs + "&_extra=facet_results,facets_timed_out"
+        )
+    ).json()
+    assert data["facets_timed_out"] == []
+    results = data["facet_results"]["results"]
+    assert set(results) == set(facets)
+    for facet in facets:
+        assert results[facet]["approximate"] is True
+    counts = {r["value"]: r["count"] for r in results["a"]["results"]}
+    assert set(counts) == set(range(7))
+    for count in counts.values():
+        assert 30000 / 7 * 0.8 < count < 30000 / 7 * 1.2
+    # The rowid range and sample queries share one time limit
+    assert len(time_limits) == 2
+    assert time_limits[0] <= 1000
+    assert time_limits[1] <= time_limits[0]
+    html = (await ds.client.get(path + qs)).text
+    assert '<span class="facet-approximate"' in html
+    assert '<span class="facet-count">~' in html
+    # Exact facets are not marked as approximate
+    small = (
+        await ds.client.get(path + ".json?_facet=a&id__lt=50&_extra=facet_results")
+    ).json()
+    assert "approximate" not in small["facet_results"]["results"]["a"]
@@ -82,6 +82,26 @@ def test_build_where(args, expected_where, expected_params):
     assert {f"p{i}": param for i, param in enumerate(expected_params)} == actual_params
 
 
+def test_build_where_array_index():
+    f = Filters(
+        sorted(
+            [
+                ("tags__arraycontains", "a"),
+                ("tags__arraynotcontains", "b"),
+                ("other__arraycontains", "c"),
+            ]
+        ),
+        array_indexes={"tags": "_array_index_t_tags"},
+    )
+    sql_bits, actual_params = f.build_where_clauses("t")
+    assert sql_bits == [
+        ":p0 in (select value from json_each([t].[other]))",
+        "[t].rowid in (select source_rowid from [_array_index_t_tags] where value = :p1)",
+        "[t].rowid not in (select source_rowid from [_array_index_t_tags] where value = :p2)",
+    ]
+    assert actual_params == {"p0": "c", "p1": "a", "p2": "b"}
+
+
 @pytest.mark.asyncio
 async def test_through_filters_from_request(ds_client):
     request = Request.fake(
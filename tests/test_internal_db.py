@@ -2,7 +2,7 @@ import pytest
 import sqlite3
 
 from datasette.utils import escape_sqlite
-from datasette.utils.internal_db import INTERNAL_DB_SCHEMA_SQL
+from datasette.utils.internal_db import INTERNAL_DB_SCHEMA_SQL, get_table_details
 
 
 # ensure refresh_schemas() gets called before interacting with internal_db
@@ -334,3 +334,147 @@ async def test_orphan_stale_catalog_child_entries_removed(tmp_path):
     assert response.status_code == 200
 
     ds2.close()
+
+
+@pytest.mark.asyncio
+async def test_get_table_details_matches_introspection(ds_client):
+    await ensure_internal(ds_client)
+    ds = ds_client.ds
+    db = ds.get_database("fixtures")
+    details = (await get_table_details(ds, [db]))["fixtures"]
+    table_names = await db.table_names()
+    assert set(details) == set(table_names)
+    for table in table_names:
+        assert details[table] == {
+            "columns": await db.table_columns(table),
+            "primary_keys": await db.primary_keys(table),
+            "fts_table": await db.fts_table(table),
+        }, table
+
+
+@pytest.mark.asyncio
+async def test_get_table_details_stale_catalog(tmp_path):
+    from datasette.app import Datasette
+
+    path = str(tmp_path / "data.db")
+    sqlite3.connect(path).execute("create table one (id integer primary key)")
+    ds = Datasette([path])
+    await ds.refresh_schemas(force=True)
+    db = ds.get_database("data")
+    await db.execute_write("create table two (pk text primary key, title)")
+    # The catalog has not been refreshed yet, so the database is introspected
+    details = (await get_table_details(ds, [db]))["data"]
+    assert details["two"] == {
+        "columns": ["pk", "title"],
+        "primary_keys": ["pk"],
+        "fts_table": None,
+    }
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_get_table_details_fts_table_mixed_case(tmp_path):
+    from datasette.app import Datasette
+
+    path = str(tmp_path / "data.db")
+    conn = sqlite3.connect(path)
+    conn.execute("create table Items (id integer primary key, title text)")
+    conn.execute("create table Notes (id integer primary key, body text)")
+    conn.execute('create virtual table items_fts using fts5 (title, content="items")')
+    conn.execute("CREATE VIRTUAL TABLE NOTES_FTS USING FTS5 (body, CONTENT=[notes])")
+    conn.commit()
+    conn.close()
+    ds = Datasette([path])
+    await ds.refresh_schemas(force=True)
+    db = ds.get_database("data")
+    details = (await get_table_details(ds, [db]))["data"]
+    assert details["Items"]["fts_table"] == "items_fts"
+    assert details["Notes"]["fts_table"] == "NOTES_FTS"
+    for table in await db.table_names():
+        assert details[table]["fts_table"] == await db.fts_table(table), table
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_incremental_refresh_only_rewrites_changed_tables(tmp_path):
+    from datasette.app import Datasette
+
+    path = str(tmp_path / "data.db")
+    conn = sqlite3.connect(path)
+    conn.execute("create table one (id integer primary key)")
+    conn.execute("create table two (id integer primary key)")
+    conn.execute("create table three (id integer primary key)")
+    conn.execute("create view v as select * from one")
+    conn.commit()
+    ds = Datasette([path])
+    await ds.refresh_schemas(force=True)
+    internal_db = ds.get_internal_database()
+
+    async def column_rowids():
+        return {
+            row["table_name"]: row["rowid"]
+            for row in (
+                await internal_db.execute(
+                    "select rowid, table_name from catalog_columns "
+                    "where database_name = 'data'"
+                )
+            ).rows
+        }
+
+    before = await column_rowids()
+    conn.execute("alter table two add column name text")
+    conn.execute("drop table three")
+    conn.execute("drop view v")
+    conn.execute("create table four (id integer primary key)")
+    conn.commit()
+    conn.close()
+    await ds.refresh_schemas(force=False)
+    # The probe runs in the background
+    await ds._schema_probe_task
+
+    tables = await internal_db.execute(
+        "select table_name from catalog_tables where database_name = 'data' "
+        "order by rowid"
+    )
+    assert [row["table_name"] for row in tables.rows] == ["one", "two", "four"]
+    views = await internal_db.execute(
+        "select view_name from catalog_views where database_name = 'data'"
+    )
+    assert views.rows == []
+    columns = await internal_db.execute(
+        "select table_name, name from catalog_columns "
+        "where database_name = 'data' order by table_name, cid"
+    )
+    assert [tuple(row) for row in columns.rows] == [
+        ("four", "id"),
+        ("one", "id"),
+        ("two", "id"),
+        ("two", "name"),
+    ]
+    after = await column_rowids()
+    # Columns of the unchanged table were left alone
+    assert after["one"] == before["one"]
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_schema_changing_write_schedules_refresh(tmp_path):
+    from datasette.app import Datasette
+
+    path = str(tmp_path / "data.db")
+    sqlite3.connect(path).execute("create table one (id integer primary key)")
+    ds = Datasette([path])
+    await ds.refresh_schemas(force=True)
+    db = ds.get_database("data")
+    internal_db = ds.get_internal_database()
+
+    await db.execute_write("insert into one (id) values (1)")
+    assert not ds._schema_refresh_pending
+    await db.execute_write("create table two (id integer primary key)")
+    assert ds._schema_refresh_pending == {"data"}
+    await ds._refresh_pending_schemas()
+    tables = await internal_db.execute(
+        "select table_name from catalog_tables where database_name = 'data'"
+    )
+    assert {row["table_name"] for row in tables.rows} == {"one", "two"}
+    ds.close()
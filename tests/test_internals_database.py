@@ -3,13 +3,19 @@ Tests for the datasette.database.Database class
 """
 
 import asyncio
+import hashlib
+import os
+import threading
 from types import SimpleNamespace
+import datasette.database
 from datasette.app import Datasette
 from datasette.database import Database, ExecuteWriteResult, Results, MultipleValues
-from datasette.database import DatasetteClosedError
+from datasette.database import QueryInterrupted
+from datasette.database import DatasetteClosedError, ReadConnectionPool
 from datasette.database import _deliver_write_result
 from datasette.utils.sqlite import sqlite3, supports_returning
-from datasette.utils import Column
+from datasette.tracer import capture_traces, trace_child_tasks
+from datasette.utils import Column, sqlite_timelimit
 import pytest
 import sqlite_utils
 import time
@@ -1214,3 +1220,1107 @@ async def test_database_close_is_idempotent(tmpdir):
     # Second call should be a no-op, not raise
     db.close()
     ds._internal_database.close()
+
+
+@pytest.mark.asyncio
+async def test_read_pool_reuses_connections(tmpdir):
+    path = str(tmpdir / "pooled.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette([path], settings={"num_sql_threads": 4})
+    db = ds.get_database("pooled")
+    for _ in range(5):
+        await db.execute("select * from t")
+    stats = db.read_pool.stats()
+    assert stats["max_size"] == 4
+    assert stats["checkouts"] == 5
+    assert stats["misses"] == 1
+    assert stats["hits"] == 4
+    assert stats["open"] == 1
+    assert stats["in_use"] == 0
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_read_pool_max_read_connections(tmpdir):
+    path = str(tmpdir / "bounded.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette([path], settings={"num_sql_threads": 4, "max_read_connections": 1})
+    db = ds.get_database("bounded")
+    seen = set()
+
+    def slow(conn):
+        seen.add(id(conn))
+        time.sleep(0.05)
+        return conn.execute("select count(*) from t").fetchone()[0]
+
+    assert await asyncio.gather(*[db.execute_fn(slow) for _ in range(4)]) == [0] * 4
+    stats = db.read_pool.stats()
+    assert len(seen) == 1
+    assert stats["open"] == 1
+    assert stats["waits"] >= 1
+    ds.close()
+
+
+def test_read_pool_evicts_idle_connections():
+    opened = []
+    closed = []
+
+    def connect():
+        conn = sqlite3.connect(":memory:", check_same_thread=False)
+        opened.append(conn)
+        return conn
+
+    pool = ReadConnectionPool(
+        connect, max_size=2, idle_timeout=0.01, close_connection=closed.append
+    )
+    conn = pool.acquire()
+    pool.release(conn)
+    time.sleep(0.05)
+    assert pool.evict_idle() == 1
+    assert closed == [conn]
+    assert pool.stats()["open"] == 0
+    assert pool.stats()["evicted"] == 1
+    # A new connection is opened on the next checkout
+    conn2 = pool.acquire()
+    assert conn2 is not conn
+    pool.release(conn2)
+    pool.close()
+    assert closed == [conn, conn2]
+
+
+def test_read_pool_replaces_unhealthy_connections():
+    pool = ReadConnectionPool(
+        lambda: sqlite3.connect(":memory:", check_same_thread=False), max_size=1
+    )
+    conn = pool.acquire()
+    conn.close()
+    pool.release(conn)
+    conn2 = pool.acquire()
+    assert conn2 is not conn
+    assert conn2.execute("select 1").fetchone()[0] == 1
+    assert pool.stats()["discarded"] == 1
+    pool.release(conn2)
+    pool.close()
+    with pytest.raises(DatasetteClosedError):
+        pool.acquire()
+
+
+@pytest.mark.asyncio
+async def test_execute_in_sql_processes(tmpdir, monkeypatch):
+    path = str(tmpdir / "processes.db")
+    conn = sqlite3.connect(path)
+    conn.execute("create table t (id integer primary key, name text)")
+    conn.executemany(
+        "insert into t (id, name) values (?, ?)", [(i, f"n{i}") for i in range(20)]
+    )
+    conn.commit()
+    conn.close()
+    ds = Datasette(
+        [path],
+        settings={
+            "num_sql_processes": 1,
+            "max_returned_rows": 10,
+            "sql_time_limit_ms": 1000,
+        },
+    )
+    db = ds.get_database("processes")
+    # Test plugins that need the datasette argument may be registered
+    monkeypatch.setattr(
+        "datasette.database.prepare_connection_needs_datasette", lambda: False
+    )
+    # Rows are built from the worker results away from the event loop
+    row_threads = []
+    original_rows_from_tuples = datasette.database.rows_from_tuples
+
+    def rows_from_tuples(columns, rows):
+        row_threads.append(threading.current_thread())
+        return original_rows_from_tuples(columns, rows)
+
+    monkeypatch.setattr("datasette.database.rows_from_tuples", rows_from_tuples)
+    assert db._sql_process_pool() is not None
+    try:
+        results = await db.execute(
+            "select id, name as [the name] from t where id < :max", {"max": 3}
+        )
+        assert row_threads and threading.current_thread() not in row_threads
+        assert isinstance(results.rows[0], sqlite3.Row)
+        assert results.columns == ["id", "the name"]
+        assert results.dicts() == [
+            {"id": 0, "the name": "n0"},
+            {"id": 1, "the name": "n1"},
+            {"id": 2, "the name": "n2"},
+        ]
+        truncated = await db.execute("select * from t", truncate=True)
+        assert truncated.truncated
+        assert len(truncated) == 10
+        with pytest.raises(sqlite3.OperationalError):
+            await db.execute("select * from no_such_table", log_sql_errors=False)
+        with pytest.raises(QueryInterrupted):
+            await db.execute(
+                """
+                with recursive counter(x) as (
+                    select 0 union all select x + 1 from counter
+                )
+                select count(*) from counter
+                """,
+                custom_time_limit=20,
+            )
+    finally:
+        ds.close()
+
+
+def test_sql_processes_skipped_for_plugins_needing_datasette(tmpdir):
+    from datasette import hookimpl
+    from datasette.plugins import pm
+    from datasette.sql_processes import prepare_connection_needs_datasette
+
+    class NeedsDatasette:
+        __name__ = "NeedsDatasette"
+
+        @hookimpl
+        def prepare_connection(self, conn, datasette):
+            pass
+
+    path = str(tmpdir / "processes.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette([path], settings={"num_sql_processes": 1})
+    pm.register(NeedsDatasette(), name="needs_datasette")
+    try:
+        assert prepare_connection_needs_datasette()
+        assert ds.get_database("processes")._sql_process_pool() is None
+    finally:
+        pm.unregister(name="needs_datasette")
+        ds.close()
+
+
+def test_sql_process_worker_closes_connections_after_removal(tmpdir):
+    from datasette import sql_processes
+
+    path = str(tmpdir / "worker.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    sql_processes._worker_connections.clear()
+    try:
+        sql_processes.execute_in_worker(
+            "worker", path, "?mode=ro", "select 1", None, 1000, None, 0
+        )
+        conn = sql_processes._worker_connections[("worker", path, "?mode=ro")]
+        # A database was removed, so existing connections are closed
+        sql_processes.execute_in_worker(
+            "worker", path, "?mode=ro", "select 1", None, 1000, None, 1
+        )
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("select 1")
+        assert (
+            sql_processes._worker_connections[("worker", path, "?mode=ro")] is not conn
+        )
+    finally:
+        for conn in sql_processes._worker_connections.values():
+            conn.close()
+        sql_processes._worker_connections.clear()
+        sql_processes._worker_databases_removed[0] = 0
+
+
+@pytest.mark.asyncio
+async def test_execute_write_group_commit(tmpdir):
+    path = str(tmpdir / "group_commit.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette([path], settings={"write_batch_size": 10, "write_batch_wait_ms": 50})
+    db = ds.get_database("group_commit")
+    batch_sizes = []
+    original_execute_write_batch = db._execute_write_batch
+
+    def recording_execute_write_batch(conn, batch):
+        batch_sizes.append(len(batch))
+        return original_execute_write_batch(conn, batch)
+
+    db._execute_write_batch = recording_execute_write_batch
+    # Start the write thread
+    await db.execute_write("insert into t (id) values (100)")
+
+    def insert_and_count(id):
+        def inner(conn):
+            conn.execute("insert into t (id) values (?)", [id])
+            return conn.execute("select count(*) from t").fetchone()[0]
+
+        return inner
+
+    outcomes = await asyncio.gather(
+        db.execute_write_fn(insert_and_count(1)),
+        db.execute_write_fn(insert_and_count(2)),
+        # Primary key conflict, should only roll back this task
+        db.execute_write("insert into t (id) values (1)"),
+        db.execute_write_fn(insert_and_count(3)),
+        return_exceptions=True,
+    )
+    assert outcomes[0] == 2
+    assert outcomes[1] == 3
+    assert isinstance(outcomes[2], sqlite3.IntegrityError)
+    assert outcomes[3] == 4
+    assert max(batch_sizes) > 1
+    ids = [r[0] for r in (await db.execute("select id from t order by id")).rows]
+    assert ids == [1, 2, 3, 100]
+    ds.close()
+
+
+SLOW_QUERY = """
+with recursive counter(x) as (
+  select 0 union all select x + 1 from counter
+)
+select count(*) from counter where x < 100000000
+"""
+
+
+@pytest.mark.asyncio
+async def test_execute_cancelled_interrupts_query(tmpdir):
+    path = str(tmpdir / "cancel.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette(
+        [path], settings={"num_sql_threads": 1, "sql_time_limit_ms": 60 * 1000}
+    )
+    db = ds.get_database("cancel")
+    task = asyncio.ensure_future(db.execute(SLOW_QUERY))
+    # Wait for the query to start running in the SQL thread
+    while db.sql_thread_pool.stats()["running"] == 0:
+        await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    # The single SQL thread is freed immediately for the next query
+    assert (await db.execute("select 1")).single_value() == 1
+    assert time.perf_counter() - start < 5
+    assert db.cancelled_queries == 1
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_execute_cancelled_before_statement_starts(tmpdir):
+    # A cancel that lands after the function has started but before its
+    # statement is running must still interrupt that statement
+    path = str(tmpdir / "cancel.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette(
+        [path], settings={"num_sql_threads": 1, "sql_time_limit_ms": 60 * 1000}
+    )
+    db = ds.get_database("cancel")
+    started = threading.Event()
+    cancelled = threading.Event()
+    outcome = []
+
+    def fn(conn):
+        started.set()
+        cancelled.wait(5)
+        try:
+            with sqlite_timelimit(conn, 60 * 1000):
+                return conn.execute(SLOW_QUERY).fetchall()
+        except sqlite3.OperationalError as ex:
+            outcome.append(ex.args)
+            raise
+
+    task = asyncio.ensure_future(db.execute_fn(fn))
+    while not started.is_set():
+        await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    cancelled.set()
+    assert (await db.execute("select 1")).single_value() == 1
+    assert time.perf_counter() - start < 5
+    assert outcome == [("interrupted",)]
+    assert db.cancelled_queries == 1
+    ds.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("num_sql_threads", (0, 1))
+async def test_fast_text_decoding(tmpdir, num_sql_threads):
+    for name, value in (("valid", "x'436166c3a9'"), ("invalid", "x'436166e9'")):
+        conn = sqlite3.connect(str(tmpdir / f"{name}.db"))
+        with conn:
+            conn.execute("create table t (name text)")
+            conn.execute(f"insert into t values (cast({value} as text))")
+        conn.close()
+    ds = Datasette(
+        [str(tmpdir / "valid.db"), str(tmpdir / "invalid.db")],
+        settings={"fast_text_decoding": True, "num_sql_threads": num_sql_threads},
+    )
+    valid = ds.get_database("valid")
+    invalid = ds.get_database("invalid")
+    assert (await valid.execute("select name from t")).single_value() == "Café"
+    assert valid.invalid_utf8 is None
+    assert await valid.execute_fn(lambda conn: conn.text_factory) is str
+    # Invalid UTF-8 is detected and the query is retried with the lossy decoder
+    assert (await invalid.execute("select name from t")).single_value() == "Caf�"
+    assert invalid.invalid_utf8 is True
+    assert await invalid.execute_fn(lambda conn: conn.text_factory) is not str
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_fast_text_decoding_does_not_repeat_execute_fn(tmpdir):
+    path = str(tmpdir / "invalid.db")
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("create table t (name text)")
+        conn.execute("insert into t values (cast(x'436166e9' as text))")
+    conn.close()
+    ds = Datasette([path], settings={"fast_text_decoding": True})
+    db = ds.get_database("invalid")
+    calls = []
+
+    def fn(conn):
+        calls.append(conn)
+        return conn.execute("select name from t").fetchall()
+
+    # Arbitrary functions may have side effects, so they are not run again
+    with pytest.raises(sqlite3.OperationalError):
+        await db.execute_fn(fn)
+    assert len(calls) == 1
+    assert db.invalid_utf8 is True
+    assert [tuple(row) for row in await db.execute_fn(fn)] == [("Caf\ufffd",)]
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_fast_text_decoding_uses_inspect_data(tmpdir):
+    path = str(tmpdir / "inspected.db")
+    sqlite3.connect(path).execute("create table t (name text)")
+    ds = Datasette(
+        [],
+        immutables=[path],
+        inspect_data={"inspected": {"tables": {}, "invalid_utf8": True}},
+        settings={"fast_text_decoding": True},
+    )
+    db = ds.get_database("inspected")
+    assert db.invalid_utf8 is True
+    assert await db.execute_fn(lambda conn: conn.text_factory) is not str
+    ds.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("num_sql_threads", (0, 2))
+async def test_execute_stream(tmpdir, num_sql_threads):
+    path = str(tmpdir / "stream.db")
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("create table t (id integer primary key)")
+        conn.executemany("insert into t (id) values (?)", ((i,) for i in range(25)))
+    conn.close()
+    ds = Datasette([path], settings={"num_sql_threads": num_sql_threads})
+    db = ds.get_database("stream")
+    batches = [
+        batch
+        async for batch in db.execute_stream(
+            "select id from t where id >= :min order by id",
+            {"min": 3},
+            batch_size=10,
+        )
+    ]
+    assert [len(batch) for batch in batches] == [10, 10, 2]
+    assert [row["id"] for batch in batches for row in batch] == list(range(3, 25))
+    # Each stream uses its own connection, which is closed afterwards
+    assert db._all_file_connections == []
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_execute_stream_closed_early(tmpdir):
+    path = str(tmpdir / "stream.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette([path])
+    db = ds.get_database("stream")
+    stream = db.execute_stream(
+        "with recursive c(x) as (select 0 union all select x + 1 from c) "
+        "select x from c",
+        batch_size=5,
+    )
+    assert [row[0] for row in await stream.__anext__()] == [0, 1, 2, 3, 4]
+    assert [row[0] for row in await stream.__anext__()] == [5, 6, 7, 8, 9]
+    await stream.aclose()
+    assert db._all_file_connections == []
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_execute_stream_time_limit(tmpdir):
+    path = str(tmpdir / "stream.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette([path])
+    db = ds.get_database("stream")
+    with pytest.raises(QueryInterrupted):
+        async for _ in db.execute_stream(SLOW_QUERY, custom_time_limit=20):
+            pass
+    assert db._all_file_connections == []
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_introspection_cache_invalidated_by_schema_changes(tmpdir):
+    path = str(tmpdir / "schema.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key, a)")
+    ds = Datasette([path])
+    db = ds.get_database("schema")
+    assert await db.table_columns("t") == ["id", "a"]
+    assert await db.table_columns("t") == ["id", "a"]
+    assert await db.primary_keys("t") == ["id"]
+    stats = db.introspection_cache_stats()
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+    # Returned values can be modified without affecting the cache
+    (await db.table_columns("t")).append("oops")
+    assert await db.table_columns("t") == ["id", "a"]
+    # DDL through execute_write() changes the schema version
+    await db.execute_write("alter table t add column b")
+    assert await db.table_columns("t") == ["id", "a", "b"]
+    assert db.introspection_cache_stats()["invalidations"] == 1
+    # So does DDL from another connection
+    conn = sqlite3.connect(path)
+    conn.execute("alter table t add column c")
+    conn.close()
+    assert await db.table_columns("t") == ["id", "a", "b", "c"]
+    assert db.introspection_cache_stats()["invalidations"] == 2
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_introspection_cache_immutable(tmpdir):
+    path = str(tmpdir / "immutable.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key, a)")
+    ds = Datasette([], immutables=[path])
+    db = ds.get_database("immutable")
+    calls = []
+    original_execute_fn = db.execute_fn
+
+    async def counting_execute_fn(fn):
+        calls.append(fn)
+        return await original_execute_fn(fn)
+
+    db.execute_fn = counting_execute_fn
+    for _ in range(3):
+        assert await db.table_columns("t") == ["id", "a"]
+        assert await db.foreign_keys_for_table("t") == []
+        assert await db.label_column_for_table("t") == "a"
+    # Immutable databases do not even need to check the schema version
+    assert len(calls) == 3
+    assert db.introspection_cache_stats()["hits"] == 6
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_table_counts_cached_for_mutable_database(tmpdir):
+    path = str(tmpdir / "counts.db")
+    conn = sqlite3.connect(path)
+    conn.execute("create table t (id integer primary key)")
+    conn.execute("create table u (id integer primary key)")
+    conn.executemany("insert into t (id) values (?)", [(i,) for i in range(5)])
+    conn.commit()
+    conn.close()
+    ds = Datasette([path])
+    db = ds.get_database("counts")
+    assert await db.table_counts() == {"t": 5, "u": 0}
+    assert db.table_counts_stale_as_of is None
+    calls = []
+    original_execute = db.execute
+
+    async def counting_execute(sql, *args, **kwargs):
+        calls.append(sql)
+        return await original_execute(sql, *args, **kwargs)
+
+    db.execute = counting_execute
+    assert await db.table_counts() == {"t": 5, "u": 0}
+    assert not [sql for sql in calls if "count(*)" in sql]
+    # Without allow_stale a write means counting again straight away
+    await db.execute_write("insert into t (id) values (5)")
+    assert await db.table_counts() == {"t": 6, "u": 0}
+    # With allow_stale the old counts are returned while they refresh
+    await db.execute_write("insert into u (id) values (1)")
+    await db.execute_write("create table v (id integer primary key)")
+    traces = []
+    with capture_traces(traces), trace_child_tasks():
+        assert await db.table_counts(allow_stale=True) == {
+            "t": 6,
+            "u": 0,
+            "v": None,
+        }
+        stale_as_of = db.table_counts_stale_as_of
+        assert stale_as_of is not None
+        await db._table_counts_refresh_task
+    # The refresh runs in the background, outside the caller's trace
+    assert not [t for t in traces if "count(*)" in t.get("sql", "")]
+    assert db.table_counts_stale_as_of is None
+    assert await db.table_counts(allow_stale=True) == {"t": 6, "u": 1, "v": 0}
+    # Writes from other connections are spotted too
+    conn = sqlite3.connect(path)
+    conn.execute("insert into v (id) values (1)")
+    conn.commit()
+    conn.close()
+    assert await db.table_counts() == {"t": 6, "u": 1, "v": 1}
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_database_page_shows_stale_table_counts(tmpdir):
+    path = str(tmpdir / "counts.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette([path])
+    db = ds.get_database("counts")
+    data = (await ds.client.get("/counts.json")).json()
+    assert data["table_counts_stale_as_of"] is None
+    # Hold the background refresh until the stale page has been checked
+    refresh_allowed = asyncio.Event()
+    original_count_tables = db._count_tables
+
+    async def slow_count_tables(limit):
+        await refresh_allowed.wait()
+        return await original_count_tables(limit)
+
+    db._count_tables = slow_count_tables
+    await db.execute_write("insert into t (id) values (1)")
+    data = (await ds.client.get("/counts.json")).json()
+    assert data["table_counts_stale_as_of"] is not None
+    assert data["tables"][0]["count"] == 0
+    response = await ds.client.get("/counts")
+    assert "Row counts as of" in response.text
+    refresh_allowed.set()
+    await db._table_counts_refresh_task
+    data = (await ds.client.get("/counts.json")).json()
+    assert data["table_counts_stale_as_of"] is None
+    assert data["tables"][0]["count"] == 1
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_table_count_estimate(tmpdir):
+    path = str(tmpdir / "estimates.db")
+    conn = sqlite3.connect(path)
+    conn.execute("create table analyzed (id integer primary key, name text)")
+    conn.execute("create index analyzed_name on analyzed (name)")
+    conn.execute("create table not_analyzed (id integer primary key)")
+    conn.executemany(
+        "insert into analyzed (name) values (?)", [(str(i),) for i in range(200)]
+    )
+    conn.executemany(
+        "insert into not_analyzed (id) values (?)", [(i,) for i in range(50)]
+    )
+    conn.execute("analyze analyzed")
+    conn.commit()
+    conn.close()
+    ds = Datasette([path])
+    db = ds.get_database("estimates")
+    assert await db.table_count_estimates() == {"analyzed": 200}
+    assert await db.table_count_estimate("analyzed") == 200
+    assert await db.table_count_estimate("not_analyzed") is None
+    # Cached until the database changes
+    conn = sqlite3.connect(path)
+    conn.execute("analyze")
+    conn.commit()
+    conn.close()
+    assert await db.table_count_estimates() == {"analyzed": 200, "not_analyzed": 50}
+    calls = []
+    original_execute = db.execute
+
+    async def counting_execute(sql, *args, **kwargs):
+        calls.append(sql)
+        return await original_execute(sql, *args, **kwargs)
+
+    db.execute = counting_execute
+    assert await db.table_count_estimate("not_analyzed") == 50
+    assert calls == []
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_count_estimate_extra(tmpdir):
+    path = str(tmpdir / "estimates.db")
+    conn = sqlite3.connect(path)
+    conn.execute("create table big (id integer primary key)")
+    conn.executemany("insert into big (id) values (?)", [(i,) for i in range(30)])
+    conn.execute("analyze")
+    conn.commit()
+    conn.close()
+    ds = Datasette([path])
+    db = ds.get_database("estimates")
+    db.count_limit = 10
+    response = await ds.client.get("/estimates/big.json?_extra=count,count_estimate")
+    data = response.json()
+    assert data["count"] == 11
+    assert data["count_truncated"] is True
+    assert data["count_estimate"] == 30
+    # Filtered counts do not get an estimate
+    response = await ds.client.get(
+        "/estimates/big.json?id__gt=1&_extra=count,count_estimate"
+    )
+    assert response.json()["count_estimate"] is None
+    response = await ds.client.get("/estimates/big")
+    assert "(about 30, estimated)" in response.text
+    response = await ds.client.get("/estimates")
+    assert "(about 30, estimated)" in response.text
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_exact_counts(tmpdir):
+    path = str(tmpdir / "exact.db")
+    conn = sqlite3.connect(path)
+    conn.execute("create table counted (id integer primary key, name text)")
+    conn.execute("create table not_counted (id integer primary key)")
+    conn.executemany("insert into counted (id) values (?)", [(i,) for i in range(15)])
+    conn.executemany(
+        "insert into not_counted (id) values (?)", [(i,) for i in range(15)]
+    )
+    conn.commit()
+    conn.close()
+    ds = Datasette(
+        [path],
+        config={
+            "databases": {
+                "exact": {
+                    "exact_counts": True,
+                    "tables": {"not_counted": {"exact_counts": False}},
+                }
+            }
+        },
+    )
+    await ds.invoke_startup()
+    db = ds.get_database("exact")
+    db.count_limit = 10
+    assert db.exact_count_tables == {"counted"}
+    assert await db.exact_counts() == {"counted": 15}
+    assert await db.table_counts() == {
+        "_datasette_counts": 1,
+        "counted": 15,
+        "not_counted": 11,
+    }
+    # The triggers keep the count up to date, including rows replaced by
+    # INSERT OR REPLACE through the write connection
+    await db.execute_write("insert into counted (id) values (100)")
+    await db.execute_write("insert or replace into counted (id, name) values (1, 'a')")
+    await db.execute_write("delete from counted where id < 5")
+    assert await db.exact_counts() == {"counted": 11}
+    data = (
+        await ds.client.get("/exact/counted.json?_extra=count,count_truncated")
+    ).json()
+    assert (data["count"], data["count_truncated"]) == (11, False)
+    # Filtered counts still use count(*)
+    data = (await ds.client.get("/exact/counted.json?id__gt=5&_extra=count")).json()
+    assert data["count"] == 10
+    tables = (await ds.client.get("/exact.json")).json()["tables"]
+    counted = next(table for table in tables if table["name"] == "counted")
+    assert (counted["count"], counted["count_truncated"]) == (11, False)
+    # The triggers are only synced again when the schema changes
+    syncs = []
+    original_sync_exact_counts = db.sync_exact_counts
+
+    async def sync_exact_counts():
+        syncs.append(1)
+        return await original_sync_exact_counts()
+
+    db.sync_exact_counts = sync_exact_counts
+    await db.table_counts()
+    await ds.client.get("/exact")
+    assert syncs == []
+    await db.execute_write("create table created_later (id integer primary key)")
+    await db.execute_write("insert into created_later (id) values (1)")
+    await ds.refresh_schemas(force=True)
+    assert syncs
+    assert db.exact_count_tables == {"counted", "created_later"}
+    assert (await db.exact_counts())["created_later"] == 1
+    ds.close()
+    # Removing the configuration removes the triggers on startup
+    ds = Datasette([path])
+    await ds.invoke_startup()
+    db = ds.get_database("exact")
+    await db.table_counts()
+    assert db.exact_count_tables == set()
+    triggers = await db.execute("select name from sqlite_master where type = 'trigger'")
+    assert triggers.rows == []
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_query_result_cache(tmpdir):
+    path = str(tmpdir / "cached.db")
+    conn = sqlite3.connect(path)
+    conn.execute("create table t (id integer primary key, name text)")
+    conn.executemany(
+        "insert into t (id, name) values (?, ?)", [(i, f"n{i}") for i in range(20)]
+    )
+    conn.commit()
+    conn.close()
+    ds = Datasette([], immutables=[path], settings={"query_cache_size_kb": 20})
+    db = ds.get_database("cached")
+    cache = ds.query_result_cache
+    calls = []
+    original_execute_fn = db.execute_fn
+
+    async def counting_execute_fn(fn):
+        calls.append(fn)
+        return await original_execute_fn(fn)
+
+    db.execute_fn = counting_execute_fn
+    sql = "select * from t where id < :max"
+    results = await db.execute(sql, {"max": 5})
+    results.rows.append("modified")
+    again = await db.execute(sql, {"max": 5})
+    assert len(calls) == 1
+    assert [row["id"] for row in again.rows] == [0, 1, 2, 3, 4]
+    assert again.columns == ["id", "name"]
+    # Different parameters, truncate or use_cache=False run the query
+    await db.execute(sql, {"max": 6})
+    await db.execute(sql, {"max": 5}, truncate=True)
+    await db.execute(sql, {"max": 5}, use_cache=False)
+    assert len(calls) == 4
+    assert (cache.hits, cache.misses) == (1, 3)
+    # Filling the cache evicts the least recently used results
+    for i in range(20):
+        await db.execute("select * from t where id >= ?", [i])
+    stats = cache.stats()
+    assert stats["evictions"] > 0
+    assert stats["bytes"] <= stats["max_bytes"]
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_query_result_cache_skips_memory_and_nocache(tmpdir):
+    path = str(tmpdir / "cached.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette(
+        immutables=[path],
+        memory=True,
+        settings={"query_cache_size_kb": 1000},
+    )
+    cache = ds.query_result_cache
+    await ds.get_database("_memory").execute("select 1")
+    await ds.get_database("_memory").execute("select 1")
+    assert cache.stats()["entries"] == 0
+    await ds.client.get("/cached/t.json")
+    hits = cache.hits
+    await ds.client.get("/cached/t.json")
+    assert cache.hits > hits
+    hits = cache.hits
+    await ds.client.get("/cached/t.json?_nocache=1")
+    assert cache.hits == hits
+    # The value is parsed as a boolean
+    await ds.client.get("/cached/t.json?_nocache=0")
+    assert cache.hits > hits
+    ds.root_enabled = True
+    threads = (await ds.client.get("/-/threads.json", actor={"id": "root"})).json()
+    assert threads["query_result_cache"]["entries"] == cache.stats()["entries"]
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_data_generation(tmpdir):
+    path = str(tmpdir / "generation.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    immutable_path = str(tmpdir / "immutable.db")
+    sqlite3.connect(immutable_path).execute("vacuum")
+    ds = Datasette([path], immutables=[immutable_path])
+    db = ds.get_database("generation")
+    generation = db.data_generation()
+    assert generation is not None
+    assert db.data_generation() == generation
+    await db.execute("select * from t")
+    assert db.data_generation() == generation
+    # Writes through Datasette advance the generation
+    await db.execute_write("insert into t (id) values (1)")
+    assert db.data_generation() > generation
+    generation = db.data_generation()
+    # So do writes from other connections
+    conn = sqlite3.connect(path)
+    conn.execute("insert into t (id) values (2)")
+    conn.commit()
+    conn.close()
+    assert db.data_generation() > generation
+    assert ds.get_database("immutable").data_generation() == 0
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_query_result_cache_mutable_database(tmpdir):
+    path = str(tmpdir / "mutable.db")
+    conn = sqlite3.connect(path)
+    conn.execute("create table t (id integer primary key)")
+    conn.execute("insert into t (id) values (1)")
+    conn.commit()
+    ds = Datasette([path], settings={"query_cache_size_kb": 1000})
+    db = ds.get_database("mutable")
+    cache = ds.query_result_cache
+    sql = "select count(*) from t"
+    assert (await db.execute(sql)).single_value() == 1
+    assert (await db.execute(sql)).single_value() == 1
+    assert cache.hits == 1
+    # A write from another process drops the cached results
+    conn.execute("insert into t (id) values (2)")
+    conn.commit()
+    assert (await db.execute(sql)).single_value() == 2
+    await db.execute_write("insert into t (id) values (3)")
+    assert (await db.execute(sql)).single_value() == 3
+    assert (await db.execute(sql)).single_value() == 3
+    assert cache.hits == 2
+    assert cache.stats()["entries"] == 1
+    # PRAGMA data_version is read away from the event loop
+    threads = []
+    original_data_generation = db.data_generation
+
+    def data_generation():
+        threads.append(threading.current_thread())
+        return original_data_generation()
+
+    db.data_generation = data_generation
+    assert (await db.execute(sql)).single_value() == 3
+    assert threads and threading.current_thread() not in threads
+    conn.close()
+    ds.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "sql",
+    (
+        "select random()",
+        "select hex(randomblob(4))",
+        "select datetime('now')",
+        "select date()",
+        "select CURRENT_TIMESTAMP",
+    ),
+)
+async def test_query_result_cache_skips_nondeterministic_sql(tmpdir, sql):
+    path = str(tmpdir / "immutable.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette([], immutables=[path], settings={"query_cache_size_kb": 1000})
+    db = ds.get_database("immutable")
+    await db.execute(sql)
+    await db.execute(sql)
+    assert ds.query_result_cache.stats()["entries"] == 0
+    # Deterministic SQL is cached
+    await db.execute("select count(*) from t")
+    assert ds.query_result_cache.stats()["entries"] == 1
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_query_result_cache_skips_arbitrary_sql(tmpdir):
+    path = str(tmpdir / "immutable.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette([], immutables=[path], settings={"query_cache_size_kb": 1000})
+    for _ in range(2):
+        response = await ds.client.get(
+            "/immutable/-/query.json?sql=select+count(*)+from+t"
+        )
+        assert response.status_code == 200
+    assert ds.query_result_cache.hits == 0
+    assert not [
+        key for key in ds.query_result_cache._entries if "count(*) from t" in key[2]
+    ]
+    ds.close()
+
+
+FINITE_QUERY = """
+with recursive counter(x) as (
+  select 0 union all select x + 1 from counter where x < {}
+)
+select count(*) from counter
+"""
+
+
+@pytest.mark.asyncio
+async def test_execute_deduplicates_identical_queries(tmpdir):
+    path = str(tmpdir / "dedupe.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette([path], settings={"sql_time_limit_ms": 60 * 1000})
+    db = ds.get_database("dedupe")
+    sql = FINITE_QUERY.format(300000)
+    calls = []
+    original_execute_fn = db.execute_fn
+
+    async def counting_execute_fn(fn):
+        calls.append(fn)
+        return await original_execute_fn(fn)
+
+    db.execute_fn = counting_execute_fn
+    results = await asyncio.gather(*(db.execute(sql) for _ in range(5)))
+    assert len(calls) == 1
+    assert db.deduplicated_queries == 4
+    assert [r.single_value() for r in results] == [300001] * 5
+    # Each caller gets its own rows list
+    results[0].rows.append("modified")
+    assert len(results[1].rows) == 1
+    # Different parameters are not shared
+    await asyncio.gather(db.execute("select ?", [1]), db.execute("select ?", [2]))
+    assert len(calls) == 3
+    # A write in between means a new query
+    first = asyncio.ensure_future(db.execute(sql))
+    await asyncio.sleep(0)
+    await db.execute_write("insert into t (id) values (1)")
+    await asyncio.gather(first, db.execute(sql))
+    assert len(calls) == 5
+    # Does not depend on PRAGMA data_version, which can fail with SQLITE_BUSY
+    db.data_generation = lambda: None
+
+    async def traced_execute():
+        traces = []
+        with capture_traces(traces):
+            await db.execute(sql)
+        return traces
+
+    all_traces = await asyncio.gather(*(traced_execute() for _ in range(3)))
+    assert len(calls) == 6
+    # Callers that joined the query see it in their traces too
+    for traces in all_traces:
+        assert [t["sql"] for t in traces if "sql" in t] == [sql.strip()]
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_execute_deduplicated_query_cancellation(tmpdir):
+    path = str(tmpdir / "dedupe.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette(
+        [path], settings={"num_sql_threads": 1, "sql_time_limit_ms": 60 * 1000}
+    )
+    db = ds.get_database("dedupe")
+    short_query = FINITE_QUERY.format(2000000)
+    first = asyncio.ensure_future(db.execute(short_query))
+    second = asyncio.ensure_future(db.execute(short_query))
+    while db.sql_thread_pool.stats()["running"] == 0:
+        await asyncio.sleep(0.01)
+    # Cancelling one caller leaves the query running for the other
+    first.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await first
+    assert (await second).single_value() == 2000001
+    assert db.cancelled_queries == 0
+    # Once every caller has been cancelled the query is interrupted
+    tasks = [asyncio.ensure_future(db.execute(SLOW_QUERY)) for _ in range(2)]
+    while db.sql_thread_pool.stats()["running"] == 0:
+        await asyncio.sleep(0.01)
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    assert (await db.execute("select 1")).single_value() == 1
+    assert db.cancelled_queries == 1
+    assert db._queries_in_flight == {}
+    ds.close()
+
+
+def _create_immutable_db(path):
+    conn = sqlite3.connect(str(path))
+    conn.execute("create table t (id integer primary key, name text)")
+    conn.executemany("insert into t (name) values (?)", [("x" * 100,)] * 500)
+    conn.commit()
+    conn.close()
+    return str(path)
+
+
+def _sha256(path):
+    with open(path, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+@pytest.mark.asyncio
+async def test_database_hash_in_background(tmpdir, monkeypatch):
+    path = _create_immutable_db(tmpdir / "big.db")
+    expected = _sha256(path)
+    release = threading.Event()
+    original = datasette.database.inspect_hash_with_sidecar
+
+    def slow_hash(path):
+        release.wait(5)
+        return original(path)
+
+    monkeypatch.setattr(datasette.database, "inspect_hash_with_sidecar", slow_hash)
+    settings = {"hash_sidecar_files": True}
+    ds = Datasette(immutables=[path], settings=settings)
+    db = ds.get_database("big")
+    db.hash_in_place_max_bytes = 0
+    assert db.hash_status == "pending"
+    color = db.color
+    assert db.hash is None
+    assert db.hash_status == "calculating"
+    databases = (await ds.client.get("/-/databases.json")).json()["databases"]
+    assert databases[0]["hash_status"] == "calculating"
+    # Downloads fall back to the fingerprint
+    response = await ds.client.get("/big.db")
+    assert response.headers["etag"] == '"{}"'.format(db.fingerprint)
+    release.set()
+    assert await db.wait_for_hash() == expected
+    assert db.hash == expected
+    assert db.hash_status == "ready"
+    # The colour does not change once the hash is ready
+    assert db.color == color
+    assert os.path.exists(path + ".datasette-hash.json")
+    ds.close()
+
+    # A new instance uses the sidecar rather than reading the file
+    def fail(path):
+        raise AssertionError("Should not hash the file again")
+
+    monkeypatch.setattr(datasette.database, "inspect_hash_with_sidecar", fail)
+    ds2 = Datasette(immutables=[path], settings=settings)
+    db2 = ds2.get_database("big")
+    db2.hash_in_place_max_bytes = 0
+    assert db2.hash == expected
+    ds2.close()
+
+    # The sidecar is ignored once the file has changed
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    monkeypatch.setattr(datasette.database, "inspect_hash_with_sidecar", original)
+    ds3 = Datasette(immutables=[path], settings=settings)
+    db3 = ds3.get_database("big")
+    db3.hash_in_place_max_bytes = 0
+    assert await db3.wait_for_hash() == expected
+    ds3.close()
+
+
+@pytest.mark.asyncio
+async def test_database_hash_sidecar_files_off_by_default(tmpdir):
+    path = _create_immutable_db(tmpdir / "big.db")
+    ds = Datasette(immutables=[path])
+    db = ds.get_database("big")
+    db.hash_in_place_max_bytes = 0
+    assert await db.wait_for_hash() == _sha256(path)
+    assert not os.path.exists(path + ".datasette-hash.json")
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_database_hash_small_file_and_errors(tmpdir, monkeypatch):
+    path = _create_immutable_db(tmpdir / "small.db")
+    ds = Datasette(immutables=[path])
+    db = ds.get_database("small")
+    assert db.hash == _sha256(path)
+    assert not os.path.exists(path + ".datasette-hash.json")
+    ds.close()
+
+    def broken(path):
+        raise OSError("Disk error")
+
+    monkeypatch.setattr(datasette.database, "inspect_hash", broken)
+    ds = Datasette(immutables=[path], memory=True)
+    db = ds.get_database("small")
+    db.hash_in_place_max_bytes = 0
+    assert await db.wait_for_hash() is None
+    assert db.hash_status == "error"
+    assert db.hash_error == "Disk error"
+    assert ds.get_database("_memory").hash_status is None
+    ds.close()
+
+
+def test_database_fingerprint(tmpdir):
+    path = _create_immutable_db(tmpdir / "data.db")
+    ds = Datasette([path], memory=True)
+    db = ds.get_database("data")
+    fingerprint = db.fingerprint
+    assert len(fingerprint) == 64
+    assert db.fingerprint == fingerprint
+    conn = sqlite3.connect(path)
+    conn.execute("update t set name = 'y' where id = 1")
+    conn.commit()
+    conn.close()
+    assert db.fingerprint != fingerprint
+    assert ds.get_database("_memory").fingerprint is None
+    ds.close()
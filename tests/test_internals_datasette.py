@@ -8,12 +8,14 @@ import hashlib
 import importlib
 import os
 import sqlite3
+import threading
 import time
+import urllib.parse
 from datasette import Context
 from datasette.app import Datasette, Database, ResourcesSQL
 from datasette.database import DatasetteClosedError
 from datasette.resources import DatabaseResource
-from datasette.utils import PrefixedUrlString
+from datasette.utils import PrefixedUrlString, StartupError
 from itsdangerous import BadSignature
 import pytest
 
@@ -177,6 +179,7 @@ async def test_datasette_constructor():
             "is_mutable": False,
             "is_memory": True,
             "hash": None,
+            "hash_status": None,
         }
     ]
 
@@ -478,3 +481,124 @@ async def test_datasette_render_template_dataclass_values_not_deep_copied():
     await ds.invoke_startup()
     rendered = await ds.render_template("error.html", context)
     assert "shallow-copied-value" in rendered
+
+
+@pytest.mark.asyncio
+async def test_per_database_sql_thread_pools(tmp_path):
+    paths = []
+    for name in ("big", "archive_1", "archive_2", "small"):
+        path = str(tmp_path / "{}.db".format(name))
+        sqlite3.connect(path).execute("create table t (id integer primary key)")
+        paths.append(path)
+    ds = Datasette(
+        paths,
+        config={
+            "sql_thread_pools": {"archives": {"num_sql_threads": 1}},
+            "databases": {
+                "big": {"num_sql_threads": 2},
+                "archive_1": {"sql_thread_pool": "archives"},
+                "archive_2": {"sql_thread_pool": "archives"},
+            },
+        },
+    )
+    assert ds.get_database("big").sql_thread_pool.name == "database:big"
+    assert ds.get_database("big").sql_thread_pool.num_threads == 2
+    assert ds.get_database("archive_1").sql_thread_pool.name == "archives"
+    assert (
+        ds.get_database("archive_1").sql_thread_pool
+        is ds.get_database("archive_2").sql_thread_pool
+    )
+    assert ds.get_database("small").sql_thread_pool.name == "default"
+
+    def thread_name(conn):
+        return threading.current_thread().name
+
+    assert (await ds.get_database("big").execute_fn(thread_name)).startswith(
+        "datasette-sql-database:big"
+    )
+    assert (await ds.get_database("archive_2").execute_fn(thread_name)).startswith(
+        "datasette-sql-archives"
+    )
+    assert (await ds.get_database("small").execute_fn(thread_name)).startswith(
+        "datasette-sql-default"
+    )
+    # Read connection pools are sized to match their thread pool
+    assert ds.get_database("big").read_pool.max_size == 2
+    assert ds.get_database("archive_1").read_pool.max_size == 1
+    stats = ds._sql_thread_pools["archives"].stats()
+    assert stats["completed"] == 1
+    assert stats["queued"] == stats["running"] == 0
+    ds.close()
+
+
+@pytest.mark.parametrize(
+    "config,error",
+    (
+        (
+            {"databases": {"data": {"sql_thread_pool": "missing"}}},
+            "Database data uses unknown sql_thread_pool: missing",
+        ),
+        (
+            {"databases": {"data": {"num_sql_threads": 0}}},
+            "databases.data.num_sql_threads must be a positive integer",
+        ),
+        (
+            {"sql_thread_pools": {"pool": {"num_sql_threads": "2"}}},
+            "sql_thread_pools.pool.num_sql_threads must be a positive integer",
+        ),
+    ),
+)
+def test_sql_thread_pool_config_errors(config, error):
+    with pytest.raises(StartupError) as ex:
+        Datasette(memory=True, config=config)
+    assert str(ex.value) == error
+
+
+@pytest.mark.asyncio
+async def test_client_disconnect_cancels_query(tmp_path):
+    path = str(tmp_path / "disconnect.db")
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    ds = Datasette(
+        [path], settings={"num_sql_threads": 1, "sql_time_limit_ms": 60 * 1000}
+    )
+    await ds.invoke_startup()
+    db = ds.get_database("disconnect")
+    app = ds.app()
+    sql = (
+        "with recursive c(x) as (select 0 union all select x + 1 from c) "
+        "select count(*) from c where x < 100000000"
+    )
+    disconnect = asyncio.Event()
+    inbox = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if inbox:
+            return inbox.pop(0)
+        await disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/disconnect/-/query.json",
+        "raw_path": b"/disconnect/-/query.json",
+        "query_string": urllib.parse.urlencode({"sql": sql}).encode("latin-1"),
+        "headers": [(b"host", b"localhost")],
+    }
+    request = asyncio.ensure_future(app(scope, receive, send))
+    while db.sql_thread_pool.stats()["running"] == 0:
+        await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    disconnect.set()
+    await asyncio.wait_for(request, timeout=10)
+    assert time.perf_counter() - start < 5
+    assert sent == []
+    assert db.cancelled_queries == 1
+    ds.close()
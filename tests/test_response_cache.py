@@ -0,0 +1,198 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from datasette.app import Datasette
+
+
+@pytest.fixture
+def cached_ds(tmpdir):
+    path = str(tmpdir / "data.db")
+    conn = sqlite3.connect(path)
+    conn.execute("create table t (id integer primary key, name text)")
+    conn.execute("insert into t (name) values ('one')")
+    conn.commit()
+    conn.close()
+    ds = Datasette([path], settings={"response_cache_size_kb": 1000})
+    calls = []
+    db = ds.get_database("data")
+    original_execute = db.execute
+
+    async def counting_execute(sql, *args, **kwargs):
+        calls.append(sql)
+        return await original_execute(sql, *args, **kwargs)
+
+    db.execute = counting_execute
+    ds._test_calls = calls
+    yield ds
+    ds.close()
+
+
+@pytest.mark.asyncio
+async def test_response_cache_serves_repeated_requests(cached_ds):
+    calls = cached_ds._test_calls
+    first = await cached_ds.client.get("/data/t.json")
+    assert first.status_code == 200
+    num_calls = len(calls)
+    assert num_calls
+    second = await cached_ds.client.get("/data/t.json")
+    assert second.status_code == 200
+    assert second.content == first.content
+    assert second.headers["content-type"] == first.headers["content-type"]
+    assert len(calls) == num_calls
+    stats = cached_ds.response_cache.stats()
+    assert stats["hits"] == 1
+    assert stats["entries"] == 1
+    # A different query string is a different entry
+    await cached_ds.client.get("/data/t.json?_size=1")
+    assert len(calls) > num_calls
+    assert cached_ds.response_cache.stats()["entries"] == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "path,kwargs",
+    (
+        ("/data/t.json?_nocache=1", {}),
+        ("/data/t.json?_trace=1", {}),
+        ("/data/t?_context=1", {}),
+        ("/data/t.json", {"cookies": {"analytics": "1"}}),
+        ("/data/t.json", {"headers": {"Authorization": "Bearer x"}}),
+        ("/data/t.json", {"actor": {"id": "root"}}),
+    ),
+)
+async def test_response_cache_bypassed(cached_ds, path, kwargs):
+    for _ in range(2):
+        await cached_ds.client.get(path, **kwargs)
+    stats = cached_ds.response_cache.stats()
+    assert stats["entries"] == 0
+    assert stats["hits"] == 0
+
+
+@pytest.mark.asyncio
+async def test_response_cache_skips_actors_from_plugins(cached_ds):
+    from datasette import hookimpl
+    from datasette.plugins import pm
+
+    class ActorFromQueryString:
+        __name__ = "ActorFromQueryString"
+
+        @hookimpl
+        def actor_from_request(self, request):
+            if request.args.get("user"):
+                return {"id": request.args["user"]}
+
+    pm.register(ActorFromQueryString(), name="actor_from_query_string")
+    try:
+        for _ in range(2):
+            await cached_ds.client.get("/data/t.json?user=alice")
+        assert cached_ds.response_cache.stats()["entries"] == 0
+    finally:
+        pm.unregister(name="actor_from_query_string")
+
+
+@pytest.mark.asyncio
+async def test_response_cache_not_served_to_actors_from_plugins(cached_ds):
+    from datasette import hookimpl
+    from datasette.plugins import pm
+
+    class ActorFromHeader:
+        __name__ = "ActorFromHeader"
+
+        @hookimpl
+        def actor_from_request(self, request):
+            if request.headers.get("x-user"):
+                return {"id": request.headers["x-user"]}
+
+    # Anonymous responses are cached first
+    anonymous = {}
+    for path in ("/-/actor.json", "/data/t"):
+        anonymous[path] = (await cached_ds.client.get(path)).text
+    pm.register(ActorFromHeader(), name="actor_from_header")
+    try:
+        response = await cached_ds.client.get(
+            "/-/actor.json", headers={"x-user": "alice"}
+        )
+        assert response.json()["actor"] == {"id": "alice"}
+        response = await cached_ds.client.get("/data/t", headers={"x-user": "alice"})
+        assert response.text != anonymous["/data/t"]
+        assert "alice" in response.text
+        # Anonymous requests are still served from the cache
+        hits = cached_ds.response_cache.stats()["hits"]
+        response = await cached_ds.client.get("/-/actor.json")
+        assert response.text == anonymous["/-/actor.json"]
+        assert cached_ds.response_cache.stats()["hits"] == hits + 1
+    finally:
+        pm.unregister(name="actor_from_header")
+
+
+@pytest.mark.asyncio
+async def test_response_cache_key_only_checks_database_in_path(cached_ds):
+    from datasette.response_cache import AsgiResponseCache
+
+    cached_ds.add_memory_database("other")
+    checked = []
+    for db in cached_ds.databases.values():
+
+        def current_version(db=db, original=db._current_version):
+            checked.append(db.name)
+            return original()
+
+        db._current_version = current_version
+    cache = AsgiResponseCache(None, cached_ds)
+    for path, expected in (
+        ("/data/t.json", ["data"]),
+        ("/data.json", ["data"]),
+        ("/other", ["other"]),
+        ("/-/databases.json", list(cached_ds.databases)),
+        ("/", list(cached_ds.databases)),
+    ):
+        checked.clear()
+        scope = {"type": "http", "method": "GET", "path": path, "headers": []}
+        assert cache.cache_key(scope) is not None
+        assert checked == expected
+
+
+@pytest.mark.asyncio
+async def test_response_cache_invalidated_by_writes(cached_ds):
+    first = await cached_ds.client.get("/data/t.json?_shape=array")
+    assert [r["name"] for r in first.json()] == ["one"]
+    await cached_ds.get_database("data").execute_write(
+        "insert into t (name) values ('two')"
+    )
+    second = await cached_ds.client.get("/data/t.json?_shape=array")
+    assert [r["name"] for r in second.json()] == ["one", "two"]
+    # Writes from another connection are seen too
+    conn = sqlite3.connect(cached_ds.get_database("data").path)
+    conn.execute("insert into t (name) values ('three')")
+    conn.commit()
+    conn.close()
+    third = await cached_ds.client.get("/data/t.json?_shape=array")
+    assert [r["name"] for r in third.json()] == ["one", "two", "three"]
+    assert cached_ds.response_cache.stats()["hits"] == 0
+
+
+@pytest.mark.asyncio
+async def test_response_cache_stale_while_revalidate(cached_ds):
+    cache = cached_ds.response_cache
+    cache.ttl = 0.2
+    calls = cached_ds._test_calls
+    await cached_ds.client.get("/data/t.json")
+    num_calls = len(calls)
+    time.sleep(0.25)
+    # Stale response is served while it is refreshed in the background
+    await cached_ds.client.get("/data/t.json")
+    assert cache.stats()["stale_hits"] == 1
+    for _ in range(50):
+        if len(calls) > num_calls and not cache._refreshing:
+            break
+        await asyncio.sleep(0.01)
+    assert len(calls) > num_calls
+    await cached_ds.client.get("/data/t.json")
+    assert cache.stats()["hits"] == 1
+    # Entries older than twice the TTL are not used at all
+    time.sleep(0.45)
+    await cached_ds.client.get("/data/t.json")
+    assert cache.stats()["misses"] == 2
@@ -81,6 +81,7 @@ async def test_db_with_route_databases(ds_with_route):
         "is_mutable": True,
         "is_memory": True,
         "hash": None,
+        "hash_status": None,
     }
 
 
@@ -17,6 +17,7 @@ import os
 import pathlib
 import pytest
 import tempfile
+import time
 from unittest.mock import patch
 
 
@@ -921,3 +922,42 @@ def test_deep_dict_update(dict1, dict2, expected):
     assert result == expected
     # Check that the original dict1 was modified
     assert dict1 == expected
+
+
+SLOW_SQL = (
+    "with recursive c(x) as (select 0 union all select x + 1 from c) "
+    "select count(*) from c where x < 1000000000"
+)
+
+
+def test_sqlite_timelimit_interrupts_query():
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    start = time.perf_counter()
+    with (
+        pytest.raises(sqlite3.OperationalError) as ex,
+        utils.sqlite_timelimit(conn, 50),
+    ):
+        conn.execute(SLOW_SQL).fetchall()
+    assert ex.value.args == ("interrupted",)
+    assert time.perf_counter() - start < 5
+    # Once the block has exited the connection is usable again
+    assert conn.execute("select 1").fetchone()[0] == 1
+
+
+def test_sqlite_timelimit_interrupts_statement_started_after_deadline():
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    with (
+        pytest.raises(sqlite3.OperationalError) as ex,
+        utils.sqlite_timelimit(conn, 50),
+    ):
+        time.sleep(0.1)
+        conn.execute(SLOW_SQL).fetchall()
+    assert ex.value.args == ("interrupted",)
+
+
+def test_sqlite_timelimit_small_limit_is_deterministic():
+    conn = sqlite3.connect(":memory:")
+    conn.create_function("sleep", 1, time.sleep)
+    with pytest.raises(sqlite3.OperationalError) as ex, utils.sqlite_timelimit(conn, 5):
+        conn.execute("select sleep(0.01), 1").fetchall()
+    assert ex.value.args == ("interrupted",)